@@ -0,0 +1,60 @@
+"""
+Time the cascade status stage of prep_target_visit_features on synthetic
+encounters, and check its categories against the row-wise implementation
+it replaced on a prefix of the data.
+
+usage: PYTHONPATH=. python benchmarks/bench_target_features.py [n_encounters] [n_checked]
+"""
+import sys
+import time
+import pandas as pd
+from src.common import target_features
+from benchmarks.synthetic import make_targets
+
+
+def rowwise_cascade_status(targets_df):
+    # the apply-based version cascade_status replaced
+    targets_df = targets_df.copy()
+    targets_df["iit_lag"] = targets_df.groupby("key")["iit"].shift(1)
+    targets_df["date_reengaged"] = targets_df.apply(
+        lambda x: x["visitdate"] if x["iit_lag"] == 1 else None, axis=1
+    )
+    targets_df["date_reengaged"] = targets_df.groupby("key")["date_reengaged"].ffill()
+    targets_df["date_reengaged"] = pd.to_datetime(
+        targets_df["date_reengaged"], errors="coerce"
+    )
+    monthssincerestart = (
+        targets_df["visitdate"] - targets_df["date_reengaged"]
+    ).dt.days / 30
+    return monthssincerestart.fillna(-1).apply(
+        lambda x: (
+            "neverdisengaged"
+            if x == -1
+            else ("shorttermrestart" if x <= 6 else "longtermrestart")
+        )
+    )
+
+
+def main(n_encounters=1_000_000, n_checked=100_000):
+    targets_df = make_targets(n_encounters)
+    print(f"{len(targets_df)} encounters, {targets_df['key'].nunique()} patients")
+
+    start = time.perf_counter()
+    status = target_features.cascade_status(
+        targets_df["key"], targets_df["visitdate"], targets_df["iit"]
+    )
+    print(f"cascade_status: {time.perf_counter() - start:.2f} seconds")
+
+    prefix = targets_df.iloc[:n_checked]
+    start = time.perf_counter()
+    expected = rowwise_cascade_status(prefix)
+    print(f"row-wise on {len(prefix)} encounters: {time.perf_counter() - start:.2f} seconds")
+    # the prefix may cut the last patient short, which does not change the
+    # status of its earlier encounters
+    if not (status[: len(prefix)] == expected.to_numpy()).all():
+        raise AssertionError("cascade_status differs from the row-wise categories")
+    print("categories identical")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
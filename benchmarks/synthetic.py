@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+
+def make_targets(n_encounters=1_000_000, encounters_per_patient=20, seed=0):
+    """
+    Synthetic targets in the shape create_target returns: integer keys,
+    encounters sorted by key and visitdate, roughly a month apart, with
+    about one in eight followed by an interruption in treatment.
+
+    Args:
+        n_encounters (int): Number of encounters.
+        encounters_per_patient (int): Average encounters per patient.
+        seed (int): Random seed.
+
+    Returns:
+        pd.DataFrame: key, visitdate, nad and iit.
+    """
+    rng = np.random.default_rng(seed)
+    n_patients = max(n_encounters // encounters_per_patient, 1)
+    keys = np.sort(rng.integers(0, n_patients, n_encounters)).astype(np.int32)
+    gaps = rng.choice([14, 30, 30, 60, 90, 180], n_encounters)
+    days = np.cumsum(gaps)
+    # restart each patient's visits in 2019
+    first = np.ones(n_encounters, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    start = np.maximum.accumulate(np.where(first, np.arange(n_encounters), 0))
+    days = days - days[start]
+    visitdate = pd.Timestamp("2019-01-01") + pd.to_timedelta(days, unit="D")
+    return pd.DataFrame(
+        {
+            "key": keys,
+            "visitdate": visitdate,
+            "nad": visitdate + pd.to_timedelta(gaps, unit="D"),
+            "iit": (rng.random(n_encounters) < 0.125).astype(np.int64),
+        }
+    )
@@ -5,51 +5,119 @@ from src.common import visit_features
 from src.common import dem_features
 from src.common import create_target
 from src.common import target_features
+from src.common import patient_keys
 from src.inference import locational_features_inf
 from src.inference import generate_inference
-from datetime import datetime
+from src.inference import model_registry
+from src.inference import result_cache
+from src.common.metrics import stage_timer
 
-def getTime():
-    return(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+def build_inference_features(lab, pharmacy, visits, dem, start_date, end_date, artifacts, latest_only = True):
+
+    # key every table with integer patient ids, so the stages below sort,
+    # group and join on integers rather than the patientpkhash strings
+    with stage_timer("intern_keys"):
+        lab, pharmacy, visits, dem, key_table = patient_keys.intern_keys(lab, pharmacy, visits, dem)
+
+    # Run cleaning and feature preparation functions, timing each stage
+    with stage_timer("clean_lab"):
+        lab = clean_data.clean_lab(lab, start_date = start_date)
+    with stage_timer("clean_pharmacy"):
+        pharmacy = clean_data.clean_pharmacy(pharmacy, start_date = start_date, end_date = end_date)
+    with stage_timer("clean_visits"):
+        visits = clean_data.clean_visits(visits, dem, start_date = start_date, end_date = end_date)
+    with stage_timer("visit_features"):
+        visits = visit_features.prep_visit_features(visits)
+    with stage_timer("demographics"):
+        visits = dem_features.prep_demographics(visits, dem_cleaned = True)
+
+    # a patient's most recent visit is judged unresolved against the latest
+    # visit at the site up to end_date, from the site activity index written
+    # by retraining, rather than against the patients in this request
+    with stage_timer("create_target"):
+        targets = create_target.create_target(
+            visits, pharmacy, dem, artifacts.site_activity, end_date = end_date
+        )
+    if targets.empty:
+        # no encounter left to score, e.g. the only visit is still unresolved
+        return targets
+    # the visit, pharmacy and lab stages of the target features time themselves
+    if latest_only:
+        # only the most recent encounter of each patient is scored, so only
+        # compute features for it and the visits its rolling windows need
+        targets = target_features.prep_latest_target_features(targets, visits, pharmacy, lab)
+    else:
+        targets = target_features.prep_target_features(targets, visits, pharmacy, lab, per_patient_labs = True)
+    with stage_timer("locational"):
+        targets = locational_features_inf.get_locational_features(targets, artifacts.locational)
+
+    # results are reported by the patientpkhash + sitecode key
+    if "key" in targets.columns:
+        targets["key"] = patient_keys.decode_keys(targets["key"], key_table)
+    return targets
 
 def run_inference_pipeline(ppk = str, sc = str, start_date = str, end_date = str):
 
+    # take one snapshot of the model bundle so the whole request is scored
+    # with a consistent model, encoder, thresholds and locational table
+    artifacts = model_registry.get_artifacts()
+
+    # only fetch the history the features can look back over
+    since = get_inference_data.history_since(start_date, end_date)
+
+    # reuse the last prediction for this patient if none of their records
+    # has been written since and the model bundle, locational table and site
+    # activity index are the same. If a fingerprint query is configured, a
+    # cache hit skips the stored procedures altogether.
+    cache_key = (ppk, str(sc), start_date, end_date, artifacts.version, artifacts.data_version)
+    with stage_timer("fingerprint"):
+        stamp = get_inference_data.get_data_fingerprint(ppk)
+    pred = result_cache.get(cache_key, stamp)
+    if pred is not None:
+        return pred
+
     # For retraining, prediction is False, so won't add that as argument to parent function
-    # lab, pharmacy, visits, dem = get_inference_data.get_inference_data_sqlite(patientPK= ppk, sitecode= sc)
-    lab, pharmacy, visits, dem = get_inference_data.get_inference_data_mysql(patientPK= ppk, sitecode= sc)
-
-    # Run cleaning and feature preparation functions
-    lab = clean_data.clean_lab(lab, start_date = start_date)
-    pharmacy = clean_data.clean_pharmacy(pharmacy, start_date = start_date, end_date = end_date)
-    visits = clean_data.clean_visits(visits, dem, start_date = start_date, end_date = end_date)
-    visits = visit_features.prep_visit_features(visits)
-    visits = dem_features.prep_demographics(visits)
-
-    print("DEBUG: lab.columns:", lab.columns)
-    print("DEBUG: lab.shape:", lab.shape)
-    print("DEBUG: pharmacy.columns:", pharmacy.columns)
-    print("DEBUG: pharmacy.shape:", pharmacy.shape)
-    print("DEBUG: visits.columns:", visits.columns)
-    print("DEBUG: visits.shape:", visits.shape)
-    print("DEBUG: dem.columns:", dem.columns)
-    print("DEBUG: dem.shape:", dem.shape)
-
-    targets = create_target.create_target(visits, pharmacy, dem)
-    print("DEBUG ",getTime() , " TARGETS 1: ", targets.shape)
-    targets = target_features.prep_target_visit_features(targets, visits)
-    print("DEBUG ",getTime() , " TARGETS 2: ", targets.shape)
-    targets = target_features.prep_target_pharmacy_features(targets, pharmacy)
-    print("DEBUG ",getTime() , " TARGETS 3: ", targets.shape)
-    targets = target_features.prep_target_lab_features(targets, lab)
-    print("DEBUG ",getTime() , " TARGETS 4: ", targets.shape)
-    targets = locational_features_inf.get_locational_features(targets)
-    print("DEBUG ",getTime() , " TARGETS 5: ", targets.shape)
-    pred = generate_inference.gen_inference(targets, sc)
-    print(pred)
+    # lab, pharmacy, visits, dem = get_inference_data.get_inference_data_sqlite(patientPK= ppk, sitecode= sc, since= since)
+    with stage_timer("fetch"):
+        lab, pharmacy, visits, dem = get_inference_data.get_inference_data_mysql(patientPK= ppk, sitecode= sc, since= since)
+
+    if stamp is None:
+        # no fingerprint query is configured, or it failed, so fingerprint
+        # the fetched tables
+        stamp = result_cache.fingerprint(lab, pharmacy, visits, dem)
+        pred = result_cache.get(cache_key, stamp)
+        if pred is not None:
+            return pred
+    elif any(df is None for df in (lab, pharmacy, visits, dem)):
+        # a prediction from a partial fetch is not cached
+        stamp = None
+
+    targets = build_inference_features(lab, pharmacy, visits, dem, start_date, end_date, artifacts)
+    pred = generate_inference.gen_inference(targets, sc, artifacts)
+    result_cache.put(cache_key, stamp, pred)
     return pred
 
+def run_batch_inference_pipeline(patients = list, start_date = str, end_date = str):
+
+    # patients is a list of (ppk, sc) pairs. Their data is fetched with all
+    # the per-patient procedures in flight at once, then cleaned, featurised
+    # and scored together in a single pass. Each patient's score depends only
+    # on their own data, the model bundle and its site activity index.
+    artifacts = model_registry.get_artifacts()
+
+    since = get_inference_data.history_since(start_date, end_date)
+    with stage_timer("fetch"):
+        lab, pharmacy, visits, dem = get_inference_data.get_batch_inference_data_mysql(patients, since= since)
+
+    targets = build_inference_features(lab, pharmacy, visits, dem, start_date, end_date, artifacts)
+
+    # the key of each patient is the patientpkhash concatenated with the sitecode
+    sitecodes = {ppk + str(sc): sc for ppk, sc in patients}
+    results = generate_inference.gen_batch_inference(targets, sitecodes, artifacts)
+    return [{"ppk": ppk, "sc": sc, **results[ppk + str(sc)]} for ppk, sc in patients]
+
 if __name__ == "__main__":
-    run_inference_pipeline(ppk = "7E14A8034F39478149EE6A4CA37A247C631D17907C746BE0336D3D7CEC68F66F",
+    print(run_inference_pipeline(ppk = "7E14A8034F39478149EE6A4CA37A247C631D17907C746BE0336D3D7CEC68F66F",
                            sc = "13074",
                             start_date = "2021-01-01",
-                            end_date = "2025-01-15")
\ No newline at end of file
+                            end_date = "2025-01-15"))
\ No newline at end of file
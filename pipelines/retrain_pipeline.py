@@ -5,8 +5,12 @@ from src.common import visit_features
 from src.common import dem_features
 from src.common import create_target
 from src.common import target_features
+from src.common import patient_keys
+from src.common import site_activity
 from src.training import locational_features
 from src.training import refresh_model
+from src.common import metrics
+from src.common.metrics import stage_timer
 
 # general imports
 import boto3
@@ -20,89 +24,97 @@ def run_retraining_pipeline(aws = True, start_date = str, end_date = str, refres
     start_time = time.time()
 
     # For retraining, prediction is False, so won't add that as argument to parent function
-    lab, pharmacy, visits, dem, mfl, dhs, txcurr = get_data.get_training_data_mysql(aws = aws)
+    with stage_timer("fetch", pipeline="retrain"):
+        lab, pharmacy, visits, dem, mfl, dhs, txcurr = get_data.get_training_data_mysql(aws = aws)
+
+    # key every table with integer patient ids; the patientpkhash and sitecode
+    # behind each id are saved alongside the stage outputs
+    with stage_timer("intern_keys", pipeline="retrain"):
+        lab, pharmacy, visits, dem, key_table = patient_keys.intern_keys(lab, pharmacy, visits, dem)
+    buffer = io.BytesIO()
+    key_table.to_parquet(buffer, index=False)
+    s3.put_object(Bucket='kehmisjan2025', Key='keys0521.parquet', Body=buffer.getvalue())
 
     # Run cleaning and feature preparation functions
-    lab = clean_data.clean_lab(lab, start_date = start_date)
+    with stage_timer("clean_lab", pipeline="retrain"):
+        lab = clean_data.clean_lab(lab, start_date = start_date)
     buffer = io.BytesIO()
     lab.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='lab0521.parquet', Body=buffer.getvalue())
     print("lab cleaned")
-    print(time.time() - start_time)
 
-    pharmacy = clean_data.clean_pharmacy(pharmacy, start_date = start_date, end_date = end_date)
+    with stage_timer("clean_pharmacy", pipeline="retrain"):
+        pharmacy = clean_data.clean_pharmacy(pharmacy, start_date = start_date, end_date = end_date)
     buffer = io.BytesIO()
     pharmacy.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='pharmacy0521.parquet', Body=buffer.getvalue())
     print("pharmacy cleaned")
-    print(time.time() - start_time)
 
     print("cleaning visits")
-    visits = clean_data.clean_visits(visits, dem, start_date = start_date, end_date = end_date)
+    with stage_timer("clean_visits", pipeline="retrain"):
+        visits = clean_data.clean_visits(visits, dem, start_date = start_date, end_date = end_date)
     buffer = io.BytesIO()
     visits.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='visits0521.parquet', Body=buffer.getvalue())
     print("visits cleaned")
-    print(time.time() - start_time)
 
-    visits = visit_features.prep_visit_features(visits)
+    with stage_timer("visit_features", pipeline="retrain"):
+        visits = visit_features.prep_visit_features(visits)
     buffer = io.BytesIO()
     visits.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='visits0521.parquet', Body=buffer.getvalue())
     print("visits features prepared")
-    print(time.time() - start_time)
 
-    visits = dem_features.prep_demographics(visits)
+    with stage_timer("demographics", pipeline="retrain"):
+        visits = dem_features.prep_demographics(visits, dem_cleaned = True)
     buffer = io.BytesIO()
     visits.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='visits0521.parquet', Body=buffer.getvalue())
     print("demographics features prepared")
-    print(time.time() - start_time)
+
+    # fold the visits into the site activity index saved next to the
+    # locational features, for inference to look sites up in. targets are
+    # labelled against this run's own visits, so a run over the same window
+    # gives the same targets whatever earlier runs saved
+    with stage_timer("site_activity", pipeline="retrain"):
+        activity = site_activity.refresh_site_activity(visits["sitecode"], visits["visitdate"])
+    with open(site_activity.SITE_ACTIVITY_FILE, "rb") as f:
+        s3.put_object(Bucket='kehmisjan2025', Key='site_activity_latest.csv', Body=f.read())
+    print("site activity index updated")
 
     print('creating targets')
-    targets = create_target.create_target(visits, pharmacy, dem)
+    with stage_timer("create_target", pipeline="retrain"):
+        targets = create_target.create_target(visits, pharmacy, dem, activity, end_date = end_date)
     buffer = io.BytesIO()
     targets.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='targets0521.parquet', Body=buffer.getvalue())
     print("targets created")
-    print(time.time() - start_time)
-
-    print("prepping target visit features")
-    targets = target_features.prep_target_visit_features(targets, visits)
-    buffer = io.BytesIO()
-    targets.to_parquet(buffer, index=False)
-    s3.put_object(Bucket='kehmisjan2025', Key='targets0521.parquet', Body=buffer.getvalue())
-    print("lateness metrics developed")
-    print(time.time() - start_time)
-
-    targets = target_features.prep_target_pharmacy_features(targets, pharmacy)
-    buffer = io.BytesIO()
-    targets.to_parquet(buffer, index=False)
-    s3.put_object(Bucket='kehmisjan2025', Key='targets0521.parquet', Body=buffer.getvalue())
-    print("pharmacy features developed")
-    print(time.time() - start_time)
 
-    targets = target_features.prep_target_lab_features(targets, lab)
+    print("prepping target visit, pharmacy and lab features")
+    # the visit, pharmacy and lab stages time themselves
+    targets = target_features.prep_target_features(targets, visits, pharmacy, lab, pipeline="retrain")
     buffer = io.BytesIO()
     targets.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='targets0521.parquet', Body=buffer.getvalue())
-    print("lab features developed")
-    print(time.time() - start_time)
+    print("lateness metrics, pharmacy and lab features developed")
 
-    targets = locational_features.prep_locational_features(targets, mfl, dhs, txcurr)
+    with stage_timer("locational", pipeline="retrain"):
+        targets = locational_features.prep_locational_features(targets, mfl, dhs, txcurr)
     buffer = io.BytesIO()
     targets.to_parquet(buffer, index=False)
     s3.put_object(Bucket='kehmisjan2025', Key='targets0521.parquet', Body=buffer.getvalue())
     print("locational features developed")
-    print(time.time() - start_time)
 
     # if running in pipeline, then targets_df = targets and pipeline = True.
     # if running from AWS, then targets_aws is the filename and pipeline = False.
-    refresh_model.refresh_model(pipeline = True, targets_df = targets, refresh_date = refresh_date)
+    with stage_timer("refresh_model", pipeline="retrain"):
+        refresh_model.refresh_model(pipeline = True, targets_df = targets, refresh_date = refresh_date)
 
     # end time
     end_time = time.time()
     print("Time taken to run the script: ", end_time - start_time, " seconds")
+    for stage, seconds in metrics.stage_totals("retrain").items():
+        print(f"  {stage}: {seconds:.1f} seconds")
 
 if __name__ == "__main__":
     # run the pipeline
@@ -1,7 +1,44 @@
 from . import helpers
+from . import dem_features
 from datetime import datetime
 import pandas as pd
 
+# raw columns each cleaning function reads (lower case); everything else is
+# dropped on entry, and the data loaders only select these. key is there when
+# the tables were keyed with patient_keys.intern_keys at ingest
+LAB_COLUMNS = ["key", "patientpkhash", "sitecode", "orderedbydate", "testname", "testresult"]
+PHARMACY_COLUMNS = [
+    "key",
+    "patientpkhash",
+    "sitecode",
+    "dispensedate",
+    "expectedreturn",
+    "treatmenttype",
+    "drug",
+]
+VISIT_COLUMNS = [
+    "key",
+    "patientpkhash",
+    "sitecode",
+    "visitdate",
+    "visittype",
+    "visitby",
+    "nextappointmentdate",
+    "tcareason",
+    "pregnant",
+    "breastfeeding",
+    "stabilityassessment",
+    "differentiatedcare",
+    "whostage",
+    "height",
+    "weight",
+    "emr",
+    "adherence",
+    "currentregimen",
+]
+# demographics are keyed by mflcode in some sources and sitecode in others
+DEM_COLUMNS = ["key", "patientpkhash", "mflcode", "sitecode"] + dem_features.DEM_COLUMNS
+
 
 def clean_lab(data, start_date):
     """
@@ -19,20 +56,22 @@ def clean_lab(data, start_date):
         )
 
     # if data is not empty, we proceed with cleaning
-    # make column names lower case
+    # make column names lower case and keep only the columns used below
     data.columns = data.columns.str.lower()
+    data = helpers.select_columns(data, LAB_COLUMNS)
 
-    # Concatenate patientpkhash and sitecode to create a unique key
-    # first make sitecode a string
+    # make sitecode a string
     data["sitecode"] = data["sitecode"].astype(str)
-    # now concatenate
-    data["key"] = data["patientpkhash"] + data["sitecode"]
+    # unless the tables were keyed at ingest, concatenate patientpkhash
+    # and sitecode to create a unique key
+    if "key" not in data.columns:
+        data["key"] = data["patientpkhash"] + data["sitecode"]
 
     # parse the date column
-    data["orderedbydate"] = data["orderedbydate"].apply(helpers.parse_long_date)
+    data["orderedbydate"] = helpers.parse_long_dates(data["orderedbydate"])
 
-    # Convert start_date to datetime.date
-    start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+    # Convert start_date to a timestamp to compare with the parsed dates
+    start_date = pd.Timestamp(datetime.strptime(start_date, "%Y-%m-%d"))
     # Filter the data to only include records after the start_date
     data = data[data["orderedbydate"] >= start_date]
     if data.empty:
@@ -41,24 +80,12 @@ def clean_lab(data, start_date):
         )
 
     # Let's filter to VLs and CD4
-    # First, let's make testname lower case
-    # Modify the testname column in place
-    data.loc[:, "testname"] = data["testname"].str.lower()
-
     # Now let's adjust testname so that if it contains the strings % of percent,
     # we consider it a CD4 test; if it contains the string viral or vl, we consider it a VL test
     # and if it contains neither, we consider it an Other test
     # Note: this is a bit of a hack, but it works for now
-    # Adjust testname based on the specified conditions
-    # Ensure testname has no None or NaN values
-    data.loc[:, "testname"] = data["testname"].fillna("")
-    data.loc[:, "testname"] = data["testname"].apply(
-        lambda x: (
-            "CD4"
-            if "cd4" in x and "%" not in x and "percent" not in x
-            else "VL" if "viral" in x or "vl" in x else "Other"
-        )
-    )
+    # Adjust testname based on the specified conditions, once per distinct test name
+    data.loc[:, "testname"] = helpers.map_distinct(data["testname"], testname_rule)
 
     # Filter the data to only include CD4 and VL tests
     data = data[data["testname"].isin(["CD4", "VL"])]
@@ -72,6 +99,18 @@ def clean_lab(data, start_date):
     return data
 
 
+def testname_rule(testname):
+    # make testname lower case, with no None or NaN values
+    testname = testname.str.lower().fillna("")
+    return testname.apply(
+        lambda x: (
+            "CD4"
+            if "cd4" in x and "%" not in x and "percent" not in x
+            else "VL" if "viral" in x or "vl" in x else "Other"
+        )
+    )
+
+
 def clean_pharmacy(data, start_date, end_date):
     """
     Clean the pharmacy data by removing unnecessary columns and renaming others.
@@ -87,18 +126,20 @@ def clean_pharmacy(data, start_date, end_date):
             columns=expected_columns
         )
 
-    # make column names lower case
+    # make column names lower case and keep only the columns used below
     data.columns = data.columns.str.lower()
+    data = helpers.select_columns(data, PHARMACY_COLUMNS)
 
-    # Concatenate patientpkhash and sitecode to create a unique key
-    # first make sitecode a string
+    # make sitecode a string
     data["sitecode"] = data["sitecode"].astype(str)
-    # now concatenate
-    data["key"] = data["patientpkhash"] + data["sitecode"]
+    # unless the tables were keyed at ingest, concatenate patientpkhash
+    # and sitecode to create a unique key
+    if "key" not in data.columns:
+        data["key"] = data["patientpkhash"] + data["sitecode"]
 
     # parse the dispensedate and expectedreturn columns
-    data["dispensedate"] = data["dispensedate"].apply(helpers.parse_long_date)
-    data["expectedreturn"] = data["expectedreturn"].apply(helpers.parse_long_date)
+    data["dispensedate"] = helpers.parse_long_dates(data["dispensedate"])
+    data["expectedreturn"] = helpers.parse_long_dates(data["expectedreturn"])
 
     # Filter data to only include treatmenttype that is either ARV or PMTCT
     data.loc[:, "treatmenttype"] = data["treatmenttype"].str.lower()
@@ -106,9 +147,9 @@ def clean_pharmacy(data, start_date, end_date):
     data = data.loc[data["treatmenttype"].isin(["arv", "pmtct"])]
 
     # Filter the data to only include records after the start_date
-    # Convert start_date to datetime.date
-    start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
-    end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
+    # Convert start_date and end_date to timestamps to compare with the parsed dates
+    start_date = pd.Timestamp(datetime.strptime(start_date, "%Y-%m-%d"))
+    end_date = pd.Timestamp(datetime.strptime(end_date, "%Y-%m-%d"))
     data = data.loc[data["dispensedate"] >= start_date]
     data = data.loc[data["dispensedate"] <= end_date]
     if data.empty:
@@ -160,18 +201,11 @@ def clean_visits(data, dem_df, start_date, end_date):
                 "stabilityassessment",
                 "differentiatedcare",
                 "whostage",
-                "whostagingoi",
                 "height",
                 "weight",
                 "emr",
-                "project",
                 "adherence",
-                "adherencecategory",
-                "bp",
-                "oi",
-                "oidate",
                 "currentregimen",
-                "appointmentreminderwillingness",
                 "key",
                 "sex",
                 "maritalstatus",
@@ -187,16 +221,19 @@ def clean_visits(data, dem_df, start_date, end_date):
             columns=expected_columns
         )
 
-    # make column names lower case
+    # make column names lower case and keep only the visit columns used
+    # by cleaning and prep_visit_features
     data.columns = data.columns.str.lower()
+    data = helpers.select_columns(data, VISIT_COLUMNS)
     dem_df.columns = dem_df.columns.str.lower()
 
     # first, create key variables
-    # Concatenate patientpkhash and sitecode to create a unique key
-    # first make sitecode a string
+    # make sitecode a string
     data["sitecode"] = data["sitecode"].astype(str)
-    # now concatenate
-    data["key"] = data["patientpkhash"] + data["sitecode"]
+    # unless the tables were keyed at ingest, concatenate patientpkhash
+    # and sitecode to create a unique key
+    if "key" not in data.columns:
+        data["key"] = data["patientpkhash"] + data["sitecode"]
 
     # Repeat for dem_df
     if "key" not in dem_df.columns:
@@ -207,58 +244,37 @@ def clean_visits(data, dem_df, start_date, end_date):
         # now concatenate
         dem_df["key"] = dem_df["patientpkhash"] + dem_df["sitecode"]
 
-    # first, merge visits with demographics (dem) on the "key" column
-    data = data.merge(
-        dem_df[
-            [
-                "key",
-                "sex",
-                "maritalstatus",
-                "educationlevel",
-                "occupation",
-                "artoutcomedescription",
-                "startartdate",
-                "dob",
-            ]
-        ],
-        on="key",
-        how="inner",
-    )
-
-    # make the values in each column lower case except for the key column
-    cols_to_convert = data.columns.difference(["key"])
-
-    # print("DEBUG: data.shape before applymap:", data.shape)
-    # print("DEBUG: cols_to_convert:", cols_to_convert)
-    # print("DEBUG: data[cols_to_convert].shape:", data[cols_to_convert].shape)
-    # print("DEBUG: data[cols_to_convert].head():\n", data[cols_to_convert].head())
-
-    # print("DEBUG: data.columns:", list(data.columns))
-    # print("DEBUG: Are there duplicates?", len(data.columns) != len(set(data.columns)))
-    # print("DEBUG: END")
-
-    data[cols_to_convert] = data[cols_to_convert].applymap(
-        lambda x: x.lower() if isinstance(x, str) else x
-    )
-
     # parse the visitdate column
-    data["visitdate"] = data["visitdate"].apply(helpers.parse_long_date)
-    data["nextappointmentdate"] = data["nextappointmentdate"].apply(
-        helpers.parse_long_date
+    data["visitdate"] = helpers.parse_long_dates(data["visitdate"])
+    data["nextappointmentdate"] = helpers.parse_long_dates(
+        data["nextappointmentdate"]
     )
 
     # Filter the data to only include records after the start_date
-    # Convert start_date to datetime.date
-    start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
-    end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
+    # Convert start_date and end_date to timestamps to compare with the parsed dates
+    start_date = pd.Timestamp(datetime.strptime(start_date, "%Y-%m-%d"))
+    end_date = pd.Timestamp(datetime.strptime(end_date, "%Y-%m-%d"))
     data = data[data["visitdate"] >= start_date]
     data = data[data["visitdate"] <= end_date]
+
+    # lower case and remove whitespace from the visits' string values, in one
+    # pass over the rows left after the date filter
+    data = helpers.normalize_strings(
+        data, columns=[col for col in data.columns if col != "key"]
+    )
+
+    # clean the demographics once per patient, then merge them onto the
+    # visits on the "key" column
+    dem_attributes = dem_features.clean_dem_attributes(
+        dem_df[["key"] + dem_features.DEM_COLUMNS].copy()
+    )
+    data = data.merge(dem_attributes, on="key", how="inner")
     if data.empty:
         return pd.DataFrame(
             columns=expected_columns
         )
-    # remove whitespace from all columns
-    data = data.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    # the key is only stripped, not lower cased
+    data = helpers.normalize_strings(data, keep_case=("key",), columns=["key"])
 
     # remove illogical return dates
     data = helpers.remove_date(data, "visitdate", "nextappointmentdate")
@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
+from . import helpers
+from . import site_activity as site_activity_index
 
 
-def create_target(visits_df, pharmacy_df, dem_df):
+def create_target(visits_df, pharmacy_df, dem_df, site_activity=None, end_date=None):
     """
     Create the target variable for the model.
 
@@ -10,6 +12,12 @@ def create_target(visits_df, pharmacy_df, dem_df):
         visits_df (pd.DataFrame): DataFrame containing visit data.
         pharmacy_df (pd.DataFrame): DataFrame containing pharmacy data.
         dem_df (pd.DataFrame): DataFrame containing demographic data.
+        site_activity (pd.Series): Latest visitdate of each sitecode, from
+            the site_activity module. If None, it is built from the visits in
+            hand, which only covers every patient at a site when training on
+            the full tables.
+        end_date (str): End of the data window. Site activity after it is
+            not used to resolve outcomes.
 
     Returns:
         pd.DataFrame: DataFrame with the target variable added.
@@ -19,11 +27,15 @@ def create_target(visits_df, pharmacy_df, dem_df):
         print("Both visits and pharmacy data are empty — no target to generate.")
         return pd.DataFrame()
 
+    # the stand-in for an empty table keeps the other table's key dtype, so
+    # stacking them does not turn integer keys into objects
     if visits_df.empty:
         visits_df = pd.DataFrame(columns=["key", "visitdate", "nad_imputed", "nad_imputation_flag", "sitecode"])
+        visits_df["key"] = visits_df["key"].astype(pharmacy_df["key"].dtype)
 
     if pharmacy_df.empty:
         pharmacy_df = pd.DataFrame(columns=["key", "dispensedate", "nad_imputed", "nad_imputation_flag", "sitecode"])
+        pharmacy_df["key"] = pharmacy_df["key"].astype(visits_df["key"].dtype)
 
 
     # select the relevant columns from visits_df and rename nad_imputed to nad
@@ -85,59 +97,68 @@ def create_target(visits_df, pharmacy_df, dem_df):
     # to do this, first sort the dataframe so that for each key and visitdate, nad_imputation flag of 0
     # is first, then nad_imputation_flag of 1, and then within each group of nad_imputation flag, sort by
     # nad is descending order so that the later nad date is first.
+    # this is the only sort: every step below works on row positions in this order
     target_df["visitdate"] = pd.to_datetime(target_df["visitdate"], errors="coerce")
-    # if there are more than one row per key and visitdate, set type to 'both'
-    target_df["type"] = np.where(
-        target_df.duplicated(subset=["key", "visitdate"], keep=False),
-        "both",
-        target_df["type"],
-    )
     target_df = target_df.sort_values(
         by=["key", "visitdate", "nad_imputation_flag", "nad"],
         ascending=[True, True, True, False],
     )
-    # print(target_df.shape)
-    # now, group by key and visitdate and take the first row
-    target_df = target_df.groupby(["key", "visitdate"]).first().reset_index()
+    # if there are more than one row per key and visitdate, set type to 'both'.
+    # those rows are next to each other after the sort
+    key = target_df["key"].to_numpy()
+    visitdate = target_df["visitdate"].to_numpy()
+    same_as_next = (key[1:] == key[:-1]) & (visitdate[1:] == visitdate[:-1])
+    duplicated = np.zeros(len(key), dtype=bool)
+    duplicated[1:] |= same_as_next
+    duplicated[:-1] |= same_as_next
+    target_df["type"] = np.where(duplicated, "both", target_df["type"])
+    # rows without a key or visitdate are dropped, as groupby does
+    has_key = (target_df["key"].notna() & target_df["visitdate"].notna()).to_numpy()
+    if not has_key.all():
+        target_df = target_df[has_key]
+    # now, take the first non-missing value of each column for each key and visitdate
+    target_df = helpers.first_per_group(target_df, ["key", "visitdate"])
     # drop rows where type is 'pharmacy'
-    target_df = target_df[target_df["type"] != "pharmacy"]
+    target_df = target_df[target_df["type"] != "pharmacy"].reset_index(drop=True)
     if target_df.empty:
         print("No data left after deduplication and filtering.")
         return pd.DataFrame()
 
+    # rows are now in key and visitdate order, one per key and visitdate;
+    # mark the first and last row of each key
+    key = target_df["key"].to_numpy()
+    n = len(key)
+    position = np.arange(n)
+    first = np.ones(n, dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+    last = np.ones(n, dtype=bool)
+    last[:-1] = first[1:]
+    key_start = np.maximum.accumulate(np.where(first, position, 0))
+    key_end = np.minimum.accumulate(np.where(last, position, n)[::-1])[::-1]
+
     ## Deal with out of order NAD
-    # sort the dataframe by key and visitdate in descending order
-    target_df = target_df.sort_values(by=["key", "visitdate"], ascending=[True, True])
     # create variable nad2 which for each row is going to be the max nad observed
-    # over all earlier touchpoints for that key, meaning the rows below
+    # over all earlier touchpoints for that key
     target_df["nad"] = pd.to_datetime(target_df["nad"], errors="coerce")
-    target_df["nad2"] = target_df.groupby("key")["nad"].cummax()
+    nad2 = target_df["nad"].groupby(key_start).cummax()
 
-    # create nad_imputation_flag_ooo column
-    # if nad2 is not equal to nad, set nad_imputation_flag_ooo to 1, else 0
-    target_df["nad_imputation_flag_ooo"] = np.where(
-        target_df["nad2"] != target_df["nad"], 1, 0
-    )
-    # update imputation flag - if either nad_imputation_flag or nad_imputation_flag_ooo is 1, set nad_imputation_flag to 1
+    # update imputation flag - if nad2 is not equal to nad (the nad was out of
+    # order), set nad_imputation_flag to 1
     target_df["nad_imputation_flag"] = np.where(
-        (target_df["nad_imputation_flag"] == 1)
-        | (target_df["nad_imputation_flag_ooo"] == 1),
+        (target_df["nad_imputation_flag"] == 1) | (nad2 != target_df["nad"]),
         1,
         0,
     )
-    # set nad to nad2 and drop nad2 and nad_imputation_flag_ooo
-    target_df["nad"] = target_df["nad2"]
-    target_df = target_df.drop(columns=["nad2", "nad_imputation_flag_ooo"])
+    # set nad to nad2
+    target_df["nad"] = nad2
 
     ## Calculate days to return and iit
-    # for each key, sort by visitdate in descending order
-    target_df = target_df.sort_values(by=["key", "visitdate"], ascending=[True, False])
-    # create a variable called num_visit which is the row number of the visit for each key
-    target_df["num_visit"] = target_df.groupby("key").cumcount()
-    # create 'actualreturndate' as the visitdate from the row above (ie the next visit)
-    target_df["actualreturndate"] = target_df.groupby("key")["visitdate"].shift(1)
+    # the actual return date is the visitdate of the key's next visit
+    visitdate = target_df["visitdate"].to_numpy()
+    actualreturndate = np.full(n, np.datetime64("NaT"), dtype=visitdate.dtype)
+    actualreturndate[~last] = visitdate[1:][~last[:-1]]
     # create a variable called visitdiff which is the difference between actualreturndate and nad
-    target_df["visitdiff"] = (target_df["actualreturndate"] - target_df["nad"]).dt.days
+    target_df["visitdiff"] = (pd.Series(actualreturndate) - target_df["nad"]).dt.days
     # create a variable called iit which is 1 if visitdiff is greater than 30, else 0
     target_df["iit"] = np.where(target_df["visitdiff"] > 30, 1, 0)
 
@@ -146,50 +167,42 @@ def create_target(visits_df, pharmacy_df, dem_df):
     # then drop the row. we will determine this by checking if the facility reported
     # any visits more than 30 days after the nad. if they did, then we'll say the outcome
     # is iit, but if they didn't, then we'll say it's unresolved and drop the row.
-    # first, split the dataframe into two dataframes - one for the most recent visit and one for all other visits
-    most_recent_visit = target_df[target_df["num_visit"] == 0]
-    other_visits = target_df[target_df["num_visit"] > 0]
-
-    # get the max visitdate for each sitecode
-    max_visitdate = target_df.groupby("sitecode")["visitdate"].max().reset_index()
-
-    # merge most_recent_visit with max_visitdate on sitecode
-    most_recent_visit = most_recent_visit.merge(
-        max_visitdate, on="sitecode", how="left", suffixes=("", "_max")
-    )
-
-    # for each row, create a variable called outcome
-    # if the nad + 30 days is greater than the max visitdate, then set outcome to
-    # unresolved, else set it to iit
-    most_recent_visit["outcome"] = np.where(
-        (most_recent_visit["nad"] + pd.Timedelta(days=30))
-        > most_recent_visit["visitdate_max"],
-        "unresolved",
-        "iit",
+    # get the max visitdate for each sitecode from the site activity index,
+    # capped at the end of the data window. a site was open at least until
+    # the patient's own most recent visit, which also covers sites that are
+    # missing from the index
+    if site_activity is None:
+        site_activity = site_activity_index.update_site_activity(
+            None, target_df["sitecode"], target_df["visitdate"]
+        )
+    most_recent_visit = target_df[last]
+    max_visitdate = np.fmax(
+        site_activity_index.latest_visitdates(
+            site_activity, most_recent_visit["sitecode"], end_date
+        ),
+        most_recent_visit["visitdate"].to_numpy(),
     )
 
-    # drop 'unresolved' rows from most_recent_visit
-    most_recent_visit = most_recent_visit[most_recent_visit["outcome"] == "iit"]
-    # set iit to 1
-    most_recent_visit["iit"] = 1
-    # drop the visitdate_max column
-    most_recent_visit = most_recent_visit.drop(columns=["visitdate_max", "outcome"])
+    # if the nad + 30 days is greater than the max visitdate, then the outcome
+    # is unresolved, else it is iit
+    unresolved = (most_recent_visit["nad"] + pd.Timedelta(days=30)) > max_visitdate
 
-    # now, filter most_recent_visit to only include patients who did not die
+    # keep the iit outcomes, only for patients who did not die
     # or have a documented transfer out, since those would not be considered IIT.
     # filter to artoucomedescription of "active", "losstofollowup", "lostinhmis"
-    most_recent_visit = most_recent_visit[
-        most_recent_visit["artoutcomedescription"].isin(
-            ["active", "loss to follow up", "lost in hmis"]
-        )
-    ]
-
-    # now, vertically stack the two dataframes
-    # concatenate the two dataframes
-    target_df = pd.concat([other_visits, most_recent_visit], axis=0, ignore_index=True)
-    # drop the num_visit and actualreturndate columns
-    target_df = target_df.drop(
-        columns=["num_visit", "actualreturndate", "artoutcomedescription", "type"]
+    resolved_iit = ~unresolved & most_recent_visit["artoutcomedescription"].isin(
+        ["active", "loss to follow up", "lost in hmis"]
     )
+    most_recent_rows = position[last][resolved_iit.to_numpy()]
+
+    # stack the other visits, latest first for each key, and then the most
+    # recent visits with iit set to 1
+    latest_first = key_start + key_end - position
+    other_rows = latest_first[~last[latest_first]]
+    target_df = target_df.iloc[np.concatenate([other_rows, most_recent_rows])]
+    target_df = target_df.reset_index(drop=True)
+    target_df.loc[len(other_rows):, "iit"] = 1
+    # drop the artoutcomedescription and type columns
+    target_df = target_df.drop(columns=["artoutcomedescription", "type"])
 
     return target_df
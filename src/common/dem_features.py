@@ -1,8 +1,46 @@
 import pandas as pd
 import numpy as np
-
-
-def prep_demographics(df):
+from . import helpers
+
+# demographic columns joined onto every visit by clean_visits
+DEM_COLUMNS = [
+    "sex",
+    "maritalstatus",
+    "educationlevel",
+    "occupation",
+    "artoutcomedescription",
+    "startartdate",
+    "dob",
+]
+
+# marital status categories, tried in order on the lower case value (see
+# helpers.replace_contains); anything not in MARITAL_STATUSES becomes None
+MARITAL_STATUS_RULES = [
+    ("poly", "polygamous"),
+    ("single", "single"),
+    ("married|cohabit", "married"),
+    ("divorced|separated", "divorced"),
+    ("widowed", "widowed"),
+]
+MARITAL_STATUSES = ["minor", "single", "married", "divorced", "widowed", "polygamous"]
+OCCUPATIONS = ["farmer", "trader", "student", "driver", "employee", "none", "other"]
+EDUCATION_LEVELS = ["none", "primary", "secondary", "college"]
+
+
+def prep_demographics(df, dem_cleaned=False):
+    """
+    Add the date-derived features and clean the demographic attributes of
+    the visits.
+
+    Args:
+        df (pd.DataFrame): Visits with their demographics.
+        dem_cleaned (bool): True if the demographics were already cleaned per
+            patient by clean_dem_attributes (as clean_visits does), so only
+            the visit-dependent under-15 marital status is left to set.
+
+    Returns:
+        pd.DataFrame: The visits with demographic features.
+    """
 
     # if the dataframe is empty, return an empty dataframe
     if df.empty:
@@ -33,9 +71,41 @@ def prep_demographics(df):
     # create a flag called firstvisit if the visitdate is the earliest visitdate for that key
     df = create_firstvisit_flag(df)
     # clean marital status, occupation and education level
-    df = clean_marital_status(df)
-    df = clean_occupation(df)
-    df = clean_education_level(df)
+    if dem_cleaned:
+        # only the under-15 override depends on the visit
+        df = set_minor_marital_status(df)
+    else:
+        df = clean_marital_status(df)
+        df = clean_occupation(df)
+        df = clean_education_level(df)
+
+    return df
+
+
+def clean_dem_attributes(dem_df):
+    """
+    Clean the demographic attributes once per patient, before clean_visits
+    joins them onto every visit: lower case and strip the strings, then map
+    marital status, occupation and education level to their categories.
+
+    Args:
+        dem_df (pd.DataFrame): Demographics with lower case column names.
+
+    Returns:
+        pd.DataFrame: The demographics with cleaned attributes.
+    """
+    dem_df = helpers.normalize_strings(dem_df, keep_case=(), columns=DEM_COLUMNS)
+    dem_df["maritalstatus"] = dem_df["maritalstatus"].str.lower()
+    dem_df = map_marital_status(dem_df)
+    dem_df = clean_occupation(dem_df)
+    dem_df = clean_education_level(dem_df)
+
+    return dem_df
+
+
+def set_minor_marital_status(df):
+    # patients under 15 are "minor" whatever marital status is recorded
+    df["maritalstatus"] = np.where(df["age"] < 15, "minor", df["maritalstatus"])
 
     return df
 
@@ -51,66 +121,59 @@ def clean_marital_status(df):
     # if maritalstatus contains the string poly, set to "polygamous"
     # if none of these apply, set to None
     df["maritalstatus"] = df["maritalstatus"].str.lower()
-    df["maritalstatus"] = np.where(df["age"] < 15, "minor", df["maritalstatus"])
-    df["maritalstatus"] = np.where(
-        df["maritalstatus"].str.contains("poly"), "polygamous", df["maritalstatus"]
-    )
-    df["maritalstatus"] = np.where(
-        df["maritalstatus"].str.contains("single"), "single", df["maritalstatus"]
-    )
-    df["maritalstatus"] = np.where(
-        df["maritalstatus"].str.contains("married|cohabit"),
-        "married",
-        df["maritalstatus"],
-    )
-    df["maritalstatus"] = np.where(
-        df["maritalstatus"].str.contains("divorced|separated"),
-        "divorced",
-        df["maritalstatus"],
-    )
-    df["maritalstatus"] = np.where(
-        df["maritalstatus"].str.contains("widowed"), "widowed", df["maritalstatus"]
-    )
-    df["maritalstatus"] = np.where(
-        ~df["maritalstatus"].isin(
-            ["minor", "single", "married", "divorced", "widowed", "polygamous"]
-        ),
-        None,
-        df["maritalstatus"],
-    )
+    df = set_minor_marital_status(df)
+    df = map_marital_status(df)
 
     return df
 
 
+def map_marital_status(df):
+
+    # map lower case marital status strings to their categories, as
+    # described in clean_marital_status, once per distinct value
+    df["maritalstatus"] = helpers.map_distinct(df["maritalstatus"], marital_status_rule)
+
+    return df
+
+
+def marital_status_rule(vec):
+    vec = helpers.replace_contains(vec, MARITAL_STATUS_RULES)
+    return np.where(~vec.isin(MARITAL_STATUSES), None, vec)
+
+
 def clean_occupation(df):
+    # map each distinct occupation to its category
+    df["occupation"] = helpers.map_distinct(df["occupation"], occupation_rule)
+
+    return df
+
+
+def occupation_rule(vec):
     # set to lower case
-    df["occupation"] = df["occupation"].str.lower()
+    vec = vec.str.lower()
 
     # replace whitespace-only or empty strings with None
-    df["occupation"] = df["occupation"].replace(r"^\s*$", None, regex=True)
+    vec = vec.replace(r"^\s*$", None, regex=True)
 
-    allowed = ["farmer", "trader", "student", "driver", "employee", "none", "other"]
-    df["occupation"] = df["occupation"].apply(
-        lambda x: x if x in allowed else (None if x == "null" or x is None else "other")
+    return vec.apply(
+        lambda x: x if x in OCCUPATIONS else (None if x == "null" or x is None else "other")
     )
 
-    return df
-
 
 def clean_education_level(df):
 
     # clean up the education level as follows
     # set to lower case. if education level is none, primary, secondary, or college, keep as is, otherwise None
-    df["educationlevel"] = df["educationlevel"].str.lower()
-    df["educationlevel"] = np.where(
-        df["educationlevel"].isin(["none", "primary", "secondary", "college"]),
-        df["educationlevel"],
-        None,
-    )
+    df["educationlevel"] = helpers.map_distinct(df["educationlevel"], education_level_rule)
 
     return df
 
 
+def education_level_rule(vec):
+    vec = vec.str.lower()
+    return np.where(vec.isin(EDUCATION_LEVELS), vec, None)
+
+
 def parse_nad_imputed(df):
     # Extract the month and day of the week from the 'nad_imputed' column
     df["month"] = df["nad_imputed"].dt.month
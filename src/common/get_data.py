@@ -6,6 +6,8 @@ import tempfile
 import json
 import mysql.connector
 from mysql.connector import Error
+from src.common import helpers
+from src.common import clean_data
 
 def load_settings(path='data/settings.json'):
     try:
@@ -96,15 +98,16 @@ def get_training_data_sqlite(aws=False):
                 tmp_file.seek(0)
                 result = pyreadr.read_r(tmp_file.name)
 
-                # Extract the DataFrame from the result
+                # Extract the DataFrame from the result, keeping only the columns
+                # the cleaning stages read (pyreadr cannot select columns on read)
                 if file_key == "pharmacy_all_feb2025.rds":
-                    pharmacy = result[None]
+                    pharmacy = helpers.select_columns(result[None], clean_data.PHARMACY_COLUMNS)
                 elif file_key == "labs_all_feb2025.rds":
-                    lab = result[None]
+                    lab = helpers.select_columns(result[None], clean_data.LAB_COLUMNS)
                 elif file_key == "visits_all_feb2025.rds":
-                    visits = result[None]
+                    visits = helpers.select_columns(result[None], clean_data.VISIT_COLUMNS)
                 elif file_key == "dem_all_may2025.rds":
-                    dem = result[None]
+                    dem = helpers.select_columns(result[None], clean_data.DEM_COLUMNS)
 
         # Check that all variables are loaded
         if any(x is None for x in [lab, pharmacy, visits, dem]):
@@ -122,7 +125,7 @@ def get_training_data_sqlite(aws=False):
         cursor = connection.cursor()
 
         # Define the SQL query to fetch data from the 'lab' table
-        query = "SELECT * FROM lab"
+        query = helpers.select_query(cursor, "lab", clean_data.LAB_COLUMNS)
 
         # Execute the query with parameters
         cursor.execute(query)
@@ -134,7 +137,7 @@ def get_training_data_sqlite(aws=False):
         lab = pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
 
         # Define the SQL query to fetch data from the 'pharmacy' table
-        query = "SELECT * FROM pharmacy"
+        query = helpers.select_query(cursor, "pharmacy", clean_data.PHARMACY_COLUMNS)
 
         # Execute the query with parameters
         cursor.execute(query)
@@ -148,7 +151,7 @@ def get_training_data_sqlite(aws=False):
         )
 
         # Define the SQL query to fetch data from the 'visits' table
-        query = "SELECT * FROM visits"
+        query = helpers.select_query(cursor, "visits", clean_data.VISIT_COLUMNS)
 
         # Execute the query with parameters
         cursor.execute(query)
@@ -162,7 +165,7 @@ def get_training_data_sqlite(aws=False):
         )
 
         # Define the SQL query to fetch data from the 'dem' table
-        query = "SELECT * FROM dem"
+        query = helpers.select_query(cursor, "dem", clean_data.DEM_COLUMNS)
 
         # Execute the query with parameters
         cursor.execute(query)
@@ -203,7 +206,7 @@ def get_inference_data_sqlite(patientPK=None, sitecode=None):
     # Create a cursor object to interact with the database
     cursor = connection.cursor()
     # Define the SQL query to fetch data from the 'lab' table
-    query = "SELECT * FROM lab WHERE PatientPKHash = ? AND SiteCode = ?"
+    query = helpers.select_query(cursor, "lab", clean_data.LAB_COLUMNS) + " WHERE PatientPKHash = ? AND SiteCode = ?"
     # Execute the query with parameters
     cursor.execute(query, (patientPK, sitecode))
     # Fetch all rows from the executed query
@@ -217,7 +220,7 @@ def get_inference_data_sqlite(patientPK=None, sitecode=None):
         lab = pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
 
     # Define the SQL query to fetch data from the 'pharmacy' table
-    query = "SELECT * FROM pharmacy WHERE PatientPKHash = ? AND SiteCode = ?"
+    query = helpers.select_query(cursor, "pharmacy", clean_data.PHARMACY_COLUMNS) + " WHERE PatientPKHash = ? AND SiteCode = ?"
     # Execute the query with parameters
     cursor.execute(query, (patientPK, sitecode))
     # Fetch all rows from the executed query
@@ -232,7 +235,7 @@ def get_inference_data_sqlite(patientPK=None, sitecode=None):
         )
 
     # Define the SQL query to fetch data from the 'visits' table
-    query = "SELECT * FROM visits WHERE PatientPKHash = ? AND SiteCode = ?"
+    query = helpers.select_query(cursor, "visits", clean_data.VISIT_COLUMNS) + " WHERE PatientPKHash = ? AND SiteCode = ?"
     # Execute the query with parameters
     cursor.execute(query, (patientPK, sitecode))
     # Fetch all rows from the executed query
@@ -248,7 +251,7 @@ def get_inference_data_sqlite(patientPK=None, sitecode=None):
 
     # Define the SQL query to fetch data from the 'dem' table
     # Execute the query with parameters
-    query = "SELECT * FROM dem WHERE PatientPKHash = ? AND MFLCode = ?"
+    query = helpers.select_query(cursor, "dem", clean_data.DEM_COLUMNS) + " WHERE PatientPKHash = ? AND MFLCode = ?"
     cursor.execute(query, (patientPK, sitecode))
     # Fetch all rows from the executed query
     rows = cursor.fetchall()
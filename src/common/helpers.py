@@ -21,6 +21,261 @@ def parse_long_date(date_col):
         return None
 
 
+def parse_long_dates(date_col):
+    """
+    Vectorized parse_long_date for a whole column: the first 10 characters of
+    each value are read as yyyy-mm-dd, and values that do not parse become NaT.
+
+    Args:
+        date_col (pd.Series): The column to parse.
+
+    Returns:
+        pd.Series: A datetime64 column of dates (no time of day).
+    """
+    if pd.api.types.is_datetime64_any_dtype(date_col):
+        # already datetimes; truncating to 10 characters drops the time of day
+        if date_col.dt.tz is not None:
+            date_col = date_col.dt.tz_localize(None)
+        return date_col.dt.normalize()
+    return pd.to_datetime(
+        date_col.astype(str).str[:10], format="%Y-%m-%d", errors="coerce"
+    )
+
+
+def select_columns(df, columns):
+    """
+    Keep only the listed columns that df has, in df's order, so columns no
+    stage reads are not carried through merges, sorts and dedups.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to project.
+        columns (list): Lower-case names of the columns to keep; df's column
+            names are matched case-insensitively.
+
+    Returns:
+        pd.DataFrame: The projected DataFrame.
+    """
+    keep = set(columns)
+    return df[[col for col in df.columns if col.lower() in keep]]
+
+
+def select_query(cursor, table, columns):
+    """
+    Build a SQLite SELECT for the listed columns (matched case-insensitively)
+    that the table actually has, so unused columns are never read.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor on the database holding table.
+        table (str): The table to select from.
+        columns (list): Lower-case column names to keep.
+
+    Returns:
+        str: "SELECT <columns> FROM <table>", with the table's own column case.
+    """
+    keep = set(columns)
+    cursor.execute(f"PRAGMA table_info({table})")
+    names = [row[1] for row in cursor.fetchall() if row[1].lower() in keep]
+    return f"SELECT {', '.join(names) or '*'} FROM {table}"
+
+
+def normalize_strings(df, keep_case=("key",), columns=None):
+    """
+    Lower case and strip whitespace from every string value in a DataFrame,
+    leaving non-string values (numbers, dates, None, NaN) untouched. Each
+    column's distinct values are normalized once and mapped back with
+    pd.factorize, so the Python-level work scales with the number of distinct
+    values rather than the number of cells.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to normalize.
+        keep_case (tuple): Columns that are only stripped, not lower cased.
+        columns (list): Columns to normalize (default: all).
+
+    Returns:
+        pd.DataFrame: The normalized DataFrame.
+    """
+    for col in df.columns if columns is None else columns:
+        if df[col].dtype != object:
+            continue
+        codes, uniques = pd.factorize(df[col])
+        uniques = np.asarray(uniques, dtype=object)
+        # only classes whose value is a string are rewritten; a string never
+        # shares a factorize class with a number, so those keep their values
+        is_str = np.array([isinstance(x, str) for x in uniques], dtype=bool)
+        if not is_str.any():
+            # object columns holding only numbers become numeric, as applymap did
+            df[col] = df[col].infer_objects()
+            continue
+        if col in keep_case:
+            normalized = [x.strip() if s else x for x, s in zip(uniques, is_str)]
+        else:
+            normalized = [x.lower().strip() if s else x for x, s in zip(uniques, is_str)]
+        normalized = np.array(normalized, dtype=object)
+        values = df[col].to_numpy(dtype=object, copy=True)
+        mask = codes >= 0
+        mask[mask] = is_str[codes[mask]]
+        values[mask] = normalized[codes[mask]]
+        df[col] = values
+    return df
+
+
+def map_distinct(values, rule):
+    """
+    Apply a cleaning rule to each distinct value of a low-cardinality column
+    once and broadcast the results back to every row. The rule is called on
+    the distinct values plus one None and one NaN, so missing values are
+    mapped exactly as the rule maps them, and None and NaN stay apart.
+
+    Args:
+        values (pd.Series): The column to map.
+        rule (callable): Takes a Series of values and returns an array-like
+            of results of the same length.
+
+    Returns:
+        np.ndarray: The rule's result for every row of values.
+    """
+    codes, uniques = pd.factorize(values)
+    n = len(uniques)
+    distinct = pd.Series(list(uniques) + [None, np.nan], dtype=object)
+    mapped = np.asarray(rule(distinct))
+    # missing rows take the result for None, or for NaN (any other missing value)
+    missing = codes < 0
+    if missing.any():
+        raw = values.to_numpy(dtype=object)[missing]
+        codes[missing] = np.where(np.equal(raw, None), n, n + 1)
+    return mapped[codes]
+
+
+def replace_contains(vec, rules):
+    """
+    Replace the values of a string Series that contain a rule's pattern with
+    the rule's category. Rules are (pattern, category) pairs applied in order,
+    each to the result of the one before.
+
+    Args:
+        vec (pd.Series): The values to categorise.
+        rules (list): (regex pattern, category) pairs.
+
+    Returns:
+        pd.Series: The categorised values.
+    """
+    for pattern, category in rules:
+        vec = pd.Series(np.where(vec.str.contains(pattern), category, vec), index=vec.index)
+    return vec
+
+
+def grouped_rolling_sums(keys, columns, windows):
+    """
+    Rolling sums over the last w rows of each key, for several columns and
+    window sizes in one pass: the same as
+    groupby(keys)[col].transform(lambda x: x.rolling(w, min_periods=1).sum())
+    for every column and w, without a Python call per key. Windows are read
+    off prefix sums that restart at each key's first row.
+
+    The prefix sums are float64, so they are exact for whole numbers such as
+    day counts and 0/1 flags.
+
+    Args:
+        keys (array-like): The group of each row; rows are in window order
+            within each group.
+        columns (dict): Column name -> numeric values (NaN is skipped).
+        windows (list): Window sizes, in rows.
+
+    Returns:
+        dict: (column name, window) -> (sums, counts), where counts is the
+        number of non-missing values in the window and sums is NaN when
+        there are none.
+    """
+    codes = pd.factorize(keys)[0]
+    n = len(codes)
+    # stable sort by group, so each group's rows are contiguous and in order
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    row = np.arange(n)
+    first = np.ones(n, dtype=bool)
+    first[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    group_start = np.maximum.accumulate(np.where(first, row, 0))
+    # rows without a key get no window, as groupby drops them
+    no_key = sorted_codes < 0
+
+    results = {}
+    for name, values in columns.items():
+        values = np.asarray(values, dtype=float)[order]
+        present = ~np.isnan(values) & ~no_key
+        prefix_sum = np.concatenate([[0.0], np.cumsum(np.where(present, values, 0.0))])
+        prefix_count = np.concatenate([[0], np.cumsum(present)])
+        for window in windows:
+            low = np.maximum(row + 1 - window, group_start)
+            sums = prefix_sum[row + 1] - prefix_sum[low]
+            counts = prefix_count[row + 1] - prefix_count[low]
+            sums[counts == 0] = np.nan
+            out_sums, out_counts = np.empty(n), np.empty(n, dtype=np.int64)
+            out_sums[order], out_counts[order] = sums, counts
+            results[(name, window)] = (out_sums, out_counts)
+    return results
+
+
+def as_datetime(values):
+    """
+    Parse a column to datetimes, coercing invalid values to NaT, unless it
+    already holds datetimes.
+
+    Args:
+        values (pd.Series): The column to parse.
+
+    Returns:
+        pd.Series: The column as datetimes.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, errors="coerce")
+
+
+def first_per_group(df, by):
+    """
+    First non-missing value of every column for each run of rows with the
+    same values of the by columns: the same as df.groupby(by).first().reset_index()
+    for a df sorted by the by columns with no missing values in them, read
+    off the row positions instead of grouping every column.
+
+    Args:
+        df (pd.DataFrame): Rows sorted by the by columns.
+        by (list): The grouping columns.
+
+    Returns:
+        pd.DataFrame: One row per group, with the by columns first.
+    """
+    n = len(df)
+    new_group = np.zeros(n, dtype=bool)
+    new_group[:1] = True
+    for col in by:
+        values = df[col].to_numpy()
+        new_group[1:] |= values[1:] != values[:-1]
+    starts = np.flatnonzero(new_group)
+    ends = np.append(starts[1:], n)
+
+    result = {col: df[col].iloc[starts].reset_index(drop=True) for col in by}
+    for col in df.columns:
+        if col in by:
+            continue
+        values = df[col].iloc[starts].reset_index(drop=True)
+        missing = values.isna().to_numpy()
+        if missing.any():
+            # for groups whose first row has no value, look for the first
+            # later row with a value that is still in the group
+            valid = np.flatnonzero(df[col].notna().to_numpy())
+            pick = np.searchsorted(valid, starts[missing])
+            found = pick < len(valid)
+            found[found] = valid[pick[found]] < ends[missing][found]
+            rows = np.flatnonzero(missing)[found]
+            values.iloc[rows] = df[col].iloc[valid[pick[found]]].to_numpy()
+            if values.dtype == object:
+                # a group without values gets None, as groupby().first() gives
+                values[values.isna()] = None
+        result[col] = values
+    return pd.DataFrame(result)
+
+
 def remove_date(df, contact_var, return_var):
     """
     Remove the date from a contact variable.
@@ -34,18 +289,13 @@ def remove_date(df, contact_var, return_var):
         pd.DataFrame: The cleaned contact variable without the date.
     """
     # make sure contact_var and return_var are date types
-    df[contact_var] = pd.to_datetime(df[contact_var], errors="coerce")
-    df[return_var] = pd.to_datetime(df[return_var], errors="coerce")
-
-    # create a new column that is the number of days between the contact date and the return date
-    df["days_between"] = (df[return_var] - df[contact_var]).dt.days
+    df[contact_var] = as_datetime(df[contact_var])
+    df[return_var] = as_datetime(df[return_var])
 
-    # if the number of days is less than 0 or more than 365, set the return var to None
-    df.loc[df["days_between"] <= 0, return_var] = None
-    df.loc[df["days_between"] > 365, return_var] = None
-
-    # drop the days_between column
-    df.drop(columns=["days_between"], inplace=True)
+    # if the number of days between the contact date and the return date
+    # is less than 0 or more than 365, set the return var to None
+    days_between = (df[return_var] - df[contact_var]).dt.days
+    df[return_var] = df[return_var].mask((days_between <= 0) | (days_between > 365))
 
     # return the dataframe
     return df
@@ -76,6 +326,13 @@ def dedup_common(df, key_var, contact_var, return_var):
     return df
 
 
+# lower bounds (in days between contact and return date) of the intervals
+# impute_date buckets into, and the days each interval stands for; the
+# first and last groups are below 45 days and 200 days or more
+DAYS_BETWEEN_BOUNDS = [45, 75, 105, 150, 200]
+DAYS_BETWEEN_GROUPS = [30, 60, 90, 120, 180, 30]
+
+
 def impute_date(df, key_var, contact_var, return_var):
     """
     Impute missing dates in the contact variable based on the gap
@@ -91,135 +348,117 @@ def impute_date(df, key_var, contact_var, return_var):
         pd.DataFrame: The DataFrame with imputed dates.
     """
     # Convert contact_var and return_var to datetime
-    df[contact_var] = pd.to_datetime(df[contact_var], errors="coerce")
-    df[return_var] = pd.to_datetime(df[return_var], errors="coerce")
-
-    # Get the number of days between the contact and return date
-    df["days_between"] = (df[return_var] - df[contact_var]).dt.days
-
-    # Create a days_between_group variable using the following logic:
-    # If days_between is less than 45, then set it to 30
-    # If days_between is greater than 45 and less than 75, then set it to 60
-    # If days_between is greater than 75 and less than 105, then set it to 90
-    # If days_between is greater than 105 and less than 150, then set it to 120
-    # If days_between is greater than 150 and less than 200, then set it to 180
-    # Else, set it to 30
-    df["days_between_group"] = np.select(
-        [
-            df["days_between"] < 45,
-            (df["days_between"] >= 45) & (df["days_between"] < 75),
-            (df["days_between"] >= 75) & (df["days_between"] < 105),
-            (df["days_between"] >= 105) & (df["days_between"] < 150),
-            (df["days_between"] >= 150) & (df["days_between"] < 200),
-        ],
-        [30, 60, 90, 120, 180],
-        default=30,
-    )
+    df[contact_var] = as_datetime(df[contact_var])
+    df[return_var] = as_datetime(df[return_var])
 
     # Sort by key_var and contact_var to ensure proper ordering
     df = df.sort_values(by=[key_var, contact_var], ascending=[True, False])
 
-    # Group by key_var and apply the imputation logic
-    # Use shift to get previous row's days_between_group per patient
-    df["prev_days_between_group"] = (
-        df.groupby(key_var)["days_between_group"].shift(1).fillna(30)
-    )
-
-    # Impute nad (next appointment date)
-    df["nad_imputed"] = df[return_var]
-
-    missing_mask = df["nad_imputed"].isna()
-    df.loc[missing_mask, "nad_imputed"] = (
-        df.loc[missing_mask, contact_var] +
-        pd.to_timedelta(df.loc[missing_mask, "prev_days_between_group"], unit="D")
-    )
-
-    # Final fallback: if any still missing, default to 30-day interval
-    fallback_mask = df["nad_imputed"].isna()
-    df.loc[fallback_mask, "nad_imputed"] = (
-        df.loc[fallback_mask, contact_var] + pd.Timedelta(days=30)
-    )
-
-    # set a nad_imputation_flag variable to 1 if nad_imputed is not equal to nad, else 0
-    df["nad_imputation_flag"] = np.where(df["nad_imputed"] != df[return_var], 1, 0)
+    # Get the number of days between the contact and return date, and bucket it:
+    # less than 45 -> 30, 45 to 75 -> 60, 75 to 105 -> 90, 105 to 150 -> 120,
+    # 150 to 200 -> 180, and 200 or more (or no return date) -> 30
+    days_between = (df[return_var] - df[contact_var]).dt.days.to_numpy()
+    days_between_group = np.array(DAYS_BETWEEN_GROUPS)[
+        np.digitize(days_between, DAYS_BETWEEN_BOUNDS)
+    ]
 
-    # drop the days_between and days_between_group columns
-    df.drop(columns=["days_between", "days_between_group"], inplace=True)
+    # the previous row's days_between_group of the same patient, 30 for
+    # each patient's first row (and rows without a key)
+    codes = pd.factorize(df[key_var])[0]
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    prev_days_between_group = np.full(len(codes), 30)
+    prev_days_between_group[1:] = days_between_group[:-1]
+    prev_days_between_group[first | (codes < 0)] = 30
+    df["prev_days_between_group"] = prev_days_between_group.astype(float)
+
+    # Impute nad (next appointment date) from the previous interval where it
+    # is missing; a missing contact date leaves it missing
+    nad_imputed = df[return_var].to_numpy(copy=True)
+    missing = pd.isna(nad_imputed)
+    nad_imputed[missing] = df[contact_var].to_numpy()[missing] + prev_days_between_group[
+        missing
+    ].astype("timedelta64[D]")
+    df["nad_imputed"] = nad_imputed
+
+    # set a nad_imputation_flag variable to 1 if nad_imputed is not equal to
+    # nad, i.e. wherever nad was missing, else 0
+    df["nad_imputation_flag"] = missing.astype(np.int64)
 
-    # return the dataframe`
+    # return the dataframe
     return df
 
 
 def dedup_lab(df, key_var, contact_var, labname_var, labresult_var):
-    # Group by key variables and count labs
-    df["lab_count"] = df.groupby([key_var, contact_var, labname_var])[
-        labname_var
-    ].transform("count")
-
-    # Create is_multi variable
-    df["is_multi"] = np.where(df["lab_count"] > 1, 1, 0)
-
-    # Clean and parse lab results
-    df["testresultraw"] = df[labresult_var]
-    df["testresultclean"] = (
-        df["testresultraw"].astype(str).str.replace(".", "", regex=False).str.lower()
-    )
-    df["testresultnum"] = pd.to_numeric(df["testresultraw"], errors="coerce")
-
-    # Create testresultcat
-    def classify(row):
-        if row[labname_var] == "VL":
-            if pd.isna(row["testresultnum"]) or row["testresultnum"] < 200:
-                return "suppressed"
-            elif row["testresultnum"] >= 200:
-                return "nonsuppressed"
-        # for CD4, if the testresultnum is NaN, return None because
-        # it's never a string that can be converted to a number
-        # and we don't want to keep it
-        elif pd.isna(row["testresultnum"]):
-            return None
-        # if the testresultnum is not NaN, we can classify it
-        elif row[labname_var] == "CD4":
-            if row["testresultnum"] < 200:
-                return "NoAHD"
-            elif row["testresultnum"] >= 200:
-                return "YesAHD"
-        return None
-
-    df["testresultcat"] = df.apply(classify, axis=1)
-
-    # Drop rows from CD4 that could not be classified
-    df = df[~((df[labname_var] == "CD4") & (df["testresultnum"].isna()))]
+    """
+    Classify VL and CD4 results and collapse repeated labs of a patient,
+    contact date and lab name. Single labs are kept; of repeated labs, the
+    only numeric result is kept if there is exactly one, and every lab is
+    kept if there are several numeric results that agree on the category.
 
-    # Split into single and multi
-    df_single = df[df["is_multi"] == 0]
-    df_multi = df[df["is_multi"] == 1]
+    Args:
+        df (pd.DataFrame): Lab records.
+        key_var (str): The name of the patient key variable.
+        contact_var (str): The name of the contact date variable.
+        labname_var (str): The name of the lab name ("VL" or "CD4") variable.
+        labresult_var (str): The name of the raw lab result variable.
 
-    # Clean multi where only one non-NA numeric result
-    df_multi_grouped = df_multi.copy()
-    df_multi_grouped["num_result_count"] = df_multi_grouped.groupby(
-        [key_var, contact_var, labname_var]
-    )["testresultnum"].transform(lambda x: x.notna().sum())
-    df_multi_clean = df_multi_grouped[
-        (df_multi_grouped["num_result_count"] == 1)
-        & (df_multi_grouped["testresultnum"].notna())
-    ]
+    Returns:
+        pd.DataFrame: key_var, contact_var, labname_var and testresultcat of
+        the single labs, then the one-result repeats, then the agreeing repeats.
+    """
+    # Parse lab results
+    testresultnum = pd.to_numeric(df[labresult_var], errors="coerce")
+    is_vl = (df[labname_var] == "VL").to_numpy()
+    is_cd4 = (df[labname_var] == "CD4").to_numpy()
+    has_num = testresultnum.notna().to_numpy()
+    below_200 = (testresultnum < 200).to_numpy()
+
+    # Create testresultcat. a VL result that is not a number counts as
+    # suppressed; a CD4 result that is not a number is never classified
+    testresultcat = np.select(
+        [
+            is_vl & (~has_num | below_200),
+            is_vl,
+            is_cd4 & has_num & below_200,
+            is_cd4 & has_num,
+        ],
+        ["suppressed", "nonsuppressed", "NoAHD", "YesAHD"],
+        default=None,
+    )
 
-    df_cleaned = pd.concat([df_single, df_multi_clean], ignore_index=True)
-
-    # Multi where all results agree
-    df_multi_grouped["num_result_count"] = df_multi_grouped.groupby(
-        [key_var, contact_var, labname_var]
-    )["testresultnum"].transform(lambda x: x.notna().sum())
-    df_multi_grouped["num_cats"] = df_multi_grouped.groupby(
-        [key_var, contact_var, labname_var]
-    )["testresultcat"].transform(lambda x: x.nunique())
-    df_multi_agree = df_multi_grouped[
-        (df_multi_grouped["num_result_count"] > 1) & (df_multi_grouped["num_cats"] == 1)
-    ]
-    print(len(df_multi_agree))
+    # Count labs, numeric results and distinct result categories of each
+    # key, contact date and lab name in one aggregation
+    group = df.groupby([key_var, contact_var, labname_var], sort=False).ngroup()
+    counts = (
+        pd.DataFrame({"testresultnum": testresultnum, "testresultcat": testresultcat})
+        .groupby(group)
+        .agg(
+            lab_count=("testresultnum", "size"),
+            num_result_count=("testresultnum", "count"),
+            num_cats=("testresultcat", "nunique"),
+        )
+        .reindex(group)
+    )
+    # records missing any of the three are never repeats
+    is_multi = (counts["lab_count"] > 1).to_numpy()
+    num_result_count = counts["num_result_count"].to_numpy()
+
+    # Drop rows from CD4 that could not be classified, then keep single labs,
+    # repeats with only one non-NA numeric result, and repeats where all
+    # results agree
+    keep = ~(is_cd4 & ~has_num)
+    single = keep & ~is_multi
+    multi_clean = keep & is_multi & (num_result_count == 1) & has_num
+    multi_agree = (
+        keep & is_multi & (num_result_count > 1) & (counts["num_cats"] == 1).to_numpy()
+    )
 
-    # Combine all cleaned
-    df_final = pd.concat([df_cleaned, df_multi_agree], ignore_index=True)
+    # Combine all cleaned, singles first
+    part = np.select([single, multi_clean, multi_agree], [0, 1, 2], default=3)
+    rows = np.flatnonzero(part < 3)
+    rows = rows[np.argsort(part[rows], kind="stable")]
+    df_final = df[[key_var, contact_var, labname_var]].iloc[rows]
+    df_final = df_final.assign(testresultcat=testresultcat[rows])
 
-    return df_final[[key_var, contact_var, labname_var, "testresultcat"]]
+    return df_final.reset_index(drop=True)
@@ -0,0 +1,87 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets; retraining stages
+# on the national tables take minutes, single-patient inference stages milliseconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900]
+
+STAGE_METRIC = "iit_stage_duration_seconds"
+
+# (pipeline, stage) -> [bucket counts..., +Inf count, sum]
+_histograms = {}
+_lock = threading.Lock()
+
+
+def observe(stage, seconds, pipeline="inference"):
+    """
+    Record how long one run of a pipeline stage took.
+
+    Args:
+        stage (str): Stage name, e.g. "clean_visits".
+        seconds (float): Duration of the run.
+        pipeline (str): "inference" or "retrain".
+    """
+    with _lock:
+        hist = _histograms.get((pipeline, stage))
+        if hist is None:
+            hist = _histograms[(pipeline, stage)] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+        hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+
+
+@contextmanager
+def stage_timer(stage, pipeline="inference"):
+    """Time the enclosed block and record it under stage, even if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, pipeline)
+
+
+def stage_totals(pipeline):
+    """
+    Total seconds spent in each stage of a pipeline so far.
+
+    Returns:
+        dict: stage -> seconds, in the order the stages first ran.
+    """
+    with _lock:
+        return {
+            stage: hist[-1]
+            for (name, stage), hist in _histograms.items()
+            if name == pipeline
+        }
+
+
+def render():
+    """
+    Render the stage histograms in the Prometheus text exposition format.
+
+    Returns:
+        str: The /metrics response body.
+    """
+    lines = [
+        f"# HELP {STAGE_METRIC} Time spent in each pipeline stage.",
+        f"# TYPE {STAGE_METRIC} histogram",
+    ]
+    with _lock:
+        items = sorted(_histograms.items())
+        for (pipeline, stage), hist in items:
+            labels = f'pipeline="{pipeline}",stage="{stage}"'
+            for bound, count in zip(BUCKETS, hist):
+                lines.append(f'{STAGE_METRIC}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{STAGE_METRIC}_bucket{{{labels},le="+Inf"}} {hist[len(BUCKETS)]}')
+            lines.append(f"{STAGE_METRIC}_sum{{{labels}}} {hist[-1]}")
+            lines.append(f"{STAGE_METRIC}_count{{{labels}}} {hist[len(BUCKETS)]}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Forget every recorded duration."""
+    with _lock:
+        _histograms.clear()
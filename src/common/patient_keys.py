@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+# integer dtype of the interned key column
+KEY_DTYPE = np.int32
+
+
+def _key_columns(df):
+    # raw tables name their columns in any case, and dem has mflcode
+    # instead of sitecode in some sources
+    cols = {col.lower(): col for col in df.columns}
+    return cols["patientpkhash"], cols.get("sitecode", cols.get("mflcode"))
+
+
+def _site_strings(site):
+    # str() each distinct sitecode once instead of every row
+    codes, uniques = pd.factorize(site, use_na_sentinel=False)
+    return np.array([str(x) for x in uniques], dtype=object)[codes]
+
+
+def build_key_table(*frames):
+    """
+    Build the key dictionary for a set of raw tables: one row per distinct
+    (patientpkhash, sitecode) pair with the integer id every stage joins,
+    sorts and groups on. Ids follow the order of the patientpkhash + sitecode
+    strings, so sorting by id orders patients as sorting by the string did.
+
+    Args:
+        *frames (pd.DataFrame): Raw lab, pharmacy, visits and dem tables.
+            None or empty tables are skipped.
+
+    Returns:
+        pd.DataFrame: key, patientpkhash and sitecode (as a string).
+    """
+    pairs = []
+    for df in frames:
+        if df is None or df.empty:
+            continue
+        hash_col, site_col = _key_columns(df)
+        pair = df[[hash_col, site_col]].drop_duplicates()
+        pairs.append(
+            pd.DataFrame(
+                {
+                    "patientpkhash": pair[hash_col].to_numpy(),
+                    "sitecode": _site_strings(pair[site_col]),
+                }
+            )
+        )
+    if not pairs:
+        return pd.DataFrame(
+            {
+                "key": pd.Series(dtype=KEY_DTYPE),
+                "patientpkhash": pd.Series(dtype=object),
+                "sitecode": pd.Series(dtype=object),
+            }
+        )
+    table = pd.concat(pairs, ignore_index=True).drop_duplicates()
+    # records without a patientpkhash cannot be linked to a patient
+    table = table[table["patientpkhash"].notna()].reset_index(drop=True)
+    codes, _ = pd.factorize(table["patientpkhash"] + table["sitecode"], sort=True)
+    table.insert(0, "key", codes.astype(KEY_DTYPE))
+    return table
+
+
+def assign_keys(df, key_table):
+    """
+    Add the interned integer key to a raw table, dropping rows whose
+    patient is not in key_table.
+
+    Args:
+        df (pd.DataFrame): Raw lab, pharmacy, visits or dem table.
+        key_table (pd.DataFrame): Output of build_key_table.
+
+    Returns:
+        pd.DataFrame: df with an integer "key" column.
+    """
+    if df is None or df.empty:
+        return df
+    hash_col, site_col = _key_columns(df)
+    lookup = pd.MultiIndex.from_arrays([key_table["patientpkhash"], key_table["sitecode"]])
+    position = lookup.get_indexer(
+        pd.MultiIndex.from_arrays([df[hash_col], _site_strings(df[site_col])])
+    )
+    df = df[position >= 0].copy()
+    df["key"] = key_table["key"].to_numpy()[position[position >= 0]]
+    return df
+
+
+def intern_keys(lab, pharmacy, visits, dem):
+    """
+    Key every raw table with integer ids from one shared key dictionary, so
+    the cleaning, target and feature stages never build, compare or hash the
+    64-character key strings. The patientpkhash and sitecode behind each id
+    stay in the returned key table for output.
+
+    Returns:
+        tuple: (lab, pharmacy, visits, dem, key_table)
+    """
+    key_table = build_key_table(lab, pharmacy, visits, dem)
+    lab, pharmacy, visits, dem = (
+        assign_keys(df, key_table) for df in (lab, pharmacy, visits, dem)
+    )
+    return lab, pharmacy, visits, dem, key_table
+
+
+def decode_keys(keys, key_table):
+    """
+    Map integer keys back to the patientpkhash + sitecode strings used in
+    API results and output files.
+
+    Args:
+        keys (array-like): Integer keys.
+        key_table (pd.DataFrame): Output of build_key_table.
+
+    Returns:
+        np.ndarray: The key strings.
+    """
+    strings = key_table.drop_duplicates("key").set_index("key")
+    strings = strings["patientpkhash"] + strings["sitecode"]
+    return strings.reindex(np.asarray(keys)).to_numpy()
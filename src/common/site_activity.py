@@ -0,0 +1,149 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from . import helpers
+
+SITE_ACTIVITY_FILE = "data/site_activity_latest.csv"
+
+# parsed indexes by path, with the file mtime they were read at (None if
+# the file did not exist)
+_tables = {}
+_lock = threading.Lock()
+
+
+def empty_site_activity():
+    """An index with no sites."""
+    return pd.Series(
+        index=pd.Index([], dtype=object, name="sitecode"),
+        dtype="datetime64[ns]",
+        name="visitdate",
+    )
+
+
+def _site_strings(sitecodes):
+    # str() each distinct sitecode once instead of every row, keeping
+    # missing sitecodes missing
+    codes, uniques = pd.factorize(pd.Series(sitecodes))
+    strings = np.array([str(x) for x in uniques] + [None], dtype=object)
+    return strings[codes]
+
+
+def update_site_activity(site_activity, sitecodes, visitdates):
+    """
+    Fold new encounters into the site activity index: the latest visitdate
+    recorded at each sitecode. Encounters that are not later than their
+    site's entry cannot change it, so they are filtered out by looking their
+    site up, and only the rest are grouped.
+
+    Args:
+        site_activity (pd.Series): Latest visitdate indexed by sitecode (as a
+            string), or None to start from an empty index.
+        sitecodes (array-like): Sitecode of each new encounter.
+        visitdates (array-like): Visitdate of each new encounter.
+
+    Returns:
+        pd.Series: The updated index. site_activity itself is returned
+        unchanged if no encounter moves a site forward.
+    """
+    if site_activity is None:
+        site_activity = empty_site_activity()
+    sites = _site_strings(sitecodes)
+    visitdates = helpers.as_datetime(pd.Series(visitdates)).to_numpy()
+    known = site_activity.reindex(sites).to_numpy()
+    newer = ~np.isnat(visitdates) & pd.notna(sites)
+    newer &= np.isnat(known) | (visitdates > known)
+    if not newer.any():
+        return site_activity
+    latest = pd.Series(visitdates[newer]).groupby(sites[newer]).max()
+    site_activity = latest.combine_first(site_activity)
+    site_activity.index.name = "sitecode"
+    site_activity.name = "visitdate"
+    return site_activity
+
+
+def latest_visitdates(site_activity, sitecodes, end_date=None):
+    """
+    Look up the latest visitdate of each sitecode in the index; sites that
+    are not in it get NaT.
+
+    Args:
+        site_activity (pd.Series): Latest visitdate indexed by sitecode.
+        sitecodes (array-like): Sitecodes to look up.
+        end_date (str): If given, visitdates after it are capped at it, so
+            activity past the end of the data being labelled is not seen.
+
+    Returns:
+        np.ndarray: One visitdate per sitecode.
+    """
+    latest = site_activity.reindex(_site_strings(sitecodes)).to_numpy()
+    if end_date is not None:
+        latest = np.minimum(latest, pd.Timestamp(end_date).to_datetime64())
+    return latest
+
+
+def load_site_activity(path=SITE_ACTIVITY_FILE):
+    """
+    Parse the site activity CSV into an index of the latest visitdate by
+    sitecode (as a string). A missing file gives an empty index.
+
+    Args:
+        path (str): Path to the site activity CSV.
+
+    Returns:
+        pd.Series: Latest visitdate indexed by sitecode.
+    """
+    if not os.path.isfile(path):
+        print(f"No site activity index at {path}, starting from an empty one.")
+        return empty_site_activity()
+    activity_df = pd.read_csv(path, dtype={"sitecode": str}, parse_dates=["visitdate"])
+    return update_site_activity(None, activity_df["sitecode"], activity_df["visitdate"])
+
+
+def save_site_activity(site_activity, path=SITE_ACTIVITY_FILE):
+    """
+    Write the site activity index to path, replacing the old file in one
+    step so readers never see it half written.
+    """
+    tmp_file = f"{path}.tmp"
+    site_activity.sort_index().reset_index().to_csv(tmp_file, index=False)
+    os.replace(tmp_file, path)
+
+
+def refresh_site_activity(sitecodes, visitdates, path=SITE_ACTIVITY_FILE):
+    """
+    Index the visits of a training run and fold them into the index saved at
+    path, for inference to look sites up in.
+
+    Args:
+        sitecodes (array-like): Sitecode of each visit.
+        visitdates (array-like): Visitdate of each visit.
+        path (str): Path to the site activity CSV.
+
+    Returns:
+        pd.Series: The index of the run's own visits. Targets are labelled
+        against it rather than the saved index, so they depend only on the
+        run's data, whatever earlier runs saved.
+    """
+    window = update_site_activity(None, sitecodes, visitdates)
+    saved = update_site_activity(load_site_activity(path), window.index, window.to_numpy())
+    save_site_activity(saved, path)
+    return window
+
+
+def get_site_activity(path=SITE_ACTIVITY_FILE):
+    """
+    Return the site activity index for path, re-reading the CSV only when
+    its modification time has changed since it was last parsed. The index is
+    shared between requests and must not be modified.
+    """
+    mtime = os.stat(path).st_mtime_ns if os.path.isfile(path) else None
+    with _lock:
+        cached = _tables.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    table = load_site_activity(path)
+    with _lock:
+        _tables[path] = (mtime, table)
+    return table
+
@@ -1,5 +1,51 @@
 import pandas as pd
+import numpy as np
 import polars as pl
+from . import helpers
+from .metrics import stage_timer
+
+# rolling windows (in visits) of the lateness features, and the number of
+# days late (lastvd) above which a visit counts towards late, late14 and late30
+LATENESS_WINDOWS = [3, 5, 10]
+LATENESS_THRESHOLDS = {"late": 0, "late14": 14, "late30": 30}
+
+# VL and CD4 results older than this many days before a visit are not valid
+LAB_VALIDITY_DAYS = 365
+
+def prep_target_features(targets_df, visits_df, pharmacy_df, lab_df, pipeline="inference", per_patient_labs=False):
+    """
+    Prepares the target visit, pharmacy and lab features in one pass. Gives the
+    same result as prep_target_visit_features, prep_target_pharmacy_features
+    and prep_target_lab_features run in turn, but the rolling joins with
+    visits, pharmacy, VL and CD4 are chained on one polars frame that is
+    converted back to pandas once, rather than once per stage.
+
+    Parameters:
+    - targets_df (pd.DataFrame): The DataFrame containing target data.
+    - visits_df (pd.DataFrame): The DataFrame containing visit data.
+    - pharmacy_df (pd.DataFrame): The DataFrame containing pharmacy data.
+    - lab_df (pd.DataFrame): The DataFrame containing lab data.
+    - pipeline (str): Pipeline the visit, pharmacy and lab stages are timed under.
+    - per_patient_labs (bool): If True, the VL of a key without any lab rows is
+      "novalidvl", as when that patient is scored on their own. If False, it
+      is only "novalidvl" when lab_df is empty altogether, as in
+      prep_target_lab_features.
+
+    Returns:
+    - pd.DataFrame: A DataFrame containing the target visit, pharmacy and lab features.
+    """
+
+    with stage_timer("target_visit_features", pipeline):
+        if visits_df is None or visits_df.empty:
+            # the visit stage fills in default cascade and lateness features
+            frame = _sorted_frame(prep_target_visit_features(targets_df, visits_df))
+        else:
+            frame = _visit_frame(targets_df, visits_df)
+    with stage_timer("target_pharmacy_features", pipeline):
+        frame = _join_pharmacy(frame, pharmacy_df)
+    with stage_timer("target_lab_features", pipeline):
+        targets_df = _join_labs(frame, lab_df).to_pandas()
+        return _lab_categories(targets_df, _without_labs(targets_df, lab_df, per_patient_labs))
 
 
 def prep_target_visit_features(targets_df, visits_df):
@@ -28,138 +74,116 @@ def prep_target_visit_features(targets_df, visits_df):
             targets_df[f"late30_{suffix}"] = 0
         return targets_df
 
+    return _visit_frame(targets_df, visits_df).to_pandas()
+
+
+def _sorted_frame(targets_df):
+    # the rolling joins need the targets in key and visitdate order
+    targets_df = targets_df.assign(
+        visitdate=pd.to_datetime(targets_df["visitdate"], errors="coerce")
+    )
+    return pl.from_pandas(targets_df.sort_values(["key", "visitdate"]))
+
+
+def _visit_frame(targets_df, visits_df):
+    # targets with their cascade status, visit and lateness features, as a
+    # polars frame sorted by key and visitdate
+
     ## Cascade features
     # First, for every instance of IIT, we want to calculate how long until reengagement
     # sort by key and in ascending order of visitdate
-    targets_df = targets_df.sort_values(by=["key", "visitdate"])
-    # Create date_reengaged column.
-    # if iit = 1 at the previous visit, then date_reengaged = visitdate
-    # if iit = 0, then date_reenaged is None
-    targets_df["visitdate"] = pd.to_datetime(targets_df["visitdate"], errors="coerce")
-    targets_df["iit_lag"] = targets_df.groupby("key")["iit"].shift(1)
-    targets_df["date_reengaged"] = targets_df.apply(
-        lambda x: x["visitdate"] if x["iit_lag"] == 1 else None, axis=1
-    )
-    # Fill forward the date_reengaged column
-    targets_df["date_reengaged"] = targets_df.groupby("key")["date_reengaged"].ffill()
-    targets_df["date_reengaged"] = pd.to_datetime(
-        targets_df["date_reengaged"], errors="coerce"
-    )
-    # Calculate the time to reengagement as visitdate - date_reengaged
-    targets_df["monthssincerestart"] = (
-        targets_df["visitdate"] - targets_df["date_reengaged"]
-    ).dt.days / 30
-
-    # Categorize monthssincerestart into bins:
-    # if None, then "neverdisengaged"
-    # if 0-6 months, "shorttermrestart"
-    # if >6 months, then "longtermrestart"
-    targets_df["monthssincerestart"] = targets_df["monthssincerestart"].fillna(-1)
-    targets_df["cascadestatus"] = targets_df["monthssincerestart"].apply(
-        lambda x: (
-            "neverdisengaged"
-            if x == -1
-            else ("shorttermrestart" if x <= 6 else "longtermrestart")
-        )
+    targets_df = targets_df.assign(
+        visitdate=pd.to_datetime(targets_df["visitdate"], errors="coerce")
     )
-
-    # drop monthssincerestart, date_reengaged, and iit_lag columns
-    targets_df = targets_df.drop(
-        columns=["monthssincerestart", "date_reengaged", "iit_lag"]
+    targets_df = targets_df.sort_values(by=["key", "visitdate"])
+    targets_df["cascadestatus"] = cascade_status(
+        targets_df["key"], targets_df["visitdate"], targets_df["iit"]
     )
 
     ## Rolling join with visits_df
     # Merge the targets DataFrame with the visits DataFrame on 'key' and 'visitdate'
     # We want a rolling join, with the visit just before the target visit
-    targets_df["join_time"] = targets_df["visitdate"]  # - pd.Timedelta('1ns')
-    visits_df["join_time"] = visits_df["visitdate"]
-    visits_df = visits_df.drop(
-        columns=["visitdate", "sitecode", "nad_imputation_flag", "nad_imputed"]
-    )
-
-    targets_df["join_time"] = pd.to_datetime(targets_df["join_time"])
-    visits_df["join_time"] = pd.to_datetime(visits_df["join_time"])
-    targets_df["key"] = targets_df["key"].astype(str)
-    visits_df["key"] = visits_df["key"].astype(str)
-    targets_df = targets_df.sort_values(
-        ["key", "join_time"], ascending=[True, True]
-    ).reset_index(drop=True)
-    visits_df = visits_df.sort_values(
-        ["key", "join_time"], ascending=[True, True]
-    ).reset_index(drop=True)
-
-    targets_df = pl.from_pandas(targets_df)
-    visits_df = pl.from_pandas(visits_df)
-
-    targets_df = targets_df.join_asof(
-        visits_df,
-        left_on="join_time",
-        right_on="join_time",
+    visits_df = visits_df.drop(columns=["sitecode", "nad_imputation_flag", "nad_imputed"])
+    visits_df["visitdate"] = pd.to_datetime(visits_df["visitdate"])
+    # the as-of join needs the same key dtype on both sides
+    visits_df["key"] = visits_df["key"].astype(targets_df["key"].dtype)
+    visits_df = visits_df.sort_values(["key", "visitdate"], ascending=[True, True])
+
+    frame = pl.from_pandas(targets_df).join_asof(
+        pl.from_pandas(visits_df),
+        on="visitdate",
         by="key",  # join by group
         strategy="backward",  # or 'forward' or 'nearest'
-    ).to_pandas()
+    )
 
     ## Lateness metrics
     # first, clean up visitdiff. if visitdiff is less than 0, then set to 0.
     #  if over 100, set to 100
     #  if None, keep as None
-    targets_df["visitdiff"] = targets_df["visitdiff"].clip(lower=0, upper=100)
-
     # create lastvd column as visitdiff from the previous visit
-    targets_df["lastvd"] = targets_df.groupby("key")["visitdiff"].shift(1)
-    targets_df = targets_df.drop(columns=["join_time", "visitdiff"])
+    frame = frame.with_columns(
+        pl.col("visitdiff").clip(0, 100).shift(1).over("key").alias("lastvd")
+    ).drop("visitdiff")
     # create three binaries.
     # if lastvd is greater than 0, then late = 1, else late = 0
     # if lastvd is greater than 14, then late14 = 1, else late14 = 0
     # if lastvd is greater than 30, then late30 = 1, else late30 = 0
-    targets_df["late"] = targets_df["lastvd"].apply(lambda x: 1 if x > 0 else 0)
-    targets_df["late14"] = targets_df["lastvd"].apply(lambda x: 1 if x > 14 else 0)
-    targets_df["late30"] = targets_df["lastvd"].apply(lambda x: 1 if x > 30 else 0)
-
-    # now, let's create rolling features
-    # first, let's get the rolling mean of visitdiff over the last 3, 5, and 10 visits
-    targets_df["lateness_last3"] = targets_df.groupby("key")["lastvd"].transform(
-        lambda x: x.rolling(window=3, min_periods=1).mean()
-    )
-    targets_df["lateness_last5"] = targets_df.groupby("key")["lastvd"].transform(
-        lambda x: x.rolling(window=5, min_periods=1).mean()
-    )
-    targets_df["lateness_last10"] = targets_df.groupby("key")["lastvd"].transform(
-        lambda x: x.rolling(window=10, min_periods=1).mean()
+    # (a missing lastvd is not late)
+    frame = frame.with_columns(
+        (pl.col("lastvd") > days).fill_null(False).cast(pl.Int64).alias(col)
+        for col, days in LATENESS_THRESHOLDS.items()
     )
 
-    # now, let's get the rolling sum of late over the last 3, 5, and 10 visits
-    targets_df["late_last3"] = targets_df.groupby("key")["late"].transform(
-        lambda x: x.rolling(window=3, min_periods=1).sum()
-    )
-    targets_df["late_last5"] = targets_df.groupby("key")["late"].transform(
-        lambda x: x.rolling(window=5, min_periods=1).sum()
-    )
-    targets_df["late_last10"] = targets_df.groupby("key")["late"].transform(
-        lambda x: x.rolling(window=10, min_periods=1).sum()
-    )
-    # now, let's get the rolling sum of late14 over the last 3, 5, and 10 visits
-    targets_df["late14_last3"] = targets_df.groupby("key")["late14"].transform(
-        lambda x: x.rolling(window=3, min_periods=1).sum()
-    )
-    targets_df["late14_last5"] = targets_df.groupby("key")["late14"].transform(
-        lambda x: x.rolling(window=5, min_periods=1).sum()
-    )
-    targets_df["late14_last10"] = targets_df.groupby("key")["late14"].transform(
-        lambda x: x.rolling(window=10, min_periods=1).sum()
+    # now, let's create rolling features over the last 3, 5, and 10 visits,
+    # all computed in one pass over the targets
+    rolling = helpers.grouped_rolling_sums(
+        frame["key"].to_numpy(),
+        {col: frame[col].to_numpy() for col in ["lastvd"] + list(LATENESS_THRESHOLDS)},
+        LATENESS_WINDOWS,
     )
-    # now, let's get the rolling sum of late30 over the last 3, 5, and 10 visits
-    targets_df["late30_last3"] = targets_df.groupby("key")["late30"].transform(
-        lambda x: x.rolling(window=3, min_periods=1).sum()
-    )
-    targets_df["late30_last5"] = targets_df.groupby("key")["late30"].transform(
-        lambda x: x.rolling(window=5, min_periods=1).sum()
-    )
-    targets_df["late30_last10"] = targets_df.groupby("key")["late30"].transform(
-        lambda x: x.rolling(window=10, min_periods=1).sum()
+    features = {}
+    # first, the rolling mean of lastvd, skipping missing values
+    for window in LATENESS_WINDOWS:
+        sums, counts = rolling[("lastvd", window)]
+        features[f"lateness_last{window}"] = sums / np.maximum(counts, 1)
+    # then the rolling sum of late, late14 and late30
+    for col in LATENESS_THRESHOLDS:
+        for window in LATENESS_WINDOWS:
+            features[f"{col}_last{window}"] = rolling[(col, window)][0]
+
+    return frame.with_columns(
+        pl.Series(name, values) for name, values in features.items()
     )
 
-    return targets_df
+
+def cascade_status(keys, visitdates, iit):
+    """
+    Cascade status of each encounter: how long ago the patient re-engaged
+    after their most recent interruption in treatment.
+
+    The re-engagement date is the visitdate of an encounter whose previous
+    encounter (same key) was an iit, carried forward over the key's later
+    encounters. Months since restart are days / 30, binned as
+    "neverdisengaged" (no re-engagement yet), "shorttermrestart" (up to 6
+    months) or "longtermrestart".
+
+    Args:
+        keys (pd.Series): Patient key, with encounters sorted by key and visitdate.
+        visitdates (pd.Series): Encounter dates (datetime64).
+        iit (pd.Series): 1 if the encounter was followed by an interruption.
+
+    Returns:
+        np.ndarray: The cascade status of each encounter.
+    """
+    iit_lag = iit.groupby(keys).shift(1)
+    date_reengaged = visitdates.where(iit_lag == 1)
+    date_reengaged = date_reengaged.groupby(keys).ffill()
+    monthssincerestart = ((visitdates - date_reengaged).dt.days / 30).fillna(-1)
+    return np.where(
+        monthssincerestart == -1,
+        "neverdisengaged",
+        np.where(monthssincerestart <= 6, "shorttermrestart", "longtermrestart"),
+    ).astype(object)
 
 
 def prep_target_pharmacy_features(targets_df, pharmacy_df):
@@ -178,39 +202,36 @@ def prep_target_pharmacy_features(targets_df, pharmacy_df):
         targets_df["optimizedhivregimen"] = 0
         return targets_df
 
-    # first, create a new column in pharmacy_df called optimizedregimen that is 1
-    # if the drug variable contains the string "DTG", else 0
-    pharmacy_df["optimizedhivregimen"] = pharmacy_df["drug"].apply(
-        lambda x: 1 if isinstance(x, str) and "DTG" in x else 0
-    )
-
-    # select key, visitdate in place of dispensedate, and optimizedregimen
-    pharmacy_df["visitdate"] = pharmacy_df["dispensedate"]
-    pharmacy_df["visitdate"] = pd.to_datetime(pharmacy_df["visitdate"], errors="coerce")
-    pharmacy_df = pharmacy_df[["key", "visitdate", "optimizedhivregimen"]]
+    return _join_pharmacy(_sorted_frame(targets_df), pharmacy_df).to_pandas()
 
-    pharmacy_df.loc[:, "key"] = pharmacy_df.loc[:, "key"].astype(str)
 
-    # do rolling join with targets_df
-    targets_df = targets_df.sort_values(
-        ["key", "visitdate"], ascending=[True, True]
-    ).reset_index(drop=True)
-    pharmacy_df = pharmacy_df.sort_values(
-        ["key", "visitdate"], ascending=[True, True]
-    ).reset_index(drop=True)
+def _join_pharmacy(frame, pharmacy_df):
+    # optimizedhivregimen of the dispense on or before each target visit;
+    # frame is a polars frame sorted by key and visitdate
+    if pharmacy_df is None or pharmacy_df.empty:
+        return frame.with_columns(pl.lit(0, dtype=pl.Int64).alias("optimizedhivregimen"))
 
-    targets_df = pl.from_pandas(targets_df)
-    pharmacy_df = pl.from_pandas(pharmacy_df)
+    # first, create a new column called optimizedregimen that is 1
+    # if the drug variable contains the string "DTG", else 0
+    # and select key, visitdate in place of dispensedate, and optimizedregimen
+    pharmacy_df = pd.DataFrame(
+        {
+            "key": pharmacy_df["key"],
+            "visitdate": pd.to_datetime(pharmacy_df["dispensedate"], errors="coerce"),
+            "optimizedhivregimen": pharmacy_df["drug"].apply(
+                lambda x: 1 if isinstance(x, str) and "DTG" in x else 0
+            ),
+        }
+    )
+    pharmacy_df = pharmacy_df.sort_values(["key", "visitdate"], ascending=[True, True])
 
-    targets_df = targets_df.join_asof(
-        pharmacy_df,
-        left_on="visitdate",
-        right_on="visitdate",
+    # do rolling join with the targets, on the same key dtype
+    return frame.join_asof(
+        pl.from_pandas(pharmacy_df).with_columns(pl.col("key").cast(frame.schema["key"])),
+        on="visitdate",
         by="key",  # join by group
         strategy="backward",  # or 'forward' or 'nearest'
-    ).to_pandas()
-
-    return targets_df
+    )
 
 
 def prep_target_lab_features(targets_df, lab_df):
@@ -227,134 +248,205 @@ def prep_target_lab_features(targets_df, lab_df):
 
     if lab_df is None or lab_df.empty:
         print("⚠️ lab_df is empty — skipping lab feature preparation.")
-        targets_df["most_recent_vl"] = "novalidvl"
-        targets_df["ahd"] = targets_df.apply(
-            lambda x: 1 if (x["age"] < 5 or x["whostage"] in [3, 4]) else 0, axis=1
+        # no results at all, so every VL is "novalidvl"
+        targets_df["most_recent_vl"] = None
+        targets_df["most_recent_cd4"] = None
+        return _lab_categories(targets_df, True)
+
+    return _lab_categories(_join_labs(_sorted_frame(targets_df), lab_df).to_pandas())
+
+
+def _join_labs(frame, lab_df):
+    # most_recent_vl and most_recent_cd4 of each target visit; frame is a
+    # polars frame sorted by key and visitdate
+    if lab_df is None or lab_df.empty:
+        print("⚠️ lab_df is empty — skipping lab feature preparation.")
+        return frame.with_columns(
+            pl.lit(None, dtype=pl.String).alias("most_recent_vl"),
+            pl.lit(None, dtype=pl.String).alias("most_recent_cd4"),
         )
-        return targets_df
 
-    # we'll need to join vl and cd4 data separately onto targets_df since they
+    # we'll need to join vl and cd4 data separately onto the targets since they
     # can be taken on different days
-    # first, get vl data
-    vl_df = lab_df[lab_df["testname"] == "VL"]
-    # rename testrestultcat to vl
-    vl_df.loc[:, "vl"] = vl_df.loc[:, "testresultcat"]
-    vl_df = vl_df[["key", "orderedbydate", "vl"]]
-
-    targets_df["visitdate"] = pd.to_datetime(targets_df["visitdate"])
-    vl_df["orderedbydate"] = pd.to_datetime(vl_df["orderedbydate"])
-
-    # do rolling join with targets_df
-    targets_df = targets_df.sort_values(
-        ["key", "visitdate"], ascending=[True, True]
-    ).reset_index(drop=True)
-    vl_df = vl_df.sort_values(
-        ["key", "orderedbydate"], ascending=[True, True]
-    ).reset_index(drop=True)
-
-    targets_df = pl.from_pandas(targets_df)
-    vl_df = pl.from_pandas(vl_df)
-
-    targets_df = (
-        targets_df.join_asof(
-            vl_df,
-            left_on="visitdate",
-            right_on="orderedbydate",
-            by="key",
-            strategy="backward",
-        )
-        .with_columns(
-            (pl.col("visitdate") - pl.col("orderedbydate"))
-            .dt.total_days()
-            .alias("days_diff")
+    for testname in ["VL", "CD4"]:
+        test_df = lab_df[lab_df["testname"] == testname]
+        test_df = pd.DataFrame(
+            {
+                "key": test_df["key"],
+                "orderedbydate": pd.to_datetime(test_df["orderedbydate"], errors="coerce"),
+                "result": test_df["testresultcat"],
+            }
         )
-        .with_columns(
-            pl.when((pl.col("days_diff") > 365) | (pl.col("days_diff") < 0))
-            .then(None)
-            .otherwise(pl.col("vl"))
-            .alias("most_recent_vl")
+        test_df = test_df.sort_values(["key", "orderedbydate"], ascending=[True, True])
+
+        # do rolling join with the targets, keeping results from the year
+        # before each visit
+        frame = (
+            frame.join_asof(
+                pl.from_pandas(test_df).with_columns(
+                    pl.col("key").cast(frame.schema["key"])
+                ),
+                left_on="visitdate",
+                right_on="orderedbydate",
+                by="key",  # join by group
+                strategy="backward",  # or 'forward' or 'nearest'
+            )
+            .with_columns(
+                (pl.col("visitdate") - pl.col("orderedbydate"))
+                .dt.total_days()
+                .alias("days_diff")
+            )
+            .with_columns(
+                pl.when((pl.col("days_diff") > LAB_VALIDITY_DAYS) | (pl.col("days_diff") < 0))
+                .then(None)
+                .otherwise(pl.col("result"))
+                .alias(f"most_recent_{testname.lower()}")
+            )
+            .drop("days_diff", "orderedbydate", "result")
         )
-        .drop("days_diff", "orderedbydate", "vl")
-        .to_pandas()
-    )
 
-    # where most_recent_vl is None, if timeonart is less than 6 months,
-    # then set to "earlyart". Otherwise, if most_recent_vl is none,
+    return frame
+
+
+def _without_labs(targets_df, lab_df, per_patient):
+    # True where a target's VL is "novalidvl" for want of any lab rows: every
+    # target if lab_df is empty, else the keys without rows if per_patient
+    if lab_df is None or lab_df.empty:
+        return True
+    if per_patient:
+        return ~targets_df["key"].isin(lab_df["key"]).to_numpy()
+    return False
+
+
+def _lab_categories(targets_df, without_labs=False):
+    # where there are no lab rows to take a VL from (without_labs), set
+    # most_recent_vl to "novalidvl". Otherwise, where most_recent_vl is None,
+    # if timeonart is less than 6 months, then set to "earlyart". Otherwise,
+    # if most_recent_vl is none,
     # time on art is greater than six months but timeatfacility is less than
     # 6 months, then set to "restart". finally, any remaining missing
     # most_recent_vl should be set to "novalidvl".
-    def classify_vl(row):
-        if pd.isnull(row["most_recent_vl"]):
-            if pd.notnull(row["timeonart"]) and row["timeonart"] <= 6:
-                return "earlyart"
-            elif (
-                pd.notnull(row["timeonart"])
-                and row["timeonart"] > 6
-                and pd.notnull(row["timeatfacility"])
-                and row["timeatfacility"] <= 6
-            ):
-                return "restart"
-            else:
-                return "novalidvl"
-        else:
-            return row["most_recent_vl"]
-
-    targets_df["most_recent_vl"] = targets_df.apply(classify_vl, axis=1)
-
-    # now, let's repeat the process for cd4 data
-    cd4_df = lab_df[lab_df["testname"] == "CD4"]
-    # rename testrestultcat to cd4
-    cd4_df.loc[:, "cd4"] = cd4_df.loc[:, "testresultcat"]
-    cd4_df = cd4_df[["key", "orderedbydate", "cd4"]]
-    cd4_df["orderedbydate"] = pd.to_datetime(cd4_df["orderedbydate"], errors="coerce")
-    # do rolling join with targets_df
-    targets_df = targets_df.sort_values(
-        ["key", "visitdate"], ascending=[True, True]
-    ).reset_index(drop=True)
-    cd4_df = cd4_df.sort_values(
-        ["key", "orderedbydate"], ascending=[True, True]
-    ).reset_index(drop=True)
-    targets_df = pl.from_pandas(targets_df)
-    cd4_df = pl.from_pandas(cd4_df)
-
-    targets_df = (
-        targets_df.join_asof(
-            cd4_df,
-            left_on="visitdate",
-            right_on="orderedbydate",
-            by="key",  # join by group
-            strategy="backward",  # or 'forward' or 'nearest'
-        )
-        .with_columns(
-            (pl.col("visitdate") - pl.col("orderedbydate"))
-            .dt.total_days()
-            .alias("days_diff")
-        )
-        .with_columns(
-            pl.when((pl.col("days_diff") > 365) | (pl.col("days_diff") < 0))
-            .then(None)
-            .otherwise(pl.col("cd4"))
-            .alias("most_recent_cd4")
-        )
-        .drop("days_diff", "orderedbydate")
-        .to_pandas()
+    # (comparisons with a missing timeonart or timeatfacility are False)
+    most_recent_vl = targets_df["most_recent_vl"]
+    timeonart = targets_df["timeonart"]
+    targets_df["most_recent_vl"] = np.select(
+        [
+            most_recent_vl.notna(),
+            np.broadcast_to(without_labs, len(targets_df)),
+            timeonart <= 6,
+            (timeonart > 6) & (targets_df["timeatfacility"] <= 6),
+        ],
+        [most_recent_vl.to_numpy(dtype=object), "novalidvl", "earlyart", "restart"],
+        default="novalidvl",
     )
 
     # finally, create a variable called ahd.
-    # if age is less than 5 or cd4 is "YesAHD" or whostage is 3 or 4, then ahd = 1
-    # else ahd = 0
-    targets_df["ahd"] = targets_df.apply(
-        lambda x: (
-            1
-            if (x["age"] < 5)
-            or (x["most_recent_cd4"] == "YesAHD")
-            or (x["whostage"] in [3, 4])
-            else 0
-        ),
-        axis=1,
+    targets_df["ahd"] = _ahd(
+        targets_df["age"], targets_df["whostage"], targets_df["most_recent_cd4"]
     )
 
     # drop most_recent_cd4 column
-    targets_df = targets_df.drop(columns=["most_recent_cd4", "cd4"])
+    return targets_df.drop(columns=["most_recent_cd4"])
+
+
+def _ahd(age, whostage, most_recent_cd4):
+    # if age is less than 5 or cd4 is "YesAHD" or whostage is 3 or 4, then ahd = 1
+    # else ahd = 0. whostage matches 3 or 4 as a number only, as "in [3, 4]" did
+    ahd = (age < 5) | whostage.isin([3, 4]) | (most_recent_cd4 == "YesAHD")
+    return ahd.astype(np.int64)
+
+
+# the longest rolling lateness window in prep_target_visit_features
+LATENESS_WINDOW = max(LATENESS_WINDOWS)
+
+# emr values gen_inference scores
+SCORED_EMRS = ["kenyaemr", "ecare"]
+
+
+def prep_latest_target_features(targets_df, visits_df, pharmacy_df, lab_df, pipeline="inference", per_patient_labs=True):
+    """
+    Inference-only alternative to running prep_target_visit_features,
+    prep_target_pharmacy_features and prep_target_lab_features over every
+    historical encounter. Only the encounter gen_inference scores (the one
+    with the latest nad among kenyaemr/ecare encounters) is kept for each key,
+    together with the LATENESS_WINDOW encounters before it that its rolling
+    lateness features need. Cascade status depends on the whole history and
+    is computed for every encounter, which is a few vectorized passes.
 
-    return targets_df
+    Parameters:
+    - targets_df (pd.DataFrame): Targets from create_target.
+    - visits_df (pd.DataFrame): The DataFrame containing visit data.
+    - pharmacy_df (pd.DataFrame): The DataFrame containing pharmacy data.
+    - lab_df (pd.DataFrame): The DataFrame containing lab data.
+    - pipeline (str): Pipeline the visit, pharmacy and lab stages are timed under.
+    - per_patient_labs (bool): As in prep_target_features. True by default, so a
+      patient scores the same in a batch as on their own.
+
+    Returns:
+    - pd.DataFrame: One row per key with the same features as the full path.
+    """
+
+    if targets_df.empty or visits_df is None or visits_df.empty:
+        # nothing to narrow down; the full path handles the defaults
+        return prep_target_features(targets_df, visits_df, pharmacy_df, lab_df, pipeline, per_patient_labs)
+
+    with stage_timer("target_visit_features", pipeline):
+        window_df, anchor_cascade = _latest_visit_window(targets_df, visits_df)
+        if window_df is None:
+            return targets_df.iloc[0:0]
+        frame = _visit_frame(window_df, visits_df)
+        # the last row of each window is the anchor
+        frame = frame.filter(pl.col("key").is_last_distinct())
+    with stage_timer("target_pharmacy_features", pipeline):
+        frame = _join_pharmacy(frame, pharmacy_df)
+    with stage_timer("target_lab_features", pipeline):
+        window_df = _join_labs(frame, lab_df).to_pandas()
+        window_df["cascadestatus"] = window_df["key"].map(anchor_cascade)
+        return _lab_categories(window_df, _without_labs(window_df, lab_df, per_patient_labs))
+
+
+def _latest_visit_window(targets_df, visits_df):
+    # the targets of each key's scored encounter and the LATENESS_WINDOW
+    # encounters before it, and the cascade status of each anchor by key;
+    # (None, None) if no encounter is scored
+    targets_df = targets_df.copy()
+    targets_df["visitdate"] = pd.to_datetime(targets_df["visitdate"], errors="coerce")
+    targets_df = targets_df.sort_values(["key", "visitdate"]).reset_index(drop=True)
+    targets_df["position"] = targets_df.groupby("key").cumcount()
+
+    # cascade status over the full history, as in prep_target_visit_features
+    cascadestatus = cascade_status(
+        targets_df["key"], targets_df["visitdate"], targets_df["iit"]
+    )
+
+    # emr of each encounter comes from the visit on or before it
+    emr_df = visits_df[["key", "visitdate", "emr"]].copy()
+    emr_df["key"] = emr_df["key"].astype(targets_df["key"].dtype)
+    emr_df["visitdate"] = pd.to_datetime(emr_df["visitdate"])
+    emr_df = emr_df.sort_values(["key", "visitdate"]).reset_index(drop=True)
+    emr = (
+        pl.from_pandas(targets_df[["key", "visitdate"]])
+        .join_asof(pl.from_pandas(emr_df), on="visitdate", by="key", strategy="backward")
+        .to_pandas()["emr"]
+    )
+
+    # the encounter gen_inference will score: latest nad among scored emrs,
+    # earliest visit first on ties
+    scored = targets_df[emr.isin(SCORED_EMRS).values]
+    anchors = (
+        scored.sort_values(["key", "nad"], ascending=[True, False])
+        .groupby("key", sort=False)
+        .head(1)
+    )
+    if anchors.empty:
+        return None, None
+    anchor_position = targets_df["key"].map(anchors.set_index("key")["position"])
+
+    # keep each anchor and the encounters its rolling windows reach back to
+    in_window = (targets_df["position"] <= anchor_position) & (
+        targets_df["position"] >= anchor_position - LATENESS_WINDOW
+    )
+    anchor_cascade = pd.Series(
+        cascadestatus[anchors.index], index=anchors["key"].values
+    )
+    return targets_df[in_window].drop(columns=["position"]), anchor_cascade
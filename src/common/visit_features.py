@@ -3,6 +3,11 @@ import numpy as np
 from . import helpers
 
 
+# regimens recorded within this long before a visit count towards its
+# regimen switch flag
+REGIMEN_WINDOW = pd.Timedelta(days=365)
+
+
 def prep_visit_features(df):
 
     """ Prepares visit features for the visit data. """
@@ -18,9 +23,9 @@ def prep_visit_features(df):
        'bmi', 'regimen_switch', 'startartdate'])
      
 
-    # first, parse dob and startartdate with the parse_long_date function
-    df["dob"] = df["dob"].apply(helpers.parse_long_date)
-    df["startartdate"] = df["startartdate"].apply(helpers.parse_long_date)
+    # first, parse dob and startartdate with the parse_long_dates function
+    df["dob"] = helpers.parse_long_dates(df["dob"])
+    df["startartdate"] = helpers.parse_long_dates(df["startartdate"])
 
     # replace all cells with "" with None
     df = df.replace(r"^\s*$", None, regex=True)
@@ -92,6 +97,11 @@ def clean_who(who_vec):
 
 
 def clean_adherence(adh_vec):
+    # each rule below runs once per distinct value, see helpers.map_distinct
+    return helpers.map_distinct(adh_vec, adherence_rule)
+
+
+def adherence_rule(adh_vec):
 
     # make lowercase
     adh_vec = adh_vec.str.lower()
@@ -113,6 +123,10 @@ def clean_adherence(adh_vec):
 
 
 def clean_visittype(visit_type_vec):
+    return helpers.map_distinct(visit_type_vec, visittype_rule)
+
+
+def visittype_rule(visit_type_vec):
 
     # make lowercase
     visit_type_vec = visit_type_vec.str.lower()
@@ -126,6 +140,10 @@ def clean_visittype(visit_type_vec):
 
 
 def clean_stabilityassessment(stab_assess_vec):
+    return helpers.map_distinct(stab_assess_vec, stabilityassessment_rule)
+
+
+def stabilityassessment_rule(stab_assess_vec):
     # make lowercase
     stab_assess_vec = stab_assess_vec.str.lower()
 
@@ -141,19 +159,22 @@ def clean_stabilityassessment(stab_assess_vec):
     return stab_assess_vec
 
 
+# group together community art distribution peer led and community art distribution
+# hcw led into a single category of community art distribution
+DIFFERENTIATED_CARE_RULES = [
+    ("community art distribution", "community art distribution"),
+]
+
+
 def clean_differentiatedcare(diff_care_vec):
+    return helpers.map_distinct(diff_care_vec, differentiatedcare_rule)
+
+
+def differentiatedcare_rule(diff_care_vec):
     # make lowercase
     diff_care_vec = diff_care_vec.str.lower()
 
-    # group together community art distribution peer led and community art distribution
-    # hcw led into a single category of community art distribution
-    diff_care_vec = np.where(
-        diff_care_vec.str.contains("community art distribution"),
-        "community art distribution",
-        diff_care_vec,
-    )
-
-    return diff_care_vec
+    return helpers.replace_contains(diff_care_vec, DIFFERENTIATED_CARE_RULES).to_numpy()
 
 
 def gen_age(df):
@@ -262,31 +283,71 @@ def clean_bmi(df):
     return df
 
 
-def regimen_switch_group(group):
-    group = group.sort_values("visitdate")
-    visitdates = group["visitdate"]
-    regimens = group["currentregimen"]
-    switch_counts = []
-
-    for _, this_date in enumerate(visitdates):
-        mask = (visitdates <= this_date) & (
-            visitdates >= this_date - pd.Timedelta(days=365)
-        )
-        prev_regimens = regimens[mask].dropna().unique()
-        switch_counts.append(len(prev_regimens))
-
-    group["regimen_switch"] = [
-        None if x == 0 else (0 if x == 1 else 1) for x in switch_counts
-    ]
-    return group
+def recent_regimen_counts(keys, visitdates, regimens, window=REGIMEN_WINDOW):
+    """
+    Count, for each visit, the distinct regimens recorded for the same key
+    on visits from window before it up to and including its date.
+
+    A regimen recorded on a visit at date t is counted for every visit of that
+    key dated within [t, t + window]. Each run of a key's visits on one regimen
+    that are no more than window apart therefore covers a single interval
+    [first visit, last visit + window], and a visit's count is the number of
+    its key's intervals that contain its date. The intervals are counted with
+    two binary searches instead of scanning the key's visits for every visit.
+
+    Args:
+        keys (pd.Series): Patient key of each visit.
+        visitdates (pd.Series): Visit dates (datetime64).
+        regimens (pd.Series): Regimen of each visit; missing values are not counted.
+        window (pd.Timedelta): How far back regimens are counted.
+
+    Returns:
+        np.ndarray: The number of distinct regimens for each visit.
+    """
+    group = pd.factorize(keys)[0].astype(np.int64)
+    regimen = pd.factorize(regimens)[0]
+    dates = visitdates.to_numpy(dtype="datetime64[ns]").view(np.int64)
+    dated = ~visitdates.isna().to_numpy()
+    recorded = dated & (regimen >= 0)
+
+    # runs of the same regimen, sorted by key, regimen and date
+    g, r, t = group[recorded], regimen[recorded], dates[recorded]
+    order = np.lexsort((t, r, g))
+    g, r, t = g[order], r[order], t[order]
+    run_start = np.ones(len(t), dtype=bool)
+    run_start[1:] = (g[1:] != g[:-1]) | (r[1:] != r[:-1]) | (t[1:] - t[:-1] > window.value)
+    run_end = np.ones(len(t), dtype=bool)
+    run_end[:-1] = run_start[1:]
+    starts, ends, run_group = t[run_start], t[run_end] + window.value, g[run_start]
+
+    # rank the visit dates and interval bounds together, so that (key, date)
+    # pairs compare as single integers
+    queries = dates[dated]
+    _, rank = np.unique(np.concatenate([queries, starts, ends]), return_inverse=True)
+    width = len(rank) + 1
+    n_queries, n_runs = len(queries), len(starts)
+    query_pos = group[dated] * width + rank[:n_queries]
+    start_pos = np.sort(run_group * width + rank[n_queries : n_queries + n_runs])
+    end_pos = np.sort(run_group * width + rank[n_queries + n_runs :])
+
+    # intervals that started on or before the visit, less those that ended before it
+    counts = np.zeros(len(dates), dtype=np.int64)
+    counts[dated] = np.searchsorted(start_pos, query_pos, side="right") - np.searchsorted(
+        end_pos, query_pos, side="left"
+    )
+    return counts
 
 
 def regimen_switch(df):
     df = df.copy()
     df["visitdate"] = pd.to_datetime(df["visitdate"], errors="coerce")
-    df = df.sort_values(by=["key", "visitdate"])
+    # visits without a key are dropped, as grouping by key does
+    df = df[df["key"].notna()].sort_values(by=["key", "visitdate"])
     df["currentregimen"] = df["currentregimen"].replace(r"^\s*$", None, regex=True)
 
-    # Parallel groupby-apply
-    df = df.groupby("key", group_keys=False).apply(regimen_switch_group)
+    # no regimen in the past year -> None, one regimen -> 0, more than one -> 1
+    counts = recent_regimen_counts(df["key"], df["visitdate"], df["currentregimen"])
+    switch = np.where(counts > 1, 1.0, 0.0)
+    switch[counts == 0] = np.nan
+    df["regimen_switch"] = switch if np.isnan(switch).any() else switch.astype(np.int64)
     return df
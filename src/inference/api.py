@@ -1,11 +1,33 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from pipelines.inference_pipeline import run_inference_pipeline
-import numpy as np
+from pipelines.inference_pipeline import run_batch_inference_pipeline
+from src.inference import model_registry
+from src.inference import get_inference_data
+from src.common import metrics
 import traceback
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # load the model artifacts once so requests don't hit the disk,
+    # then watch the bundle manifest for retrained models
+    model_registry.init_registry()
+    model_registry.start_watcher()
+    # open the shared MySQL pool up front; if the database is not reachable
+    # yet the pool is created on the first request instead
+    try:
+        get_inference_data.init_pool()
+    except Exception as e:
+        print(f"MySQL Error: {e}")
+    yield
+    model_registry.stop_watcher()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 class InferenceRequest(BaseModel):
@@ -15,6 +37,17 @@ class InferenceRequest(BaseModel):
     end_date: Optional[str] = "2025-01-15"
 
 
+class Patient(BaseModel):
+    ppk: str
+    sc: str
+
+
+class BatchInferenceRequest(BaseModel):
+    patients: List[Patient]
+    start_date: Optional[str] = "2021-01-01"
+    end_date: Optional[str] = "2025-01-15"
+
+
 @app.post("/inference")
 def inference(request: InferenceRequest):
     try:
@@ -34,3 +67,26 @@ def inference(request: InferenceRequest):
         print("Error: ", e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/inference/batch")
+def batch_inference(request: BatchInferenceRequest):
+    try:
+        results = run_batch_inference_pipeline(
+            patients=[(p.ppk, p.sc) for p in request.patients],
+            start_date=request.start_date,
+            end_date=request.end_date,
+        )
+        return {"results": results}
+    except Exception as e:
+        print("Error: ", e)
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    # per-stage latency histograms in the Prometheus text format
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4"
+    )
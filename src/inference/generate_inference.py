@@ -1,29 +1,47 @@
 import xgboost as xgb
-from sklearn.preprocessing import OneHotEncoder
 from datetime import datetime
-import random
-import io
-import os
 import pandas as pd
-import pickle
 from src.common.feature_dtypes import expected_dtypes
+from src.common.metrics import stage_timer
+from src.inference import model_registry
 
 
-def gen_inference(df, sitecode):
+UNAVAILABLE = {"pred_out": None, "pred_cat": "unavailable"}
 
+
+def score_most_recent(df, artifacts):
+    """
+    Encode and score the most recent encounter (latest nad) of every key in df
+    with a single booster call.
+
+    Args:
+        df (pd.DataFrame): Target rows with all features, for one or more keys.
+        artifacts (ModelArtifacts): The model bundle to score with.
+
+    Returns:
+        tuple: (keys, df, final_df, preds) with one row per scored key, where df
+        holds the unencoded features and final_df the model inputs, or None if
+        the rows could not be scored.
+    """
     if df is None or df.empty:
-        return {"pred_out": None, "pred_cat": "unavailable"}
+        return None
 
     required_cols = ["nad", "iit"]
     missing = [col for col in required_cols if col not in df.columns]
     if missing:
         print(f"Missing required column(s): {missing} — cannot proceed with inference.")
-        return {"pred_out": None, "pred_cat": "unavailable"}
+        return None
 
     # make sure nad is a datetime
     df["nad"] = pd.to_datetime(df["nad"], format="%Y-%m-%d")
-    # make sure data is sorted by nad in descending order
-    df = df.sort_values(by="nad", ascending=False)
+    # make sure data is sorted by nad in descending order within each key
+    df = df.sort_values(by=["key", "nad"], ascending=[True, False])
+
+    # filter to emr in kenyamer and ecare
+    df = df[df["emr"].isin(["kenyaemr", "ecare"])]
+    # only the most recent encounter of each key is scored
+    df = df.groupby("key", sort=False).head(1)
+    keys = df["key"].tolist()
 
     df = df.drop(
         columns=[
@@ -44,8 +62,6 @@ def gen_inference(df, sitecode):
         ]
     )
 
-    # filter to emr in kenyamer and ecare
-    df = df[df["emr"].isin(["kenyaemr", "ecare"])]
     # Emr: KenyaEMR -> 1, else 0
     df["emr"] = (df["emr"] == "kenyaemr").astype("Int64")
 
@@ -70,16 +86,8 @@ def gen_inference(df, sitecode):
             #     print("Unique values in the column:", df[col].unique()[:10])  # show a few
             #     raise e  # re-raise the error to preserve traceback
 
-    # load encoder which is called ohe_latest.pkl
-    # from the models directory
-    encoder = "models/ohe_latest.pkl"
-    # Check if the encoder file exists
-    if not os.path.exists(encoder):
-        raise FileNotFoundError(
-            f"Encoder file {encoder} not found. Please train the model first."
-        )
-    with open(encoder, "rb") as f:
-        ohe = pickle.load(f)
+    # encoder fitted at training time (ohe_latest.pkl)
+    ohe = artifacts.ohe
 
     # encode categorical columns
     # Get the categorical columns from the DataFrame
@@ -88,52 +96,67 @@ def gen_inference(df, sitecode):
     # to match the training columns
     categorical_columns = df.select_dtypes(include=["object"]).columns.tolist()
 
-    # One-hot encode the categorical columns
-    try:
-        encoded_features = ohe.transform(df[categorical_columns]).toarray()
-    except Exception as e:
-        print(f"OneHotEncoding failed: {e}")
-        return {"pred_out": None, "pred_cat": "unavailable"}
-    encoded_feature_names = ohe.get_feature_names_out(categorical_columns)
+    # encoding covers everything that builds the model input from the features
+    with stage_timer("encode"):
+        # One-hot encode the categorical columns
+        try:
+            encoded_features = ohe.transform(df[categorical_columns]).toarray()
+        except Exception as e:
+            print(f"OneHotEncoding failed: {e}")
+            return None
+        encoded_feature_names = ohe.get_feature_names_out(categorical_columns)
 
-    # Create a DataFrame with the encoded features
-    encoded_df = pd.DataFrame(
-        encoded_features, columns=encoded_feature_names, index=df.index
-    )
+        # Create a DataFrame with the encoded features
+        encoded_df = pd.DataFrame(
+            encoded_features, columns=encoded_feature_names, index=df.index
+        )
 
-    # Concatenate the encoded features with the original DataFrame
-    final_df = pd.concat([df.drop(columns=categorical_columns), encoded_df], axis=1)
+        # Concatenate the encoded features with the original DataFrame
+        final_df = pd.concat([df.drop(columns=categorical_columns), encoded_df], axis=1)
 
-    # make sure the columns are in the right order
-    with open("models/feature_order.pkl", "rb") as f:
-        feature_order = pickle.load(f)
-    try:
-        final_df = final_df[feature_order]
-    except KeyError as e:
-        print(f"❌ Feature mismatch: some expected columns are missing: {e}")
-        return {"pred_out": None, "pred_cat": "unavailable"}
-
-    # convert to xgb.Dmatrix
-    xgb_df = xgb.DMatrix(data=final_df.drop(columns=["iit"]), label=final_df["iit"])
-
-    # load model
-    model = "models/mod_latest.json"
-    # Check if the model file exists
-    if not os.path.exists(model):
-        raise FileNotFoundError(
-            f"Model file {model} not found. Please train the model first."
-        )
-    bst = xgb.Booster()
-    bst.load_model(model)
+        # make sure the columns are in the right order
+        try:
+            final_df = final_df[list(artifacts.feature_order)]
+        except KeyError as e:
+            print(f"❌ Feature mismatch: some expected columns are missing: {e}")
+            return None
+
+        # convert to xgb.Dmatrix
+        xgb_df = xgb.DMatrix(data=final_df.drop(columns=["iit"]), label=final_df["iit"])
+
+    # model loaded once by the registry (mod_latest.json)
+    bst = artifacts.booster
 
     # make prediction
     try:
-        preds = bst.predict(xgb_df)
-        pred_out = preds[0].item()
+        with stage_timer("predict"):
+            preds = bst.predict(xgb_df)
     except Exception as e:
         print(f"❌ Prediction failed: {e}")
-        return {"pred_out": None, "pred_cat": "unavailable"}
+        return None
+    if len(preds) == 0:
+        print("❌ Prediction failed: no rows left to score")
+        return None
+
+    return keys, df, final_df, preds
 
+
+def build_result(pred_out, sitecode, artifacts, df, final_df, i):
+    """
+    Turn one prediction into the API result: the site-specific risk category
+    and, for high and medium risk, the patient's risk factors.
+
+    Args:
+        pred_out (float): The predicted probability of IIT.
+        sitecode (str): Site code used to look up thresholds.
+        artifacts (ModelArtifacts): The model bundle that produced the prediction.
+        df (pd.DataFrame): The scored rows before encoding.
+        final_df (pd.DataFrame): The scored rows as passed to the model.
+        i (int): Position of this prediction's row in df and final_df.
+
+    Returns:
+        dict: pred_out, pred_cat, risk_factors and evaluation_date.
+    """
     # # load thresholds from models/thresholds.pkl
     # thresholds_file = "models/thresholds_latest.pkl"
     # if not os.path.exists(thresholds_file):
@@ -154,14 +177,8 @@ def gen_inference(df, sitecode):
     # else:
     #     pred_cat = "low"
 
-    # load site thresholds
-    thresholds_file = "models/site_thresholds_latest.pkl"
-    if not os.path.exists(thresholds_file):
-        raise FileNotFoundError(
-            f"Thresholds file {thresholds_file} not found. Please train the model first."
-        )
-    with open(thresholds_file, "rb") as f:
-        thresholds = pickle.load(f)
+    # site thresholds (site_thresholds_latest.pkl)
+    thresholds = artifacts.site_thresholds
 
     # get thresholds for the site
     site_thresholds = thresholds.get(sitecode, thresholds["19735"])
@@ -178,7 +195,7 @@ def gen_inference(df, sitecode):
     # if lateness_last5 is greater than 0, return lateness_last5,
     # if most_recent_vl is "unsuppressed", return "unsuppressed",
     if pred_cat in ["high", "medium"]:
-        adherence_val = final_df["adherence"].iloc[0]
+        adherence_val = final_df["adherence"].iloc[i]
         if pd.isna(adherence_val):
             adherence = None
         elif adherence_val == 1:
@@ -188,14 +205,19 @@ def gen_inference(df, sitecode):
         else:
             adherence = None
         risk_factors = {
-            "avg_days_late_last5visits": final_df["lateness_last5"].iloc[0],
-            "months_on_art": final_df["timeonart"].iloc[0],
-            "most_recent_viralload": df["most_recent_vl"].iloc[0],
+            "avg_days_late_last5visits": final_df["lateness_last5"].iloc[i],
+            "months_on_art": final_df["timeonart"].iloc[i],
+            "most_recent_viralload": df["most_recent_vl"].iloc[i],
             # if adherence is 1, then return "good", if 0, return "poor", otherwise None
             # "adherence": "good" if final_df["adherence"].iloc[0] == 1 else "poor" if final_df["adherence"].iloc[0] == 0 else None,
             "adherence": adherence,
             # if visittype is 1, then return "unscheduled visits", otherwise return "no unscheduled visits"
-            "unscheduled_visits": "unscheduled visits" if final_df["visittype"].iloc[0] == 1 else "no unscheduled visits",
+            "unscheduled_visits": "unscheduled visits" if final_df["visittype"].iloc[i] == 1 else "no unscheduled visits",
+        }
+        # missing values (e.g. no ART start date) are returned as null, since
+        # NaN is not valid JSON and would fail the whole response
+        risk_factors = {
+            k: (None if pd.isna(v) else v) for k, v in risk_factors.items()
         }
     else:
         risk_factors = None
@@ -208,3 +230,46 @@ def gen_inference(df, sitecode):
         "evaluation_date": datetime.now().strftime("%Y-%m-%d"),
     }
     return pred_out
+
+
+def gen_inference(df, sitecode, artifacts=None):
+
+    # use the artifacts loaded at startup rather than reading them from disk per call
+    if artifacts is None:
+        artifacts = model_registry.get_artifacts()
+
+    scored = score_most_recent(df, artifacts)
+    if scored is None:
+        return dict(UNAVAILABLE)
+    _, df, final_df, preds = scored
+
+    return build_result(preds[0].item(), sitecode, artifacts, df, final_df, 0)
+
+
+def gen_batch_inference(df, sitecodes, artifacts=None):
+    """
+    Score many patients at once.
+
+    Args:
+        df (pd.DataFrame): Target rows with all features for every patient.
+        sitecodes (dict): key -> site code used for that patient's thresholds.
+        artifacts (ModelArtifacts): The model bundle to score with.
+
+    Returns:
+        dict: key -> result as returned by gen_inference.
+    """
+    if artifacts is None:
+        artifacts = model_registry.get_artifacts()
+
+    results = {key: dict(UNAVAILABLE) for key in sitecodes}
+    scored = score_most_recent(df, artifacts)
+    if scored is None:
+        return results
+    keys, df, final_df, preds = scored
+
+    for i, key in enumerate(keys):
+        if key in sitecodes:
+            results[key] = build_result(
+                preds[i].item(), sitecodes[key], artifacts, df, final_df, i
+            )
+    return results
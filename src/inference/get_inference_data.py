@@ -1,10 +1,34 @@
 import sqlite3
+import threading
+import functools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import pandas as pd
 import json
 import mysql.connector
 from mysql.connector import Error
-
+from mysql.connector import pooling
+from mysql.connector.constants import DEFAULT_CONFIGURATION
+from src.common import helpers
+from src.common import clean_data
+from src.common import target_features
+from src.common import visit_features
+
+# shared connection pool, created once at app startup by init_pool
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+# threads that run the per-patient procedures concurrently
+_fetch_executor = None
+
+@functools.lru_cache(maxsize=None)
 def load_settings(path='data/settings.json'):
+    # settings are read once per process and cached
     try:
         with open(path, 'r') as f:
             config = json.load(f)
@@ -12,193 +36,316 @@ def load_settings(path='data/settings.json'):
     except Exception as e:
         raise RuntimeError(f"Failed to load settings: {e}")
 
-def mysql_connect():
-    config = load_settings()
-    connection = None
-
-    try:
-        connection = mysql.connector.connect(
+def init_pool():
+    """
+    Create the shared MySQL connection pool. The pool size comes from the
+    optional "mysql_pool_size" setting (default 8; mysql-connector allows at most 32).
+    Reads on its connections time out after "mysql_query_timeout" seconds, so a
+    query that outlives its timeout does not hold a connection until it finishes.
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+        config = load_settings()
+        pool_size = int(config.get("mysql_pool_size", 8))
+        # timeouts are whole seconds. mysql-connector releases without
+        # read_timeout apply connection_timeout to every read instead. A timed
+        # out connection is reconnected by the ping on its next checkout.
+        timeout = max(1, math.ceil(float(config.get("mysql_query_timeout", 30))))
+        timeouts = {"connection_timeout": timeout}
+        if "read_timeout" in DEFAULT_CONFIGURATION:
+            timeouts["read_timeout"] = timeout
+        _pool = pooling.MySQLConnectionPool(
+            pool_name="iitml",
+            pool_size=pool_size,
+            pool_reset_session=True,
             host=config["mysql_url"],
             port=int(config["mysql_port"]),
             database=config["mysql_database"],
             user=config["mysql_username"],
-            password=config["mysql_password"]
+            password=config["mysql_password"],
+            **timeouts
         )
-    except Error as e:
-        print(f"MySQL Error: {e}")
-
-    return connection
-
-def get_inference_data_mysql(patientPK=None, sitecode=None):
-    # Initialize variables to None
-    pharmacy = lab = visits = dem = None
-    # # load settings
-    # config = load_settings()
-
+        # mysql-connector raises instead of waiting when the pool is exhausted,
+        # so callers queue on a semaphore with one slot per pooled connection
+        _pool_slots = threading.BoundedSemaphore(pool_size)
+        print(f"MySQL connection pool created with {pool_size} connections.")
+        return _pool
+
+def get_fetch_executor():
+    """
+    Return the thread pool used to run procedures concurrently. It has one
+    worker per pooled connection so queued queries wait for a thread rather
+    than for a connection.
+    """
+    global _fetch_executor
+    init_pool()
+    with _pool_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(
+                max_workers=_pool.pool_size, thread_name_prefix="mysql-fetch"
+            )
+        return _fetch_executor
+
+@contextmanager
+def pooled_connection(timeout=30):
+    """
+    Check a connection out of the pool, waiting up to timeout seconds for one
+    to be free. The connection is pinged (and reconnected if the server closed
+    it) before use, and returned to the pool on exit.
+    """
+    pool = init_pool()
+    if not _pool_slots.acquire(timeout=timeout):
+        raise Error(msg=f"No pooled MySQL connection available after {timeout}s")
+    connection = None
     try:
-        # connection = mysql.connector.connect(
-        #     host=config["mysql_url"],
-        #     port=int(config["mysql_port"]),
-        #     database=config["mysql_database"],
-        #     user=config["mysql_username"],
-        #     password=config["mysql_password"]
-        # )
-
-        connection = mysql_connect()
-
-        if connection.is_connected():
-            print("Connected to MySQL For Inference 1 - Lab")
-
-            labCursor = connection.cursor(dictionary=True)
-
-            # Lab Table
-            print("Lab Table: ")
-            labQuery = "CALL sp_iitml_get_patient_lab(%s)"
-            labCursor.execute(labQuery, (patientPK, ))
-            # Fetch all rows from the executed query
-            labRows = labCursor.fetchall()
-            # Create a DataFrame from the fetched rows
-            # if rows is empty, return empty DataFrame, set lab to an empty dataframe
-            if not labRows:
-                lab = pd.DataFrame(columns=[column[0] for column in labCursor.description])
-            else:
-                # Create a DataFrame from the fetched rows
-                lab = pd.DataFrame(labRows, columns=[column[0] for column in labCursor.description])
-            # close cursor
-            labCursor.close()
-
-    except Error as e:
-        print(f"MySQL Error: {e}")
-
+        connection = pool.get_connection()
+        connection.ping(reconnect=True, attempts=2, delay=0)
+        yield connection
     finally:
-        if 'connection' in locals() and connection.is_connected():
-            labCursor.close()
+        if connection is not None:
+            # close() on a pooled connection returns it to the pool
             connection.close()
-            print("Mysql Connection closed.")
-
+        _pool_slots.release()
+
+# longest interval between two visits the history horizon allows for
+# (six-monthly multi-month dispensing), and the safety margin added on top
+APPOINTMENT_GAP_DAYS = 180
+HISTORY_MARGIN_DAYS = 365
+
+def min_history_days():
+    """
+    Shortest history, in days before end_date, that the features of a
+    patient's most recent visit look back over: the rolling lateness windows
+    reach back LATENESS_WINDOW visits (and the visit before the earliest of
+    them), regimen switches REGIMEN_WINDOW and VL/CD4 results
+    LAB_VALIDITY_DAYS. Visits are assumed to be at most APPOINTMENT_GAP_DAYS
+    apart, and HISTORY_MARGIN_DAYS is added for visits before end_date.
+    """
+    lookback = max(
+        (target_features.LATENESS_WINDOW + 1) * APPOINTMENT_GAP_DAYS,
+        visit_features.REGIMEN_WINDOW.days,
+        target_features.LAB_VALIDITY_DAYS,
+    )
+    return lookback + HISTORY_MARGIN_DAYS
+
+@functools.lru_cache(maxsize=None)
+def history_horizon():
+    """
+    Days of history fetched before end_date: the optional
+    "history_horizon_days" setting, min_history_days() if it is not set, or
+    None (everything since start_date) if it is set to null. A setting below
+    min_history_days() is raised to it.
+    """
+    floor = min_history_days()
+    horizon = load_settings().get("history_horizon_days", floor)
+    if horizon is None:
+        return None
+    if int(horizon) < floor:
+        print(f"history_horizon_days {horizon} is shorter than the features look back, using {floor}.")
+        return floor
+    return int(horizon)
+
+def history_since(start_date, end_date):
+    """
+    Earliest encounter date worth fetching for a request: start_date, as
+    rows before it are dropped by cleaning anyway, or history_horizon() days
+    before end_date if that is later.
+
+    Returns:
+        str: The cut-off date as yyyy-mm-dd.
+    """
+    since = datetime.strptime(start_date, "%Y-%m-%d").date()
+    horizon = history_horizon()
+    if horizon is not None:
+        end = datetime.strptime(end_date, "%Y-%m-%d").date()
+        since = max(since, end - timedelta(days=horizon))
+    return since.isoformat()
+
+def call_procedure(procedure, patientPK, date_column=None, since=None):
+    """
+    Call one of the sp_iitml_* stored procedures for a patient on a pooled
+    connection and return its result set as a DataFrame (empty, with the
+    result columns, if there are no rows).
+
+    Rows whose date_column is before since are not returned. If the
+    "mysql_procedures_take_since" setting is true, the procedures of dated
+    tables take since as a second parameter and skip those rows on the
+    server, so they are never sent. Otherwise they are sent and dropped from
+    the frame once it is built, which only spares the later stages the rows.
+    """
+    params = (patientPK, )
+    if date_column is not None and load_settings().get("mysql_procedures_take_since", False):
+        params = (patientPK, since)
+        since = None
+    rows = []
+    with pooled_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            placeholders = ", ".join(["%s"] * len(params))
+            cursor.execute(f"CALL {procedure}({placeholders})", params)
+            columns = [column[0] for column in cursor.description]
+            # the procedures return column names in their own case
+            date_key = next(
+                (c for c in columns if date_column and c.lower() == date_column), None
+            )
+            while True:
+                batch = cursor.fetchmany(FETCH_SIZE)
+                if not batch:
+                    break
+                rows.extend(batch)
+            # drain any remaining result sets so the connection is clean for reuse
+            while cursor.nextset():
+                pass
+        finally:
+            cursor.close()
+    # Create a DataFrame from the fetched rows
+    # if rows is empty, return empty DataFrame with the result columns
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(rows, columns=columns)
+    if since is not None and date_key is not None:
+        # dates are compared as cleaning parses them, by their first 10
+        # characters; rows whose date cannot be parsed are kept for cleaning to drop
+        dates = helpers.parse_long_dates(df[date_key])
+        df = df[~(dates < pd.Timestamp(since))].reset_index(drop=True)
+    return df
+
+# the four per-patient procedures, in the order their frames are returned
+PROCEDURES = {
+    "lab": "sp_iitml_get_patient_lab",
+    "pharmacy": "sp_iitml_get_pharmacy_visits",
+    "visits": "sp_iitml_get_visits",
+    "dem": "sp_iitml_get_patient_demographics",
+}
+
+# encounter date of each table that history is limited by (lower case)
+HISTORY_DATES = {
+    "lab": "orderedbydate",
+    "pharmacy": "dispensedate",
+    "visits": "visitdate",
+}
+
+# rows read from the server per round trip while streaming a result
+FETCH_SIZE = 500
+
+def get_data_fingerprint(patientPK):
+    """
+    Run the optional "mysql_fingerprint_query" setting for a patient on a
+    pooled connection, to tell before the procedures run whether a cached
+    prediction is still current. The query is passed patientPK, the
+    PatientPKHash the sp_iitml_* procedures take, as %(patient)s, and should
+    summarise the rows those procedures read (e.g. counts and last-written
+    dates). Without it, the procedures' results are fetched and
+    fingerprinted instead (result_cache.fingerprint).
+
+    Returns:
+        tuple: The query's row, which changes when any of the patient's
+        records is written, or None if it is not set or failed.
+    """
+    query = load_settings().get("mysql_fingerprint_query")
+    if query is None:
+        return None
     try:
-        # connection = mysql.connector.connect(
-        #     host=config["mysql_url"],
-        #     port=int(config["mysql_port"]),
-        #     database=config["mysql_database"],
-        #     user=config["mysql_username"],
-        #     password=config["mysql_password"]
-        # )
-
-        connection = mysql_connect()
-
-        if connection.is_connected():
-            print("Connected to MySQL For Inference 1 - Pharmacy")
-
-            pharmacyCursor = connection.cursor(dictionary=True)
-
-            # Pharmacy Table
-            print("Pharmacy Table: ")
-            pharmacyQuery = "CALL sp_iitml_get_pharmacy_visits(%s)"
-            pharmacyCursor.execute(pharmacyQuery, (patientPK, ))
-            # Fetch all rows from the executed query
-            pharmacyRows = pharmacyCursor.fetchall()
-            # Create a DataFrame from the fetched rows
-            if not pharmacyRows:
-                pharmacy = pd.DataFrame(columns=[column[0] for column in pharmacyCursor.description])
-            else:
-                # Create a DataFrame from the fetched rows
-                pharmacy = pd.DataFrame(pharmacyRows, columns=[column[0] for column in pharmacyCursor.description])
-
+        with pooled_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, {"patient": patientPK})
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
     except Error as e:
-        print(f"MySQL Error: {e}")
-
-    finally:
-        if 'connection' in locals() and connection.is_connected():
-            pharmacyCursor.close()
-            connection.close()
-            print("Mysql Connection closed.")
-
+        print(f"MySQL Error: fingerprint query: {e}")
+        return None
+    return ("db", ) + tuple(rows[0]) if rows else None
+
+def _submit_patient(executor, patientPK, since):
+    # queue the four procedures for one patient
+    return {
+        name: executor.submit(
+            call_procedure, procedure, patientPK, HISTORY_DATES.get(name), since
+        )
+        for name, procedure in PROCEDURES.items()
+    }
+
+def _collect(futures, deadline, timeout):
+    # wait for one patient's procedures until deadline; a query that fails
+    # or times out leaves only its own frame as None
+    frames = {}
+    for name, future in futures.items():
+        try:
+            frames[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FuturesTimeout:
+            # cancel() only drops a query that has not started; one already
+            # running gives its connection back when the read times out
+            future.cancel()
+            print(f"MySQL Error: {PROCEDURES[name]} timed out after {timeout}s")
+            frames[name] = None
+        except Exception as e:
+            # not only MySQL errors: any failure of one procedure, e.g. a
+            # result without columns, must not fail the other patients
+            print(f"MySQL Error: {PROCEDURES[name]}: {e}")
+            frames[name] = None
+    return frames
+
+def get_inference_data_mysql(patientPK=None, sitecode=None, since=None):
+    """
+    Fetch lab, pharmacy, visits and demographics for a patient. The four
+    procedures are independent, so they run concurrently on pooled
+    connections and the fetch takes as long as the slowest one. Each query
+    has its own timeout ("mysql_query_timeout" setting, default 30 seconds);
+    a query that fails or times out leaves only its own frame as None.
+    Encounters before since (yyyy-mm-dd, see history_since) are skipped.
+    """
+    timeout = float(load_settings().get("mysql_query_timeout", 30))
     try:
-        # connection = mysql.connector.connect(
-        #     host=config["mysql_url"],
-        #     port=int(config["mysql_port"]),
-        #     database=config["mysql_database"],
-        #     user=config["mysql_username"],
-        #     password=config["mysql_password"]
-        # )
-
-        connection = mysql_connect()
-
-        if connection.is_connected():
-            print("Connected to MySQL For Inference 1 - Visits")
-
-            visitCursor = connection.cursor(dictionary=True)
-
-            # Visits Table
-            print("Visits Table: ")
-            # visitQueryBuilder = ['CALL sp_iitml_get_visits("', patientPK, '");']
-            # visitQuery = "".join(visitQueryBuilder)
-            # print("Mysql using the query: " + visitQuery)
-            # cursor.execute(visitQuery)
-            visitQuery = "CALL sp_iitml_get_visits(%s)"
-            visitCursor.execute(visitQuery, (patientPK, ))
-            # Fetch all rows from the executed query
-            visitRows = visitCursor.fetchall()
-            # Create a DataFrame from the fetched rows
-            if not visitRows:
-                visits = pd.DataFrame(columns=[column[0] for column in visitCursor.description])
-            else:
-                # Create a DataFrame from the fetched rows
-                visits = pd.DataFrame(
-                    visitRows, columns=[column[0] for column in visitCursor.description]
-                )
-
+        executor = get_fetch_executor()
     except Error as e:
         print(f"MySQL Error: {e}")
-
-    finally:
-        if 'connection' in locals() and connection.is_connected():
-            visitCursor.close()
-            connection.close()
-            print("Mysql Connection closed.")
-
+        return None, None, None, None
+    futures = _submit_patient(executor, patientPK, since)
+    frames = _collect(futures, time.monotonic() + timeout, timeout)
+
+    return frames["lab"], frames["pharmacy"], frames["visits"], frames["dem"]
+
+def get_batch_inference_data_mysql(patients, since=None):
+    """
+    Fetch lab, pharmacy, visits and demographics for many patients. The
+    procedures are per patient, so every patient's four calls are queued at
+    once and run concurrently on the pooled connections, rather than one
+    patient after another. The queries queue for the connections, so the
+    batch is allowed one "mysql_query_timeout" per round of pool_size queries.
+
+    Args:
+        patients (list): (ppk, sc) pairs.
+        since (str): Earliest encounter date to fetch, see history_since.
+
+    Returns:
+        tuple: (lab, pharmacy, visits, dem), each the rows of every patient
+        whose query succeeded (an empty DataFrame if none did).
+    """
+    timeout = float(load_settings().get("mysql_query_timeout", 30))
+    tables = {name: [] for name in PROCEDURES}
     try:
-        # connection = mysql.connector.connect(
-        #     host=config["mysql_url"],
-        #     port=int(config["mysql_port"]),
-        #     database=config["mysql_database"],
-        #     user=config["mysql_username"],
-        #     password=config["mysql_password"]
-        # )
-
-        connection = mysql_connect()
-
-        if connection.is_connected():
-            print("Connected to MySQL For Inference 1 - Demographics")
-
-            demCursor = connection.cursor(dictionary=True)
-
-            # Dem (Demographics) Table
-            print("Demographics Table: ")
-            demQuery = "CALL sp_iitml_get_patient_demographics(%s)"
-            demCursor.execute(demQuery, (patientPK, ))
-            # Fetch all rows from the executed query
-            demRows = demCursor.fetchall()
-            # Create a DataFrame from the fetched rows
-            if not demRows:
-                dem = pd.DataFrame(columns=[column[0] for column in demCursor.description])
-            else:
-                # Create a DataFrame from the fetched rows
-                dem = pd.DataFrame(demRows, columns=[column[0] for column in demCursor.description])
-
+        executor = get_fetch_executor()
     except Error as e:
         print(f"MySQL Error: {e}")
-
-    finally:
-        if 'connection' in locals() and connection.is_connected():
-            demCursor.close()
-            connection.close()
-            print("Mysql Connection closed.")
-
-    return lab, pharmacy, visits, dem
-
-def get_inference_data_sqlite(patientPK=None, sitecode=None):
+        return tuple(pd.DataFrame() for _ in tables)
+    submitted = [_submit_patient(executor, ppk, since) for ppk, _ in patients]
+    rounds = max(1, -(-len(PROCEDURES) * len(patients) // _pool.pool_size))
+    deadline = time.monotonic() + timeout * rounds
+    for futures in submitted:
+        for name, df in _collect(futures, deadline, timeout).items():
+            if df is not None:
+                tables[name].append(df)
+
+    return tuple(
+        pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+        for dfs in tables.values()
+    )
+
+def get_inference_data_sqlite(patientPK=None, sitecode=None, since=None):
 
     # Initialize variables to None
     pharmacy = lab = visits = dem = None
@@ -206,61 +353,48 @@ def get_inference_data_sqlite(patientPK=None, sitecode=None):
     connection = sqlite3.connect("./data/iit_test.sqlite")
     # Create a cursor object to interact with the database
     cursor = connection.cursor()
-    # Define the SQL query to fetch data from the 'lab' table
-    query = "SELECT * FROM lab WHERE PatientPKHash = ? AND SiteCode = ?"
-    # Execute the query with parameters
-    cursor.execute(query, (patientPK, sitecode))
-    # Fetch all rows from the executed query
-    rows = cursor.fetchall()
-    # Create a DataFrame from the fetched rows
-    # if rows is empty, return empty DataFrame, set lab to an empty dataframe
-    if not rows:
-        lab = pd.DataFrame(columns=[column[0] for column in cursor.description])
-    else:
-        # Create a DataFrame from the fetched rows
-        lab = pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
 
-    # Define the SQL query to fetch data from the 'pharmacy' table
-    query = "SELECT * FROM pharmacy WHERE PatientPKHash = ? AND SiteCode = ?"
-    # Execute the query with parameters
-    cursor.execute(query, (patientPK, sitecode))
-    # Fetch all rows from the executed query
-    rows = cursor.fetchall()
-    # Create a DataFrame from the fetched rows
-    if not rows:
-        pharmacy = pd.DataFrame(columns=[column[0] for column in cursor.description])
-    else:
-        # Create a DataFrame from the fetched rows
-        pharmacy = pd.DataFrame(
-            rows, columns=[column[0] for column in cursor.description]
-        )
-
-    # Define the SQL query to fetch data from the 'visits' table
-    query = "SELECT * FROM visits WHERE PatientPKHash = ? AND SiteCode = ?"
-    # Execute the query with parameters
-    cursor.execute(query, (patientPK, sitecode))
-    # Fetch all rows from the executed query
-    rows = cursor.fetchall()
-    # Create a DataFrame from the fetched rows
-    if not rows:
-        visits = pd.DataFrame(columns=[column[0] for column in cursor.description])
-    else:
-        # Create a DataFrame from the fetched rows
-        visits = pd.DataFrame(
-            rows, columns=[column[0] for column in cursor.description]
-        )
-
-    # Define the SQL query to fetch data from the 'dem' table
-    # Execute the query with parameters
-    query = "SELECT * FROM dem WHERE PatientPKHash = ? AND MFLCode = ?"
-    cursor.execute(query, (patientPK, sitecode))
-    # Fetch all rows from the executed query
-    rows = cursor.fetchall()
-    # Create a DataFrame from the fetched rows
-    if not rows:
-        dem = pd.DataFrame(columns=[column[0] for column in cursor.description])
-    else:
+    def fetch(query, params, date_column=None):
+        # skip encounters before since in the query itself; ISO date strings
+        # compare in date order
+        if since is not None and date_column is not None:
+            query += f" AND {date_column} >= ?"
+            params = params + (since, )
+        # Execute the query with parameters
+        cursor.execute(query, params)
+        # Fetch all rows from the executed query
+        rows = cursor.fetchall()
         # Create a DataFrame from the fetched rows
-        dem = pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
+        # if rows is empty, return empty DataFrame with the table's columns
+        if not rows:
+            return pd.DataFrame(columns=[column[0] for column in cursor.description])
+        return pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
+
+    # only the columns the cleaning stages read are selected;
+    # lab, pharmacy and visits are filtered by their encounter date
+    lab = fetch(
+        helpers.select_query(cursor, "lab", clean_data.LAB_COLUMNS)
+        + " WHERE PatientPKHash = ? AND SiteCode = ?",
+        (patientPK, sitecode),
+        "OrderedbyDate",
+    )
+    pharmacy = fetch(
+        helpers.select_query(cursor, "pharmacy", clean_data.PHARMACY_COLUMNS)
+        + " WHERE PatientPKHash = ? AND SiteCode = ?",
+        (patientPK, sitecode),
+        "DispenseDate",
+    )
+    visits = fetch(
+        helpers.select_query(cursor, "visits", clean_data.VISIT_COLUMNS)
+        + " WHERE PatientPKHash = ? AND SiteCode = ?",
+        (patientPK, sitecode),
+        "VisitDate",
+    )
+    # the dem table is keyed by MFLCode rather than SiteCode
+    dem = fetch(
+        helpers.select_query(cursor, "dem", clean_data.DEM_COLUMNS)
+        + " WHERE PatientPKHash = ? AND MFLCode = ?",
+        (patientPK, sitecode),
+    )
 
     return lab, pharmacy, visits, dem
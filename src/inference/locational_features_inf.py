@@ -1,14 +1,69 @@
+import os
+import threading
 import pandas as pd
 
-def get_locational_features(targets_df):
+LOCATIONAL_FILE = "data/locational_variables_latest.csv"
 
-    # read in locational_variables_latest.csv from the data folder
-    loc_df = pd.read_csv("data/locational_variables_latest.csv")
+# parsed tables by path, with the file mtime they were read at
+_tables = {}
+_lock = threading.Lock()
 
-    # make sure sitecode is a string in both targets_df and loc_df
-    targets_df["sitecode"] = targets_df["sitecode"].astype(str)
+
+def load_locational_table(path=LOCATIONAL_FILE):
+    """
+    Parse the locational features CSV into a table indexed by sitecode (as a
+    string), so sites can be looked up without a merge.
+
+    Args:
+        path (str): Path to the locational features CSV.
+
+    Returns:
+        pd.DataFrame: Locational features indexed by sitecode.
+    """
+    loc_df = pd.read_csv(path, dtype={"sitecode": str})
+    return index_locational_table(loc_df)
+
+
+def index_locational_table(loc_df):
+    # make sure sitecode is a string and use it as the index, keeping
+    # the first row if a site appears more than once
+    loc_df = loc_df.copy()
     loc_df["sitecode"] = loc_df["sitecode"].astype(str)
-    # now merge the locational features with the targets_df by sitecode
-    targets_df = targets_df.merge(loc_df, on="sitecode", how="left")
+    loc_df = loc_df.drop_duplicates(subset="sitecode", keep="first")
+    return loc_df.set_index("sitecode")
+
+
+def get_locational_table(path=LOCATIONAL_FILE):
+    """
+    Return the parsed locational table for path, re-reading the CSV only
+    when its modification time has changed since it was last parsed.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        cached = _tables.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    table = load_locational_table(path)
+    with _lock:
+        _tables[path] = (mtime, table)
+    return table
+
+
+def get_locational_features(targets_df, loc_df=None):
+
+    # use the sitecode-indexed table from the model bundle being scored with,
+    # or the locational_variables_latest.csv from the data folder
+    if loc_df is None:
+        loc_df = get_locational_table()
+    elif loc_df.index.name != "sitecode":
+        loc_df = index_locational_table(loc_df)
+
+    # make sure sitecode is a string in targets_df
+    targets_df["sitecode"] = targets_df["sitecode"].astype(str)
+    # look up each target's site and line the features up with targets_df;
+    # sites without locational features get missing values, as a left join would
+    features = loc_df.reindex(targets_df["sitecode"].values)
+    features.index = targets_df.index
+    targets_df = pd.concat([targets_df, features], axis=1).reset_index(drop=True)
 
     return targets_df
@@ -0,0 +1,348 @@
+import os
+import json
+import pickle
+import shutil
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from src.inference import locational_features_inf
+from src.common import site_activity as site_activity_index
+
+MODELS_DIR = "models"
+BUNDLE_MANIFEST = "models/bundle_latest.json"
+LOCATIONAL_FILE = locational_features_inf.LOCATIONAL_FILE
+SITE_ACTIVITY_FILE = site_activity_index.SITE_ACTIVITY_FILE
+
+# keys every bundle manifest must provide, each pointing at an artifact file
+BUNDLE_KEYS = ["model", "encoder", "feature_order", "site_thresholds", "locational"]
+# keys a manifest may leave out; bundles published before the site activity
+# index existed do not have one
+OPTIONAL_BUNDLE_KEYS = ["site_activity"]
+
+# process-wide snapshot of the loaded artifacts, guarded by _lock
+_artifacts = None
+_lock = threading.Lock()
+
+# background watcher that swaps in new bundles
+_watcher = None
+_stop_watcher = threading.Event()
+
+
+@dataclass(frozen=True)
+class ModelArtifacts:
+    """
+    Immutable snapshot of everything needed to score a patient.
+
+    Attributes:
+        version (str): Bundle version (training timestamp) or "latest" for legacy files.
+        ohe (OneHotEncoder): The fitted one-hot encoder.
+        feature_order (tuple): The column order the booster was trained on.
+        booster (xgb.Booster): The trained model.
+        site_thresholds (Mapping): Site code -> {"high", "medium"} thresholds.
+        locational_path (str): Path to the locational features CSV.
+        site_activity_path (str): Path to the site activity CSV, or None.
+    """
+
+    version: str
+    ohe: object
+    feature_order: tuple
+    booster: xgb.Booster
+    site_thresholds: MappingProxyType
+    locational_path: str
+    site_activity_path: str = None
+
+    @property
+    def locational(self):
+        """
+        Locational features indexed by sitecode. The parsed table is shared
+        between requests and only re-read when the CSV changes.
+        """
+        return locational_features_inf.get_locational_table(self.locational_path)
+
+    @property
+    def site_activity(self):
+        """
+        Latest visitdate of each sitecode, as written by retraining. Empty if
+        the bundle has no site activity index.
+        """
+        if self.site_activity_path is None:
+            return site_activity_index.empty_site_activity()
+        return site_activity_index.get_site_activity(self.site_activity_path)
+
+    @property
+    def data_version(self):
+        """
+        Modification times of the locational and site activity CSVs, which
+        change when either is replaced without a new bundle version.
+        """
+        return tuple(
+            os.stat(path).st_mtime_ns if path and os.path.isfile(path) else None
+            for path in (self.locational_path, self.site_activity_path)
+        )
+
+
+def _require(path, what):
+    # Check if the artifact file exists
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{what} file {path} not found. Please train the model first."
+        )
+    return path
+
+
+def _load(version, model, encoder, feature_order, site_thresholds, locational, site_activity=None):
+    with open(_require(encoder, "Encoder"), "rb") as f:
+        ohe = pickle.load(f)
+
+    with open(_require(feature_order, "Feature order"), "rb") as f:
+        feature_order = tuple(pickle.load(f))
+
+    bst = xgb.Booster()
+    bst.load_model(_require(model, "Model"))
+
+    with open(_require(site_thresholds, "Thresholds"), "rb") as f:
+        site_thresholds = MappingProxyType(pickle.load(f))
+
+    # parse the locational table and site activity index now, so a bad CSV
+    # rejects the bundle
+    locational_features_inf.get_locational_table(_require(locational, "Locational features"))
+    if site_activity is not None:
+        site_activity_index.get_site_activity(site_activity)
+
+    return ModelArtifacts(
+        version=version,
+        ohe=ohe,
+        feature_order=feature_order,
+        booster=bst,
+        site_thresholds=site_thresholds,
+        locational_path=locational,
+        site_activity_path=site_activity,
+    )
+
+
+def read_manifest(path=BUNDLE_MANIFEST):
+    """
+    Read a bundle manifest written by refresh_model.
+
+    Args:
+        path (str): Path to the manifest JSON.
+
+    Returns:
+        dict: The manifest, with a "version" and one path per artifact.
+    """
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    missing = [k for k in ["version"] + BUNDLE_KEYS if k not in manifest]
+    if missing:
+        raise ValueError(f"Bundle manifest {path} is missing {missing}")
+    return manifest
+
+
+def publish_bundle(timestamp, locational=LOCATIONAL_FILE, site_activity_file=SITE_ACTIVITY_FILE):
+    """
+    Write a manifest listing the artifacts saved under this timestamp and
+    atomically make it the bundle served by the inference API. The
+    locational and site activity CSVs are copied to timestamped files first,
+    so refreshing the *_latest CSVs later does not change a published bundle.
+
+    Args:
+        timestamp (str): The timestamp used in the artifact file names.
+        locational (str): Path to the locational features CSV for this bundle.
+        site_activity_file (str): Path to the site activity CSV for this
+            bundle; left out of the manifest if it does not exist.
+
+    Returns:
+        dict: The manifest that was published.
+    """
+    bundle_locational = f"{MODELS_DIR}/locational_variables_{timestamp}.csv"
+    shutil.copyfile(locational, bundle_locational)
+
+    manifest = {
+        "version": timestamp,
+        "model": f"{MODELS_DIR}/mod_{timestamp}.json",
+        "encoder": f"{MODELS_DIR}/ohe_{timestamp}.pkl",
+        "feature_order": f"{MODELS_DIR}/feature_order_{timestamp}.pkl",
+        "site_thresholds": f"{MODELS_DIR}/site_thresholds_{timestamp}.pkl",
+        "locational": bundle_locational,
+    }
+    if os.path.isfile(site_activity_file):
+        manifest["site_activity"] = f"{MODELS_DIR}/site_activity_{timestamp}.csv"
+        shutil.copyfile(site_activity_file, manifest["site_activity"])
+    with open(f"{MODELS_DIR}/bundle_{timestamp}.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    # write to a temporary file then rename over bundle_latest.json, so the
+    # API never reads a half-written manifest
+    tmp_file = f"{BUNDLE_MANIFEST}.tmp"
+    shutil.copyfile(f"{MODELS_DIR}/bundle_{timestamp}.json", tmp_file)
+    os.replace(tmp_file, BUNDLE_MANIFEST)
+
+    return manifest
+
+
+def load_bundle(manifest):
+    """
+    Load every artifact listed in a bundle manifest.
+
+    Args:
+        manifest (dict): A manifest as returned by read_manifest.
+
+    Returns:
+        ModelArtifacts: A freshly loaded snapshot.
+    """
+    return _load(
+        version=str(manifest["version"]),
+        **{k: manifest[k] for k in BUNDLE_KEYS},
+        **{k: manifest[k] for k in OPTIONAL_BUNDLE_KEYS if k in manifest},
+    )
+
+
+def load_artifacts(models_dir=MODELS_DIR):
+    """
+    Read the legacy *_latest encoder, feature order, model and site thresholds
+    from disk, for deployments that mount individual files rather than a bundle.
+
+    Args:
+        models_dir (str): Directory holding the *_latest artifacts.
+
+    Returns:
+        ModelArtifacts: A freshly loaded snapshot.
+    """
+    return _load(
+        version="latest",
+        model=os.path.join(models_dir, "mod_latest.json"),
+        encoder=os.path.join(models_dir, "ohe_latest.pkl"),
+        feature_order=os.path.join(models_dir, "feature_order.pkl"),
+        site_thresholds=os.path.join(models_dir, "site_thresholds_latest.pkl"),
+        locational=LOCATIONAL_FILE,
+        site_activity=SITE_ACTIVITY_FILE,
+    )
+
+
+def warm_up(artifacts):
+    """
+    Score one dummy row to make sure the encoder, feature order and booster in
+    a bundle belong together before it is allowed to serve requests.
+
+    Args:
+        artifacts (ModelArtifacts): The snapshot to check.
+
+    Raises:
+        ValueError: If the artifacts are inconsistent or the prediction is invalid.
+    """
+    features = [c for c in artifacts.feature_order if c != "iit"]
+
+    # encoded columns produced by the encoder must all be part of the feature order
+    if hasattr(artifacts.ohe, "feature_names_in_"):
+        encoded = set(artifacts.ohe.get_feature_names_out())
+        unknown = encoded - set(features)
+        if unknown:
+            raise ValueError(f"Encoder columns not in feature order: {sorted(unknown)[:5]}")
+
+    # the booster must have been trained on the same features
+    if artifacts.booster.feature_names is not None and list(
+        artifacts.booster.feature_names
+    ) != features:
+        raise ValueError("Booster feature names do not match feature order")
+
+    dummy = pd.DataFrame(np.zeros((1, len(features))), columns=features)
+    pred = artifacts.booster.predict(xgb.DMatrix(data=dummy))
+    if pred.shape[0] != 1 or not (0.0 <= float(pred[0]) <= 1.0):
+        raise ValueError(f"Warm-up prediction is not a probability: {pred}")
+
+
+def _swap(artifacts):
+    global _artifacts
+    with _lock:
+        _artifacts = artifacts
+
+
+def init_registry(models_dir=MODELS_DIR, manifest_path=BUNDLE_MANIFEST):
+    """
+    Load the artifacts once and make them the process-wide snapshot.
+    Prefers the bundle manifest and falls back to the legacy *_latest files.
+    Called at API startup.
+    """
+    if os.path.exists(manifest_path):
+        artifacts = load_bundle(read_manifest(manifest_path))
+    else:
+        artifacts = load_artifacts(models_dir)
+    warm_up(artifacts)
+    _swap(artifacts)
+    return artifacts
+
+
+def refresh_registry(manifest_path=BUNDLE_MANIFEST):
+    """
+    Swap in the bundle named by the manifest if its version differs from the
+    one being served. The new bundle is fully loaded and warmed up before the
+    swap, so requests in flight keep their old snapshot and new requests see
+    either the old bundle or the new one, never a mix.
+
+    Returns:
+        bool: True if a new bundle was swapped in.
+    """
+    if not os.path.exists(manifest_path):
+        return False
+    try:
+        manifest = read_manifest(manifest_path)
+        current = _artifacts
+        if current is not None and current.version == str(manifest["version"]):
+            return False
+        artifacts = load_bundle(manifest)
+        warm_up(artifacts)
+    except Exception as e:
+        print(f"❌ Rejected model bundle from {manifest_path}: {e}")
+        return False
+    _swap(artifacts)
+    print(f"Model bundle {artifacts.version} is now serving.")
+    return True
+
+
+def start_watcher(interval=30, manifest_path=BUNDLE_MANIFEST):
+    """
+    Poll the bundle manifest in a daemon thread and hot-swap new bundles.
+
+    Args:
+        interval (int): Seconds between checks of the manifest.
+        manifest_path (str): Path to the manifest to watch.
+    """
+    global _watcher
+
+    def watch():
+        last_mtime = None
+        while not _stop_watcher.wait(interval):
+            try:
+                mtime = os.stat(manifest_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if mtime != last_mtime:
+                last_mtime = mtime
+                refresh_registry(manifest_path)
+
+    _stop_watcher.clear()
+    _watcher = threading.Thread(target=watch, name="bundle-watcher", daemon=True)
+    _watcher.start()
+
+
+def stop_watcher():
+    """Stop the bundle watcher started by start_watcher."""
+    global _watcher
+    _stop_watcher.set()
+    if _watcher is not None:
+        _watcher.join()
+        _watcher = None
+
+
+def get_artifacts():
+    """
+    Return the current artifact snapshot, loading it on first use if the
+    registry was not initialised at startup (e.g. when running the pipeline
+    from the command line).
+    """
+    if _artifacts is None:
+        init_registry()
+    return _artifacts
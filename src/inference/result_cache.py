@@ -0,0 +1,90 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+from datetime import date
+
+# how many patients' predictions are kept, and for how long (seconds)
+MAX_ENTRIES = 5000
+TTL_SECONDS = 6 * 60 * 60
+
+# newest encounter date column of each raw table, by table position
+# in the (lab, pharmacy, visits, dem) tuple returned by the data fetch
+ENCOUNTER_DATES = {0: "orderedbydate", 1: "dispensedate", 2: "visitdate"}
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+def fingerprint(lab, pharmacy, visits, dem):
+    """
+    Summarise the raw patient tables by their latest lab, dispense and visit
+    dates and their row counts. This is the default fingerprint, used unless
+    a fingerprint query is configured (get_inference_data.get_data_fingerprint)
+    and succeeds: the tables have been fetched already, but the cleaning,
+    feature and scoring stages can still be skipped.
+
+    Returns:
+        tuple: Hashable summary that changes when a new encounter is recorded,
+        or None if any table could not be fetched.
+    """
+    tables = (lab, pharmacy, visits, dem)
+    if any(df is None for df in tables):
+        return None
+    summary = []
+    for i, df in enumerate(tables):
+        latest = None
+        if i in ENCOUNTER_DATES and not df.empty:
+            cols = {c.lower(): c for c in df.columns}
+            col = cols.get(ENCOUNTER_DATES[i])
+            if col is not None:
+                # raw dates are yyyy-mm-dd strings or datetimes; compare them as text
+                dates = df[col].dropna().astype(str)
+                latest = dates.max() if not dates.empty else None
+        summary.append((len(df), latest))
+    return tuple(summary)
+
+
+def get(key, stamp):
+    """
+    Return the cached prediction for key if it was computed from data with the
+    same fingerprint, today, and within the TTL; otherwise None.
+
+    Args:
+        key (tuple): (ppk, sc, start_date, end_date, bundle version, data
+            version).
+        stamp (tuple): Current fingerprint of the patient's records.
+    """
+    if stamp is None:
+        return None
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        stored_stamp, stored_day, stored_at, pred = entry
+        if (
+            stored_stamp != stamp
+            or stored_day != date.today()
+            or time.monotonic() - stored_at > TTL_SECONDS
+        ):
+            del _entries[key]
+            return None
+        _entries.move_to_end(key)
+        return copy.deepcopy(pred)
+
+
+def put(key, stamp, pred):
+    """Cache a prediction, evicting the least recently used entry when full."""
+    if stamp is None:
+        return
+    with _lock:
+        _entries[key] = (stamp, date.today(), time.monotonic(), copy.deepcopy(pred))
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def clear():
+    """Drop every cached prediction."""
+    with _lock:
+        _entries.clear()
@@ -8,6 +8,7 @@ import pandas as pd
 import pickle
 import shutil
 from src.common.feature_dtypes import expected_dtypes
+from src.inference.model_registry import publish_bundle
 
 
 def refresh_model(pipeline=False, targets_df=None, targets_aws=None, refresh_date=str):
@@ -136,8 +137,9 @@ def refresh_model(pipeline=False, targets_df=None, targets_aws=None, refresh_dat
 
         feature_order = list(final_df.columns)
         if save_feature_order:
-            with open("models/feature_order.pkl", "wb") as f:
+            with open(f"models/feature_order_{timestamp}.pkl", "wb") as f:
                 pickle.dump(feature_order, f)
+            shutil.copyfile(f"models/feature_order_{timestamp}.pkl", "models/feature_order.pkl")
 
         # convert to xgb.Dmatrix
         xgb_df = xgb.DMatrix(data=final_df.drop(columns=["iit"]), label=final_df["iit"])
@@ -249,6 +251,10 @@ def refresh_model(pipeline=False, targets_df=None, targets_aws=None, refresh_dat
         pickle.dump(thresholds, f)
     shutil.copyfile(f"models/thresholds_{timestamp}.pkl", "models/thresholds_latest.pkl")
 
+    # publish all artifacts from this run as one bundle; the API swaps to it
+    # in a single step rather than picking up the *_latest copies one at a time
+    publish_bundle(timestamp)
+
 
 if __name__ == "__main__":
     refresh_model(
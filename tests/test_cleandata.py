@@ -231,3 +231,197 @@ def test_parse_long_date():
 
     # Test None
     assert parse_long_date(None) is None, "None value not handled correctly"
+
+
+def test_parse_long_dates_matches_parse_long_date():
+    from datetime import date
+    from src.common import helpers
+
+    values = pd.Series(
+        ["2021-01-05", "2021-01-05 10:30:00", "2021-1-5", "bad", "", None, date(2022, 3, 1)],
+        dtype=object,
+    )
+    parsed = helpers.parse_long_dates(values)
+    assert str(parsed.dtype).startswith("datetime64")
+    expected = [helpers.parse_long_date(v) for v in values]
+    assert [None if pd.isna(p) else p.date() for p in parsed] == expected
+
+
+def test_normalize_strings_only_touches_strings():
+    import numpy as np
+    from src.common import helpers
+
+    df = pd.DataFrame(
+        {
+            "key": [" ABC13074 ", "ABC13074"],
+            "visittype": [" Scheduled ", None],
+            "whostage": pd.Series([1, np.nan], dtype=object),
+            "adherence": ["GOOD", np.nan],
+        }
+    )
+    out = helpers.normalize_strings(df.copy(), keep_case=("key",))
+    assert out["key"].tolist() == ["ABC13074", "ABC13074"]
+    assert out["visittype"].tolist() == ["scheduled", None]
+    # numeric-only object columns become numeric, as with applymap
+    assert out["whostage"].dtype == float
+    assert out["adherence"].iloc[0] == "good"
+    assert isinstance(out["adherence"].iloc[1], float)
+
+
+def test_clean_lab_drops_unused_columns():
+    data = pd.DataFrame(
+        {
+            "PatientPKHash": ["A"],
+            "SiteCode": [13074],
+            "OrderedbyDate": ["2024-01-01"],
+            "TestName": ["Viral Load"],
+            "TestResult": ["LDL"],
+            "Comments": ["not used"],
+        }
+    )
+    cleaned = clean_lab(data, start_date="2023-01-01")
+    assert "comments" not in cleaned.columns
+    assert len(cleaned) == 1
+
+
+def test_map_distinct_runs_rule_once_per_value():
+    import numpy as np
+    from src.common import helpers
+
+    calls = []
+
+    def rule(vec):
+        calls.append(len(vec))
+        return np.array(["none" if x is None else str(x) for x in vec], dtype=object)
+
+    s = pd.Series(["a", "b", "a", None, np.nan, "b"])
+    out = helpers.map_distinct(s, rule)
+    # two distinct strings plus the None and NaN stand-ins
+    assert calls == [4]
+    assert list(out) == ["a", "b", "a", "none", "nan", "b"]
+
+
+def test_dedup_lab_keeps_single_and_agreeing_results():
+    from src.common import helpers
+
+    data = pd.DataFrame(
+        {
+            "key": ["A", "B", "B", "C", "C", "D", "D", "E"],
+            "orderedbydate": pd.to_datetime(["2021-01-01"] * 8),
+            "testname": ["VL", "VL", "VL", "VL", "VL", "VL", "VL", "CD4"],
+            "testresult": ["LDL", "50", "1000", "100", "150", "LDL", "300", "n/a"],
+        }
+    )
+    out = helpers.dedup_lab(data, "key", "orderedbydate", "testname", "testresult")
+    # A is a single lab; B disagrees and is dropped; D has one numeric
+    # result, kept after the singles; C agrees, kept last; E's CD4 is not a number
+    assert out["key"].tolist() == ["A", "D", "C", "C"]
+    assert out["testresultcat"].tolist() == [
+        "suppressed",
+        "nonsuppressed",
+        "suppressed",
+        "suppressed",
+    ]
+    assert list(out.columns) == ["key", "orderedbydate", "testname", "testresultcat"]
+
+
+def test_dedup_lab_repeated_and_non_numeric_results():
+    from src.common import helpers
+
+    data = pd.DataFrame(
+        {
+            "key": list("AAABBBCCCDDEEEFFGGH"),
+            "orderedbydate": pd.to_datetime(
+                ["2021-01-01"] * 2 + ["2021-06-01"] + ["2021-01-01"] * 3 + ["2021-02-01"] * 3
+                + ["2021-03-01"] * 2 + ["2021-04-01"] * 2 + ["2021-05-01"] * 3 + ["2021-07-01"] * 2
+                + ["2021-08-01"]
+            ),
+            "testname": ["VL", "CD4", "VL"] + ["VL"] * 3 + ["CD4"] * 3 + ["VL"] * 2
+            + ["CD4"] * 2 + ["VL"] * 3 + ["CD4", "VL", "CD4"],
+            "testresult": [
+                "LDL", "150", "199", "200", "5000", "LDL", "350", "n/a", "420", "< 40", "1.5e3",
+                "199.9", "200", None, "0", "12", "", "40.0", "x",
+            ],
+        }
+    )
+    out = helpers.dedup_lab(data, "key", "orderedbydate", "testname", "testresult")
+    # B's VLs disagree and E's CD4s straddle 200, so both are dropped; C
+    # keeps both numeric CD4s, H's CD4 is not a number
+    assert out["key"].tolist() == ["A", "A", "A", "E", "G", "D", "C", "C", "F", "F"]
+    assert out["orderedbydate"].dt.strftime("%m-%d").tolist() == [
+        "01-01", "01-01", "06-01", "05-01", "07-01", "03-01", "02-01", "02-01", "05-01", "05-01",
+    ]
+    assert out["testname"].tolist() == ["VL", "CD4", "VL", "VL", "VL", "VL", "CD4", "CD4", "VL", "VL"]
+    assert out["testresultcat"].tolist() == [
+        "suppressed", "NoAHD", "suppressed", "suppressed", "suppressed",
+        "nonsuppressed", "YesAHD", "YesAHD", "suppressed", "suppressed",
+    ]
+
+
+def test_impute_date_uses_next_visit_interval():
+    from src.common import helpers
+
+    data = pd.DataFrame(
+        {
+            "key": ["A", "A", "A", "B"],
+            "visitdate": pd.to_datetime(
+                ["2021-01-01", "2021-03-01", "2021-06-01", "2021-01-01"]
+            ),
+            "nextappointmentdate": pd.to_datetime(
+                [None, "2021-06-01", "2021-07-01", None]
+            ),
+        }
+    )
+    out = helpers.impute_date(data, "key", "visitdate", "nextappointmentdate")
+    # rows run from each patient's latest visit back; A's first visit takes
+    # the 90-day group of the visit after it, B's only visit falls back to 30
+    assert out["prev_days_between_group"].tolist() == [30, 30, 90, 30]
+    assert out["nad_imputed"].tolist() == list(
+        pd.to_datetime(["2021-07-01", "2021-06-01", "2021-04-01", "2021-01-31"])
+    )
+    assert out["nad_imputation_flag"].tolist() == [0, 0, 1, 1]
+
+
+def test_remove_and_impute_date_around_interval_boundaries():
+    from src.common import helpers
+
+    # return dates on either side of each interval boundary, out of range,
+    # missing and unparseable, for patients with one to six visits
+    data = pd.DataFrame(
+        {
+            "key": ["A"] * 6 + ["B"] * 4 + ["C"] + ["D"] * 3,
+            "visitdate": [
+                "2021-01-01", "2021-02-14", "2021-04-30", "2021-08-12", "2022-01-09", "2022-07-28",
+                "2021-03-01", "2021-03-02", "2021-06-30", "2022-07-01",
+                "2021-05-05",
+                "2021-01-10", "2021-04-20", "not a date",
+            ],
+            "nextappointmentdate": [
+                "2021-02-14", "2021-04-30", "2021-08-12", "2022-01-09", "2022-07-28", None,
+                "2021-03-01", "2021-06-30", "2022-07-01", "2022-12-28",
+                None,
+                "2021-04-19", "bad", "2021-06-01",
+            ],
+        }
+    )
+    data = helpers.remove_date(data, "visitdate", "nextappointmentdate")
+    out = helpers.impute_date(data, "key", "visitdate", "nextappointmentdate")
+    # each patient's rows run from their latest visit back, keeping their index
+    assert out.index.tolist() == [5, 4, 3, 2, 1, 0, 9, 8, 7, 6, 10, 12, 11, 13]
+    assert out["key"].tolist() == data["key"].tolist()
+    assert out["visitdate"].isna().tolist() == [False] * 13 + [True]
+    # return dates on or before the visit, more than a year after it or
+    # unparseable are removed
+    assert out["nextappointmentdate"].isna().tolist() == [
+        True, False, False, False, False, False, False, True, False, True, True, True, False, False,
+    ]
+    assert out["prev_days_between_group"].tolist() == [30, 30, 30, 180, 90, 90, 30, 180, 30, 120, 30, 30, 30, 90]
+    assert out["nad_imputed"].tolist() == list(
+        pd.to_datetime([
+            "2022-08-27", "2022-07-28", "2022-01-09", "2021-08-12", "2021-04-30", "2021-02-14",
+            "2022-12-28", "2021-12-27", "2021-06-30", "2021-06-29",
+            "2021-06-04",
+            "2021-05-20", "2021-04-19", "2021-06-01",
+        ])
+    )
+    assert out["nad_imputation_flag"].tolist() == [1, 0, 0, 0, 0, 0, 0, 1, 0, 1, 1, 1, 0, 0]
@@ -1,5 +1,6 @@
 import pandas as pd
 from src.common.create_target import create_target
+from src.common import site_activity
 
 
 def test_create_target_minimal():
@@ -156,3 +157,169 @@ def test_create_target_unresolved_outcome():
     result = create_target(visits, pharmacy, dem)
     # Should be empty because outcome is unresolved
     assert result.empty
+
+
+def test_create_target_merges_same_day_rows_and_fixes_out_of_order_nad():
+    visits = pd.DataFrame(
+        {
+            "key": ["A", "A", "A"],
+            "visitdate": pd.to_datetime(["2022-01-01", "2022-02-01", "2022-06-01"]),
+            "nad_imputed": pd.to_datetime([None, "2022-03-01", "2022-07-01"]),
+            "nad_imputation_flag": [0, 0, 0],
+            "sitecode": ["001", "001", "001"],
+        }
+    )
+    pharmacy = pd.DataFrame(
+        {
+            "key": ["A", "B"],
+            "dispensedate": pd.to_datetime(["2022-01-01", "2022-01-01"]),
+            "nad_imputed": pd.to_datetime(["2022-04-01", "2022-02-01"]),
+            "nad_imputation_flag": [1, 0],
+            "sitecode": ["001", "001"],
+        }
+    )
+    dem = pd.DataFrame({"key": ["A", "B"], "artoutcomedescription": ["active", "active"]})
+    result = create_target(visits, pharmacy, dem)
+    # B only has a pharmacy visit; A's visits come latest first, and A's
+    # most recent visit is unresolved
+    assert result["visitdate"].tolist() == list(pd.to_datetime(["2022-02-01", "2022-01-01"]))
+    # the same-day clinical row has no nad, so the pharmacy row's nad fills it
+    # in while the clinical row's flag is kept; the next nad is out of order
+    assert result["nad"].tolist() == list(pd.to_datetime(["2022-04-01", "2022-04-01"]))
+    assert result["nad_imputation_flag"].tolist() == [1, 0]
+    assert result["visitdiff"].tolist() == [61, -59]
+    assert result["iit"].tolist() == [1, 0]
+
+
+def test_create_target_over_sites_outcomes_and_unresolved_visits():
+    # visits and dispenses of patients at two sites, with same-day rows,
+    # missing and out-of-order nads, resolved and unresolved last visits,
+    # and outcomes that are and are not counted as iit
+    visits = pd.DataFrame(
+        {
+            "key": ["A"] * 4 + ["B"] * 3 + ["C"] * 2 + ["D"] + ["E"] * 2,
+            "visitdate": pd.to_datetime([
+                "2022-01-03", "2022-02-01", "2022-05-10", "2022-06-01", "2022-01-15", "2022-01-15",
+                "2022-09-20", "2022-03-01", "2022-04-01", "2022-02-10", "2022-05-05", "2022-08-01",
+            ]),
+            "nad_imputed": pd.to_datetime([
+                "2022-02-01", "2022-05-01", "2022-05-08", "2022-09-01", "2022-04-15", "2022-04-20",
+                "2022-12-20", "2022-04-01", "2022-07-01", None, "2022-08-01", "2022-11-01",
+            ]),
+            "nad_imputation_flag": [0, 1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0],
+            "sitecode": ["001"] * 4 + ["002"] * 3 + ["001"] * 2 + ["002"] + ["001"] * 2,
+        }
+    )
+    pharmacy = pd.DataFrame(
+        {
+            "key": ["A", "A", "B", "C", "D", "F"],
+            "dispensedate": pd.to_datetime(
+                ["2022-02-01", "2022-03-15", "2022-01-15", "2022-04-01", "2022-02-10", "2022-06-01"]
+            ),
+            "nad_imputed": pd.to_datetime(
+                ["2022-04-01", "2022-06-15", "2022-04-15", "2022-06-01", "2022-03-10", "2022-07-01"]
+            ),
+            "nad_imputation_flag": [0, 0, 1, 0, 0, 1],
+            "sitecode": ["001", "001", "002", "001", "002", "002"],
+        }
+    )
+    dem = pd.DataFrame(
+        {
+            "key": ["A", "B", "C", "D", "E", "F"],
+            "artoutcomedescription": ["active", "loss to follow up", "dead", "lost in hmis", "active", "transfer out"],
+        }
+    )
+    result = create_target(visits, pharmacy, dem)
+    assert result["key"].tolist() == ["A", "A", "A", "B", "C", "E", "D"]
+    assert result["visitdate"].tolist() == list(pd.to_datetime(
+        ["2022-05-10", "2022-02-01", "2022-01-03", "2022-01-15", "2022-03-01", "2022-05-05", "2022-02-10"]
+    ))
+    assert result["nad"].tolist() == list(pd.to_datetime(
+        ["2022-05-08", "2022-04-01", "2022-02-01", "2022-04-15", "2022-04-01", "2022-08-01", "2022-03-10"]
+    ))
+    assert result["nad_imputation_flag"].tolist() == [0] * 7
+    assert result["sitecode"].tolist() == ["001", "001", "001", "002", "001", "001", "002"]
+    # D's only visit has no next visit to measure against
+    assert result["visitdiff"].tolist()[:-1] == [24, 39, 0, 158, 0, 0]
+    assert pd.isna(result["visitdiff"].iloc[-1])
+    assert result["iit"].tolist() == [0, 1, 0, 1, 0, 0, 1]
+    assert list(result.columns) == ["key", "visitdate", "nad", "nad_imputation_flag", "sitecode", "visitdiff", "iit"]
+
+
+def site_visits():
+    visits = pd.DataFrame(
+        {
+            "key": ["A", "A"],
+            "visitdate": pd.to_datetime(["2022-01-01", "2022-02-01"]),
+            "nad_imputed": pd.to_datetime(["2022-02-01", "2022-03-01"]),
+            "nad_imputation_flag": [0, 0],
+            "sitecode": [13074, 13074],
+        }
+    )
+    pharmacy = visits.rename(columns={"visitdate": "dispensedate"}).iloc[:0]
+    dem = pd.DataFrame({"key": ["A"], "artoutcomedescription": ["active"]})
+    return visits, pharmacy, dem
+
+
+def test_create_target_looks_up_site_activity_index(tmp_path):
+    visits, pharmacy, dem = site_visits()
+
+    # on its own, the patient's most recent visit is unresolved
+    assert create_target(visits, pharmacy, dem.copy())["visitdate"].tolist() == [
+        pd.Timestamp("2022-01-01")
+    ]
+
+    # other patients were seen at the site long after the patient's nad, so
+    # the most recent visit resolves to iit
+    path = str(tmp_path / "site_activity.csv")
+    activity = site_activity.update_site_activity(
+        None, ["13074", "12905", None], pd.to_datetime(["2022-06-01", "2022-03-01", "2023-01-01"])
+    )
+    site_activity.save_site_activity(activity, path)
+    activity = site_activity.get_site_activity(path)
+    assert activity.to_dict() == {
+        "12905": pd.Timestamp("2022-03-01"),
+        "13074": pd.Timestamp("2022-06-01"),
+    }
+    result = create_target(visits, pharmacy, dem.copy(), activity)
+    assert result["visitdate"].tolist() == list(pd.to_datetime(["2022-01-01", "2022-02-01"]))
+    assert result["iit"].tolist() == [0, 1]
+
+    # site activity after end_date is not used
+    result = create_target(visits, pharmacy, dem.copy(), activity, end_date="2022-03-15")
+    assert result["visitdate"].tolist() == [pd.Timestamp("2022-01-01")]
+
+    # a site missing from the index is taken to be open until the patient's
+    # own most recent visit
+    result = create_target(visits, pharmacy, dem.copy(), site_activity.empty_site_activity())
+    assert result["visitdate"].tolist() == [pd.Timestamp("2022-01-01")]
+
+
+def test_retraining_labels_do_not_depend_on_saved_site_activity(tmp_path):
+    visits, pharmacy, dem = site_visits()
+    # a second patient keeps the site active until 2022-03-15, before A's
+    # most recent visit can be resolved
+    visits = pd.concat(
+        [visits, visits.iloc[[1]].assign(key="B", visitdate=pd.Timestamp("2022-03-15"))],
+        ignore_index=True,
+    )
+    dem = pd.DataFrame({"key": ["A", "B"], "artoutcomedescription": ["active", "active"]})
+    expected = create_target(visits, pharmacy, dem.copy(), end_date="2022-06-30")
+
+    path = str(tmp_path / "site_activity.csv")
+    saved = {
+        "later run": pd.to_datetime(["2024-01-01"]),
+        "earlier run": pd.to_datetime(["2021-01-01"]),
+        "inside the window": pd.to_datetime(["2022-06-01"]),
+    }
+    for visitdates in saved.values():
+        site_activity.save_site_activity(
+            site_activity.update_site_activity(None, ["13074"], visitdates), path
+        )
+        activity = site_activity.refresh_site_activity(visits["sitecode"], visits["visitdate"], path)
+        result = create_target(visits, pharmacy, dem.copy(), activity, end_date="2022-06-30")
+        pd.testing.assert_frame_equal(result, expected)
+        # the saved index still moves forward to the run's latest visit
+        assert site_activity.load_site_activity(path)["13074"] == max(
+            visitdates[0], pd.Timestamp("2022-03-15")
+        )
@@ -213,3 +213,28 @@ def test_prep_demographics_basic():
 
     # Check timeonart is non-negative
     assert (out["timeonart"] >= 0).all()
+
+
+def test_clean_dem_attributes_once_per_patient():
+    dem = pd.DataFrame(
+        {
+            "key": ["A", "B"],
+            "sex": [" Female ", "MALE"],
+            "maritalstatus": [" Married Polygamous", "SINGLE "],
+            "educationlevel": ["College", "unknown"],
+            "occupation": [" Trader", "null"],
+            "artoutcomedescription": ["Active ", None],
+            "startartdate": ["2020-01-01", None],
+            "dob": ["2015-01-01", "1990-01-01"],
+        }
+    )
+    dem = dem_features.clean_dem_attributes(dem)
+    assert dem["sex"].tolist() == ["female", "male"]
+    assert dem["maritalstatus"].tolist() == ["polygamous", "single"]
+    assert dem["educationlevel"].tolist() == ["college", None]
+    assert dem["occupation"].tolist() == ["trader", None]
+
+    # the minor override still depends on the age at each visit
+    visits = pd.DataFrame({"age": [9, 20], "maritalstatus": dem["maritalstatus"]})
+    visits = dem_features.set_minor_marital_status(visits)
+    assert visits["maritalstatus"].tolist() == ["minor", "single"]
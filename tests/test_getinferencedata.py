@@ -0,0 +1,315 @@
+import re
+import time
+import threading
+import pytest
+from mysql.connector import Error
+from src.inference import get_inference_data
+
+
+class FakeCursor:
+    # serves the result sets of one CALL, like a mysql-connector cursor
+    def __init__(self, connection):
+        self.connection = connection
+        self.result_sets = []
+
+    def execute(self, query, params):
+        pool = self.connection.pool
+        call = re.match(r"CALL (\w+)\(", query)
+        procedure = call.group(1) if call else "query"
+        self.params = params
+        pool.calls.append((procedure, params))
+        time.sleep(pool.delays.get(procedure, pool.delay))
+        if procedure in pool.failing:
+            raise Error(msg=f"{procedure} failed")
+        self.result_sets = [list(s) for s in pool.results(procedure, params)]
+
+    @property
+    def description(self):
+        if self.params[0] in self.connection.pool.broken:
+            return None
+        return [(column,) for column in self.result_sets[0][0]]
+
+    def fetchmany(self, size):
+        self.connection.pool.fetch_sizes.append(size)
+        columns, rows = self.result_sets[0]
+        batch, self.result_sets[0][1] = rows[:size], rows[size:]
+        return [dict(zip(columns, row)) for row in batch]
+
+    def fetchall(self):
+        columns, rows = self.result_sets[0]
+        self.result_sets[0][1] = []
+        return rows
+
+    def nextset(self):
+        self.result_sets.pop(0)
+        self.connection.pool.sets_drained += 1
+        return True if self.result_sets else None
+
+    def close(self):
+        self.connection.pool.cursors_closed += 1
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def ping(self, reconnect, attempts, delay):
+        self.pool.pings += 1
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self)
+
+    def close(self):
+        # closing a pooled connection returns it to the pool
+        with self.pool.lock:
+            self.pool.in_use -= 1
+            self.pool.returned += 1
+
+
+class FakePool:
+    def __init__(self, pool_size, results, delay=0.0, failing=(), delays=None, broken=()):
+        self.pool_size = pool_size
+        self.results = results
+        self.delay = delay
+        self.delays = delays or {}
+        self.failing = set(failing)
+        # patients whose results have no columns
+        self.broken = set(broken)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.fetch_sizes = []
+        self.in_use = self.max_in_use = self.returned = 0
+        self.pings = self.cursors_closed = self.sets_drained = 0
+
+    def get_connection(self):
+        with self.lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return FakeConnection(self)
+
+
+def patient_results(procedure, params):
+    # one result set with a row per patient, plus the status set procedures
+    # also return
+    (ppk,) = params
+    columns = {
+        "sp_iitml_get_patient_lab": ["PatientPKHash", "OrderedbyDate"],
+        "sp_iitml_get_pharmacy_visits": ["PatientPKHash", "DispenseDate"],
+        "sp_iitml_get_visits": ["PatientPKHash", "VisitDate"],
+        "sp_iitml_get_patient_demographics": ["PatientPKHash", "MFLCode"],
+    }[procedure]
+    return [(columns, [(ppk, "2024-01-01")]), (["status"], [])]
+
+
+@pytest.fixture
+def use_pool(monkeypatch):
+    def install(pool):
+        monkeypatch.setattr(get_inference_data, "_pool", pool)
+        monkeypatch.setattr(get_inference_data, "_pool_slots", threading.BoundedSemaphore(pool.pool_size))
+        monkeypatch.setattr(get_inference_data, "_fetch_executor", None)
+        return pool
+
+    yield install
+    if get_inference_data._fetch_executor is not None:
+        get_inference_data._fetch_executor.shutdown()
+
+
+def test_batch_fetch_runs_every_patient_concurrently(use_pool):
+    pool = use_pool(FakePool(4, patient_results, delay=0.05))
+    lab, pharmacy, visits, dem = get_inference_data.get_batch_inference_data_mysql(
+        [("A", "13074"), ("B", "13074"), ("C", "12905")]
+    )
+    assert visits["PatientPKHash"].tolist() == ["A", "B", "C"]
+    assert dem["PatientPKHash"].tolist() == ["A", "B", "C"]
+    assert len(pool.calls) == 12
+    # the calls of different patients share the pool instead of running
+    # one patient after another
+    assert pool.max_in_use == 4
+    assert pool.returned == 12
+
+
+def use_settings(monkeypatch, **settings):
+    monkeypatch.setattr(get_inference_data, "load_settings", lambda: settings)
+    get_inference_data.history_horizon.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_history_horizon():
+    yield
+    get_inference_data.history_horizon.cache_clear()
+
+
+PPK = "7E14A8034F39478149EE6A4CA37A247C631D17907C746BE0336D3D7CEC68F66F"
+
+
+def fingerprint_results(procedure, params):
+    assert procedure == "query"
+    return [(["encounters", "changed"], [(3, params["patient"])])]
+
+
+def test_data_fingerprint_is_opt_in(use_pool, monkeypatch):
+    use_settings(monkeypatch)
+    pool = use_pool(FakePool(2, fingerprint_results))
+    assert get_inference_data.get_data_fingerprint(PPK) is None
+    # without a query the pool is not touched; the fetched tables are fingerprinted
+    assert pool.calls == []
+
+
+def test_data_fingerprint_is_keyed_on_patientpkhash(use_pool, monkeypatch):
+    use_settings(monkeypatch, mysql_fingerprint_query="SELECT ... WHERE PatientPKHash = %(patient)s")
+    pool = use_pool(FakePool(2, fingerprint_results))
+    assert get_inference_data.get_data_fingerprint(PPK) == ("db", 3, PPK)
+    assert pool.calls == [("query", {"patient": PPK})]
+    assert pool.returned == 1
+    assert pool.cursors_closed == 1
+
+
+def test_data_fingerprint_failure_falls_back(use_pool, monkeypatch):
+    use_settings(monkeypatch, mysql_fingerprint_query="SELECT ... WHERE PatientPKHash = %(patient)s")
+    pool = use_pool(FakePool(2, fingerprint_results, failing=["query"]))
+    assert get_inference_data.get_data_fingerprint(PPK) is None
+    assert pool.returned == 1
+
+
+def test_history_horizon_covers_feature_lookback(monkeypatch):
+    floor = get_inference_data.min_history_days()
+    # eleven visits at the longest appointment gap, plus the margin
+    assert floor == 11 * 180 + 365
+
+    use_settings(monkeypatch)
+    assert get_inference_data.history_since("2010-01-01", "2024-12-31") == "2018-07-31"
+    assert get_inference_data.history_since("2020-01-01", "2024-12-31") == "2020-01-01"
+
+    # a horizon shorter than the features look back is raised to it
+    use_settings(monkeypatch, history_horizon_days=365)
+    assert get_inference_data.history_horizon() == floor
+    use_settings(monkeypatch, history_horizon_days=4000)
+    assert get_inference_data.history_horizon() == 4000
+    use_settings(monkeypatch, history_horizon_days=None)
+    assert get_inference_data.history_since("2010-01-01", "2024-12-31") == "2010-01-01"
+
+
+def dated_results(procedure, params):
+    rows = [("A", "2019-05-01"), ("A", "2023-01-01"), ("A", None)]
+    return [(["PatientPKHash", "VisitDate"], rows)]
+
+
+def test_since_is_pushed_into_procedures(use_pool, monkeypatch):
+    use_settings(monkeypatch, mysql_procedures_take_since=True)
+    pool = use_pool(FakePool(2, dated_results))
+    df = get_inference_data.call_procedure("sp_iitml_get_visits", "A", "visitdate", "2020-01-01")
+    assert pool.calls == [("sp_iitml_get_visits", ("A", "2020-01-01"))]
+    # the server does the filtering, so rows are not checked again
+    assert len(df) == 3
+
+
+def test_since_is_applied_to_the_result(use_pool, monkeypatch):
+    use_settings(monkeypatch)
+    pool = use_pool(FakePool(2, dated_results))
+    df = get_inference_data.call_procedure("sp_iitml_get_visits", "A", "visitdate", "2020-01-01")
+    assert pool.calls == [("sp_iitml_get_visits", ("A", ))]
+    # rows with an unparseable date are kept for cleaning to drop
+    assert df["VisitDate"].tolist() == ["2023-01-01", None]
+
+
+def test_pooled_connection_is_pinged_and_returned(use_pool):
+    pool = use_pool(FakePool(2, patient_results))
+    with get_inference_data.pooled_connection() as connection:
+        assert pool.in_use == 1
+    assert pool.pings == 1
+    assert pool.returned == 1
+    assert pool.in_use == 0
+
+
+def test_pooled_connection_is_returned_on_error(use_pool):
+    pool = use_pool(FakePool(1, patient_results, failing=["sp_iitml_get_visits"]))
+    with pytest.raises(Error):
+        get_inference_data.call_procedure("sp_iitml_get_visits", "A")
+    assert pool.returned == 1
+    assert pool.cursors_closed == 1
+    # the only slot was released, so the next call gets the connection back
+    df = get_inference_data.call_procedure("sp_iitml_get_patient_lab", "A")
+    assert df["PatientPKHash"].tolist() == ["A"]
+    assert pool.returned == 2
+
+
+def test_pooled_connection_waits_for_a_free_slot(use_pool):
+    pool = use_pool(FakePool(1, patient_results))
+    with get_inference_data.pooled_connection():
+        with pytest.raises(Error, match="No pooled MySQL connection"):
+            with get_inference_data.pooled_connection(timeout=0.01):
+                pass
+    # the failed checkout never took a connection or a slot
+    assert pool.returned == 1
+    with get_inference_data.pooled_connection(timeout=0.01):
+        pass
+    assert pool.returned == 2
+
+
+def test_settings_are_read_once(tmp_path):
+    path = tmp_path / "settings.json"
+    path.write_text('{"mysql_pool_size": 4}')
+    assert get_inference_data.load_settings(str(path)) == {"mysql_pool_size": 4}
+    path.write_text('{"mysql_pool_size": 16}')
+    assert get_inference_data.load_settings(str(path)) == {"mysql_pool_size": 4}
+
+
+def long_results(procedure, params):
+    # a result streamed over several fetches, followed by two more sets
+    rows = [("A", f"2024-01-{day:02d}") for day in range(1, 8)]
+    return [(["PatientPKHash", "VisitDate"], rows), (["status"], [("ok", )]), (["status"], [])]
+
+
+def test_procedure_result_is_streamed_and_drained(use_pool, monkeypatch):
+    use_settings(monkeypatch)
+    monkeypatch.setattr(get_inference_data, "FETCH_SIZE", 3)
+    pool = use_pool(FakePool(1, long_results))
+    df = get_inference_data.call_procedure("sp_iitml_get_visits", "A", "visitdate", "2024-01-03")
+    assert df["VisitDate"].tolist() == [f"2024-01-{day:02d}" for day in range(3, 8)]
+    # 7 rows in batches of 3, then an empty fetch
+    assert pool.fetch_sizes == [3, 3, 3, 3]
+    # both trailing result sets were read off before the connection went back
+    assert pool.sets_drained == 3
+    assert pool.returned == 1
+
+
+def test_failed_procedure_leaves_only_its_own_frame_empty(use_pool, monkeypatch):
+    use_settings(monkeypatch)
+    pool = use_pool(FakePool(4, patient_results, failing=["sp_iitml_get_pharmacy_visits"]))
+    lab, pharmacy, visits, dem = get_inference_data.get_inference_data_mysql("A", "13074")
+    assert pharmacy is None
+    assert [df["PatientPKHash"].tolist() for df in (lab, visits, dem)] == [["A"]] * 3
+    assert pool.returned == 4
+
+
+def test_slow_procedure_times_out_on_its_own(use_pool, monkeypatch):
+    use_settings(monkeypatch, mysql_query_timeout=0.2)
+    use_pool(FakePool(4, patient_results, delays={"sp_iitml_get_visits": 1.0}))
+    start = time.monotonic()
+    lab, pharmacy, visits, dem = get_inference_data.get_inference_data_mysql("A", "13074")
+    # the fetch gives up on the slow query after its timeout
+    assert time.monotonic() - start < 0.9
+    assert visits is None
+    # the others ran alongside it and were not held up
+    assert [df["PatientPKHash"].tolist() for df in (lab, pharmacy, dem)] == [["A"]] * 3
+
+
+def test_one_bad_patient_does_not_fail_the_batch(use_pool, monkeypatch):
+    use_settings(monkeypatch)
+    pool = use_pool(FakePool(4, patient_results, broken=["B"]))
+    tables = get_inference_data.get_batch_inference_data_mysql([("A", "13074"), ("B", "13074"), ("C", "13074")])
+    # the TypeError from B's missing columns is not a MySQL error
+    assert [df["PatientPKHash"].tolist() for df in tables] == [["A", "C"]] * 4
+    assert pool.returned == 12
+
+
+def test_pool_reads_time_out_with_the_queries(monkeypatch):
+    created = {}
+    monkeypatch.setattr(get_inference_data.pooling, "MySQLConnectionPool", lambda **config: created.update(config) or FakePool(2, patient_results))
+    monkeypatch.setattr(get_inference_data, "_pool", None)
+    use_settings(monkeypatch, mysql_url="db", mysql_port="3306", mysql_database="openmrs",
+                 mysql_username="user", mysql_password="secret", mysql_query_timeout=2.5)
+    get_inference_data.init_pool()
+    assert created["connection_timeout"] == 3
+    assert created.get("read_timeout", 3) == 3
+    monkeypatch.setattr(get_inference_data, "_pool", None)
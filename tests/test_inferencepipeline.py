@@ -0,0 +1,274 @@
+import shutil
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+from fastapi.testclient import TestClient
+from pipelines import inference_pipeline
+from src.inference import api
+from src.inference import get_inference_data
+from src.inference import model_registry
+from src.inference import result_cache
+from src.common import helpers
+from src.common import metrics
+
+SITES = ["13074", "12905"]
+
+
+def make_raw(n_patients, seed=0):
+    # raw lab, pharmacy, visits and dem tables in the shape the stored
+    # procedures return, for patients at two sites
+    rng = np.random.default_rng(seed)
+    lab, pharmacy, visits, dem = [], [], [], []
+    for p in range(n_patients):
+        ppk = f"{p:064X}"
+        sc = SITES[p % len(SITES)]
+        visitdate = pd.Timestamp("2021-02-01") + pd.Timedelta(days=int(rng.integers(0, 300)))
+        for _ in range(int(rng.integers(1, 12))):
+            gap = int(rng.choice([30, 60, 90, 180]))
+            nad = visitdate + pd.Timedelta(days=gap)
+            visits.append(
+                {
+                    "PatientPKHash": ppk,
+                    "SiteCode": int(sc),
+                    "VisitDate": visitdate.strftime("%Y-%m-%d"),
+                    "VisitType": rng.choice(["Scheduled", "Unscheduled"]),
+                    "VisitBy": "Self",
+                    "NextAppointmentDate": nad.strftime("%Y-%m-%d"),
+                    "TCAReason": "Follow up",
+                    "Pregnant": rng.choice(["Yes", "No", None]),
+                    "Breastfeeding": "No",
+                    "StabilityAssessment": rng.choice(["Stable", "Unstable"]),
+                    "DifferentiatedCare": "Fast Track",
+                    "WHOStage": int(rng.integers(1, 5)),
+                    "WHOStagingOI": None,
+                    "Height": 170.0,
+                    "Weight": 60.0,
+                    "EMR": "KenyaEMR",
+                    "Project": "x",
+                    "Adherence": rng.choice(["Good", "Poor"]),
+                    "AdherenceCategory": "ART",
+                    "BP": "120/80",
+                    "OI": None,
+                    "OIDate": None,
+                    "CurrentRegimen": rng.choice(["TDF/3TC/DTG", "AZT/3TC/NVP"]),
+                    "AppointmentReminderWillingness": "Yes",
+                }
+            )
+            pharmacy.append(
+                {
+                    "PatientPKHash": ppk,
+                    "SiteCode": sc,
+                    "DispenseDate": visitdate.strftime("%Y-%m-%d"),
+                    "ExpectedReturn": nad.strftime("%Y-%m-%d"),
+                    "TreatmentType": "ARV",
+                    "Drug": "TDF/3TC/DTG",
+                }
+            )
+            if rng.random() < 0.3:
+                lab.append(
+                    {
+                        "PatientPKHash": ppk,
+                        "SiteCode": sc,
+                        "OrderedbyDate": visitdate.strftime("%Y-%m-%d"),
+                        "TestName": rng.choice(["Viral Load", "CD4 Count"]),
+                        "TestResult": rng.choice(["LDL", "1000", "150"]),
+                    }
+                )
+            visitdate = nad + pd.Timedelta(days=int(rng.choice([0, 3, 45])))
+        dem.append(
+            {
+                "PatientPKHash": ppk,
+                "MFLCode": sc,
+                "Sex": rng.choice(["Male", "Female"]),
+                "MaritalStatus": "Single",
+                "EducationLevel": "Primary",
+                "Occupation": "Farmer",
+                "ARTOutcomeDescription": "Active",
+                "StartARTDate": "2018-01-01",
+                "DOB": "1990-01-01",
+            }
+        )
+    return pd.DataFrame(lab), pd.DataFrame(pharmacy), pd.DataFrame(visits), pd.DataFrame(dem)
+
+
+@pytest.fixture
+def served(tmp_path, monkeypatch):
+    # serve the repo's encoder, feature order and site thresholds with a
+    # small booster trained on random data, and fetch from in-memory tables
+    for name in ["ohe_latest.pkl", "feature_order.pkl", "site_thresholds_latest.pkl"]:
+        shutil.copyfile(f"models/{name}", tmp_path / name)
+    with open(tmp_path / "feature_order.pkl", "rb") as f:
+        features = [c for c in pickle.load(f) if c != "iit"]
+    rng = np.random.default_rng(0)
+    train = xgb.DMatrix(
+        rng.random((50, len(features))), label=rng.integers(0, 2, 50), feature_names=features
+    )
+    xgb.train({"objective": "binary:logistic"}, train, 3).save_model(str(tmp_path / "mod_latest.json"))
+    model_registry.init_registry(models_dir=str(tmp_path), manifest_path=str(tmp_path / "none.json"))
+    result_cache.clear()
+
+    tables = make_raw(12)
+
+    def fetch(patientPK=None, sitecode=None, since=None):
+        return tuple(df[df["PatientPKHash"] == patientPK].reset_index(drop=True) for df in tables)
+
+    def fetch_batch(patients, since=None):
+        frames = [fetch(ppk) for ppk, _ in patients]
+        return tuple(pd.concat(dfs, ignore_index=True) for dfs in zip(*frames))
+
+    monkeypatch.setattr(get_inference_data, "get_data_fingerprint", lambda patientPK: None)
+    monkeypatch.setattr(get_inference_data, "get_inference_data_mysql", fetch)
+    monkeypatch.setattr(get_inference_data, "get_batch_inference_data_mysql", fetch_batch)
+    return [tuple(p) for p in tables[3][["PatientPKHash", "MFLCode"]].values.tolist()]
+
+
+def test_patient_scores_the_same_alone_and_in_a_batch(served):
+    patients = served
+    batch = inference_pipeline.run_batch_inference_pipeline(
+        patients=patients, start_date="2021-01-01", end_date="2022-06-30"
+    )
+    for (ppk, sc), result in zip(patients, batch):
+        alone = inference_pipeline.run_inference_pipeline(
+            ppk=ppk, sc=sc, start_date="2021-01-01", end_date="2022-06-30"
+        )
+        assert result == {"ppk": ppk, "sc": sc, **alone}
+    assert any(result["pred_out"] is not None for result in batch)
+
+
+def test_batch_endpoint_returns_result_per_patient(served, monkeypatch):
+    monkeypatch.setattr(model_registry, "init_registry", lambda: None)
+    monkeypatch.setattr(model_registry, "start_watcher", lambda: None)
+    monkeypatch.setattr(get_inference_data, "init_pool", lambda: None)
+    patients = served[:3] + [("unknown", "13074")]
+    with TestClient(api.app) as client:
+        response = client.post(
+            "/inference/batch",
+            json={
+                "patients": [{"ppk": ppk, "sc": sc} for ppk, sc in patients],
+                "end_date": "2022-06-30",
+            },
+        )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(r["ppk"], r["sc"]) for r in results] == patients
+    # a patient without records is reported as unavailable
+    assert results[-1]["pred_cat"] == "unavailable"
+    assert all(r["pred_cat"] in ["high", "medium", "low", "unavailable"] for r in results)
+
+
+def test_cached_prediction_skips_the_fetch(served, monkeypatch):
+    ppk, sc = served[0]
+    stamps = {ppk: ("db", 1)}
+    fetched = []
+    fetch = get_inference_data.get_inference_data_mysql
+    monkeypatch.setattr(get_inference_data, "get_data_fingerprint", lambda patientPK: stamps[patientPK])
+    monkeypatch.setattr(
+        get_inference_data,
+        "get_inference_data_mysql",
+        lambda **kwargs: fetched.append(kwargs["patientPK"]) or fetch(**kwargs),
+    )
+
+    first = inference_pipeline.run_inference_pipeline(ppk=ppk, sc=sc, start_date="2021-01-01", end_date="2022-06-30")
+    second = inference_pipeline.run_inference_pipeline(ppk=ppk, sc=sc, start_date="2021-01-01", end_date="2022-06-30")
+    assert second == first
+    assert fetched == [ppk]
+
+    # a record written since changes the fingerprint, so the patient is fetched again
+    stamps[ppk] = ("db", 2)
+    inference_pipeline.run_inference_pipeline(ppk=ppk, sc=sc, start_date="2021-01-01", end_date="2022-06-30")
+    assert fetched == [ppk, ppk]
+
+
+def make_long_raw(n_patients, end_date, seed=0):
+    # patients in care for over ten years, returning at most 25 days after
+    # each appointment, with up to six-monthly appointments
+    rng = np.random.default_rng(seed)
+    lab, pharmacy, visits, dem = make_raw(n_patients, seed)
+    visits = visits.groupby("PatientPKHash").head(1)
+    rows = {"lab": [], "pharmacy": [], "visits": []}
+    for p, visit in enumerate(visits.to_dict("records")):
+        # the last patient comes every 180 days, the longest gap the horizon allows for
+        gaps = [180] * 45 if p == n_patients - 1 else rng.choice([30, 90, 180], 45)
+        visitdate = pd.Timestamp(end_date) - pd.Timedelta(days=int(rng.integers(0, 200)))
+        for i, gap in enumerate(gaps):
+            nad = visitdate + pd.Timedelta(days=int(gap))
+            rows["visits"].append(
+                {**visit, "VisitDate": visitdate.strftime("%Y-%m-%d"), "NextAppointmentDate": nad.strftime("%Y-%m-%d")}
+            )
+            rows["pharmacy"].append(
+                {
+                    "PatientPKHash": visit["PatientPKHash"],
+                    "SiteCode": str(visit["SiteCode"]),
+                    "DispenseDate": visitdate.strftime("%Y-%m-%d"),
+                    "ExpectedReturn": nad.strftime("%Y-%m-%d"),
+                    "TreatmentType": "ARV",
+                    "Drug": rng.choice(["TDF/3TC/DTG", "TDF/3TC/EFV"]),
+                }
+            )
+            if rng.random() < 0.3:
+                rows["lab"].append(
+                    {
+                        "PatientPKHash": visit["PatientPKHash"],
+                        "SiteCode": str(visit["SiteCode"]),
+                        "OrderedbyDate": visitdate.strftime("%Y-%m-%d"),
+                        "TestName": rng.choice(["Viral Load", "CD4 Count"]),
+                        "TestResult": rng.choice(["LDL", "1000", "150"]),
+                    }
+                )
+            # step back to the visit that booked this one
+            booked = int(gaps[min(i + 1, len(gaps) - 1)])
+            visitdate = visitdate - pd.Timedelta(days=booked + int(rng.integers(0, 25)))
+    return pd.DataFrame(rows["lab"]), pd.DataFrame(rows["pharmacy"]), pd.DataFrame(rows["visits"]), dem
+
+
+def test_features_are_unchanged_under_the_history_horizon(served):
+    start_date, end_date = "2000-01-01", "2024-06-30"
+    tables = make_long_raw(8, end_date)
+    since = get_inference_data.history_since(start_date, end_date)
+    assert since > start_date
+
+    # drop the rows the fetch skips
+    bounded = []
+    for name, df in zip(get_inference_data.PROCEDURES, tables):
+        date_column = get_inference_data.HISTORY_DATES.get(name)
+        if date_column is not None:
+            column = next(c for c in df.columns if c.lower() == date_column)
+            df = df[~(helpers.parse_long_dates(df[column]) < pd.Timestamp(since))]
+        bounded.append(df.reset_index(drop=True))
+    assert len(bounded[2]) < len(tables[2])
+
+    artifacts = model_registry.get_artifacts()
+    full = inference_pipeline.build_inference_features(*tables, start_date, end_date, artifacts)
+    horizon = inference_pipeline.build_inference_features(*bounded, start_date, end_date, artifacts)
+    # timeatfacility counts from the first fetched visit; only its "restart"
+    # cut-off at 6 months reaches the model, through most_recent_vl
+    assert (full["timeatfacility"] > 6).all() and (horizon["timeatfacility"] > 6).all()
+    pd.testing.assert_frame_equal(
+        full.drop(columns="timeatfacility").reset_index(drop=True),
+        horizon.drop(columns="timeatfacility").reset_index(drop=True),
+    )
+
+
+def test_every_scoring_stage_is_timed(served, capsys):
+    ppk, sc = served[0]
+    metrics.reset()
+    pred = inference_pipeline.run_inference_pipeline(ppk=ppk, sc=sc, start_date="2021-01-01", end_date="2022-06-30")
+    assert pred["pred_out"] is not None
+    stages = metrics.stage_totals("inference")
+    for stage in [
+        "fingerprint",
+        "fetch",
+        "clean_visits",
+        "create_target",
+        "target_visit_features",
+        "target_pharmacy_features",
+        "target_lab_features",
+        "locational",
+        "encode",
+        "predict",
+    ]:
+        assert stage in stages
+    # timing does not print the prediction
+    assert str(pred["pred_out"]) not in capsys.readouterr().out
@@ -0,0 +1,18 @@
+from src.common import metrics
+
+
+def test_stage_timer_renders_histogram():
+    metrics.reset()
+    metrics.observe("clean_lab", 0.02)
+    metrics.observe("clean_lab", 3.0)
+    with metrics.stage_timer("predict"):
+        pass
+    text = metrics.render()
+    assert "# TYPE iit_stage_duration_seconds histogram" in text
+    # 0.02s falls in the 0.025 bucket, 3s only from the 5s bucket up
+    assert 'stage="clean_lab",le="0.025"} 1' in text
+    assert 'stage="clean_lab",le="5"} 2' in text
+    assert 'iit_stage_duration_seconds_count{pipeline="inference",stage="clean_lab"} 2' in text
+    assert 'stage="predict",le="+Inf"} 1' in text
+    assert metrics.stage_totals("inference")["clean_lab"] == 3.02
+    assert metrics.stage_totals("retrain") == {}
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import pickle
+import pandas as pd
+import xgboost as xgb
+from sklearn.preprocessing import OneHotEncoder
+from src.inference import model_registry
+from src.common import site_activity
+
+
+def write_bundle(folder, version, txcurr=100, feature_order=("age", "sex_Male", "iit")):
+    # a tiny but complete bundle: encoder, booster, feature order, site
+    # thresholds and locational CSV, all named by version
+    ohe = OneHotEncoder(drop="first", handle_unknown="ignore")
+    ohe.fit(pd.DataFrame({"sex": ["Male", "Female"]}))
+    train = pd.DataFrame({"age": [20, 30, 40, 50], "sex_Male": [1, 0, 1, 0]})
+    bst = xgb.train(
+        {"objective": "binary:logistic"}, xgb.DMatrix(train, label=[0, 1, 0, 1]), num_boost_round=2
+    )
+    paths = {
+        "model": os.path.join(folder, f"mod_{version}.json"),
+        "encoder": os.path.join(folder, f"ohe_{version}.pkl"),
+        "feature_order": os.path.join(folder, f"feature_order_{version}.pkl"),
+        "site_thresholds": os.path.join(folder, f"site_thresholds_{version}.pkl"),
+        "locational": os.path.join(folder, f"locational_variables_{version}.csv"),
+    }
+    bst.save_model(paths["model"])
+    with open(paths["encoder"], "wb") as f:
+        pickle.dump(ohe, f)
+    with open(paths["feature_order"], "wb") as f:
+        pickle.dump(list(feature_order), f)
+    with open(paths["site_thresholds"], "wb") as f:
+        pickle.dump({"19735": {"high": 0.5, "medium": 0.2}}, f)
+    pd.DataFrame({"sitecode": ["13074"], "txcurr": [txcurr]}).to_csv(paths["locational"], index=False)
+    return {"version": version, **paths}
+
+
+def publish(manifest, path):
+    # swap the manifest in the way publish_bundle does
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def test_refresh_registry_rejects_bundle_failing_warm_up(tmp_path):
+    manifest_path = str(tmp_path / "bundle_latest.json")
+    publish(write_bundle(str(tmp_path), "v1"), manifest_path)
+    model_registry.init_registry(manifest_path=manifest_path)
+
+    # the feature order leaves out a column the booster was trained on
+    publish(write_bundle(str(tmp_path), "v2", feature_order=("age", "iit")), manifest_path)
+    assert model_registry.refresh_registry(manifest_path) is False
+    assert model_registry.get_artifacts().version == "v1"
+
+
+def test_refresh_registry_swaps_whole_bundle(tmp_path):
+    manifest_path = str(tmp_path / "bundle_latest.json")
+    publish(write_bundle(str(tmp_path), "v1", txcurr=100), manifest_path)
+    old = model_registry.init_registry(manifest_path=manifest_path)
+
+    publish(write_bundle(str(tmp_path), "v2", txcurr=200), manifest_path)
+    assert model_registry.refresh_registry(manifest_path) is True
+    new = model_registry.get_artifacts()
+    assert new.version == "v2"
+    assert new.locational.loc["13074", "txcurr"] == 200
+    # a request holding the old snapshot keeps every old artifact
+    assert old.version == "v1"
+    assert old.locational.loc["13074", "txcurr"] == 100
+    assert old.booster is not new.booster
+    # the same version is not loaded again
+    assert model_registry.refresh_registry(manifest_path) is False
+
+
+def test_watcher_swaps_in_published_bundle(tmp_path):
+    manifest_path = str(tmp_path / "bundle_latest.json")
+    publish(write_bundle(str(tmp_path), "v1"), manifest_path)
+    model_registry.init_registry(manifest_path=manifest_path)
+    model_registry.start_watcher(interval=0.01, manifest_path=manifest_path)
+    try:
+        publish(write_bundle(str(tmp_path), "v2"), manifest_path)
+        deadline = time.monotonic() + 10
+        while model_registry.get_artifacts().version != "v2" and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        model_registry.stop_watcher()
+    assert model_registry.get_artifacts().version == "v2"
+
+
+def test_publish_bundle_copies_locational_csv(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("models")
+    os.makedirs("data")
+    pd.DataFrame({"sitecode": ["13074"], "txcurr": [100]}).to_csv(
+        "data/locational_variables_latest.csv", index=False
+    )
+    manifest = model_registry.publish_bundle("20250101_000000")
+    assert manifest["locational"] == "models/locational_variables_20250101_000000.csv"
+    assert model_registry.read_manifest()["version"] == "20250101_000000"
+
+    # the next locational refresh does not change the published bundle
+    pd.DataFrame({"sitecode": ["13074"], "txcurr": [200]}).to_csv(
+        "data/locational_variables_latest.csv", index=False
+    )
+    assert pd.read_csv(manifest["locational"])["txcurr"].tolist() == [100]
+    # without a site activity index the bundle serves an empty one
+    assert "site_activity" not in manifest
+
+
+def test_publish_bundle_copies_site_activity_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("models")
+    os.makedirs("data")
+    bundle = write_bundle("models", "20250101_000000")
+    os.replace(bundle["locational"], "data/locational_variables_latest.csv")
+    site_activity.save_site_activity(
+        site_activity.update_site_activity(None, [13074], pd.to_datetime(["2024-12-01"]))
+    )
+    manifest = model_registry.publish_bundle("20250101_000000")
+    assert manifest["site_activity"] == "models/site_activity_20250101_000000.csv"
+
+    artifacts = model_registry.load_bundle(manifest)
+    assert artifacts.site_activity.to_dict() == {"13074": pd.Timestamp("2024-12-01")}
+    version = artifacts.data_version
+    # the next retraining run does not change the published bundle
+    site_activity.save_site_activity(
+        site_activity.update_site_activity(None, [13074], pd.to_datetime(["2025-01-01"]))
+    )
+    assert artifacts.site_activity["13074"] == pd.Timestamp("2024-12-01")
+    assert artifacts.data_version == version
+
+
+def test_locational_table_reloads_when_csv_changes(tmp_path):
+    manifest = write_bundle(str(tmp_path), "v1", txcurr=100)
+    artifacts = model_registry.load_bundle(manifest)
+    table = artifacts.locational
+    assert table.loc["13074", "txcurr"] == 100
+    # an unchanged CSV is not parsed again
+    assert artifacts.locational is table
+
+    pd.DataFrame({"sitecode": ["13074"], "txcurr": [300]}).to_csv(manifest["locational"], index=False)
+    stat = os.stat(manifest["locational"])
+    os.utime(manifest["locational"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert artifacts.locational.loc["13074", "txcurr"] == 300
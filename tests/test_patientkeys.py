@@ -0,0 +1,37 @@
+import pandas as pd
+from src.common import patient_keys
+from src.common.clean_data import clean_pharmacy
+
+
+def test_intern_keys_shares_ids_across_tables():
+    lab = pd.DataFrame({"PatientPKHash": ["B", "A"], "SiteCode": ["13074", "13074"]})
+    pharmacy = pd.DataFrame({"PatientPKHash": ["A"], "SiteCode": [13074]})
+    visits = pd.DataFrame({"PatientPKHash": ["A", "C"], "SiteCode": [13074, 12905]})
+    dem = pd.DataFrame({"PatientPKHash": ["A", "B"], "MFLCode": ["13074", "13074"]})
+
+    lab, pharmacy, visits, dem, key_table = patient_keys.intern_keys(lab, pharmacy, visits, dem)
+
+    # ids follow the order of the hash + sitecode strings
+    assert lab["key"].tolist() == [1, 0]
+    assert pharmacy["key"].tolist() == [0]
+    assert visits["key"].tolist() == [0, 2]
+    assert dem["key"].tolist() == [0, 1]
+    assert lab["key"].dtype == patient_keys.KEY_DTYPE
+    assert list(patient_keys.decode_keys([2, 0], key_table)) == ["C12905", "A13074"]
+
+
+def test_clean_pharmacy_keeps_interned_key():
+    data = pd.DataFrame(
+        {
+            "PatientPKHash": ["hash1"],
+            "SiteCode": [13074],
+            "DispenseDate": ["2024-01-01"],
+            "ExpectedReturn": ["2024-02-01"],
+            "TreatmentType": ["ARV"],
+            "Drug": ["TDF/3TC/DTG"],
+        }
+    )
+    data, _, _, _, key_table = patient_keys.intern_keys(data, None, None, None)
+    cleaned = clean_pharmacy(data, start_date="2023-01-01", end_date="2025-01-01")
+    assert cleaned["key"].tolist() == [0]
+    assert list(patient_keys.decode_keys(cleaned["key"], key_table)) == ["hash113074"]
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+from src.inference import result_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    result_cache.clear()
+    yield
+    result_cache.clear()
+
+
+def tables(visitdates):
+    visits = pd.DataFrame({"VisitDate": visitdates})
+    return pd.DataFrame(), pd.DataFrame(), visits, pd.DataFrame({"PatientPKHash": ["A"]})
+
+
+def test_cached_prediction_is_a_copy():
+    result_cache.put("a", ("db", 1), {"pred_cat": "high"})
+    pred = result_cache.get("a", ("db", 1))
+    assert pred == {"pred_cat": "high"}
+    pred["pred_cat"] = "low"
+    assert result_cache.get("a", ("db", 1)) == {"pred_cat": "high"}
+
+
+def test_new_encounter_invalidates_prediction():
+    stamp = result_cache.fingerprint(*tables(["2024-01-01", "2024-03-01"]))
+    result_cache.put("a", stamp, {"pred_cat": "high"})
+    assert result_cache.get("a", result_cache.fingerprint(*tables(["2024-01-01", "2024-03-01"]))) is not None
+
+    newer = result_cache.fingerprint(*tables(["2024-01-01", "2024-03-01", "2024-06-01"]))
+    assert newer != stamp
+    assert result_cache.get("a", newer) is None
+    # the stale entry is dropped, so the old fingerprint misses too
+    assert result_cache.get("a", stamp) is None
+
+
+def test_failed_fetch_is_not_cached():
+    lab, pharmacy, visits, dem = tables(["2024-01-01"])
+    assert result_cache.fingerprint(lab, pharmacy, None, dem) is None
+    result_cache.put("a", None, {"pred_cat": "high"})
+    assert result_cache.get("a", None) is None
+
+
+def test_prediction_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, "monotonic", lambda: now[0])
+    result_cache.put("a", ("db", 1), {"pred_cat": "high"})
+    now[0] += result_cache.TTL_SECONDS
+    assert result_cache.get("a", ("db", 1)) is not None
+    now[0] += 1
+    assert result_cache.get("a", ("db", 1)) is None
+
+
+def test_least_recently_used_prediction_is_evicted(monkeypatch):
+    monkeypatch.setattr(result_cache, "MAX_ENTRIES", 2)
+    result_cache.put("a", ("db", 1), {"pred_cat": "high"})
+    result_cache.put("b", ("db", 1), {"pred_cat": "low"})
+    # reading a makes b the least recently used
+    assert result_cache.get("a", ("db", 1)) is not None
+    result_cache.put("c", ("db", 1), {"pred_cat": "medium"})
+    assert result_cache.get("b", ("db", 1)) is None
+    assert result_cache.get("a", ("db", 1)) is not None
+    assert result_cache.get("c", ("db", 1)) is not None
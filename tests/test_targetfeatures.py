@@ -111,18 +111,296 @@ def test_prep_target_lab_features_vl_cd4_logic():
     assert out["ahd"].iloc[0] == 1
 
 
-# def test_prep_target_lab_features_missing_vl_cd4():
-#     # No lab data: should fill with novalidvl and ahd=0
-#     targets = pd.DataFrame({
-#         "key": ["A"],
-#         "visitdate": ["2022-01-01"],
-#         "timeonart": [10],
-#         "timeatfacility": [10],
-#         "age": [30],
-#         "whostage": [1]
-#     })
-#     lab = pd.DataFrame(columns=["key", "testname", "orderedbydate", "testresultcat"])
-#     targets["visitdate"] = pd.to_datetime(targets["visitdate"])
-#     out = target_features.prep_target_lab_features(targets.copy(), lab.copy())
-#     assert out["most_recent_vl"].iloc[0] == "novalidvl"
-#     assert out["ahd"].iloc[0] == 0
+def test_prep_target_lab_features_vl_fallbacks_and_ahd():
+    targets = pd.DataFrame(
+        {
+            "key": ["A", "B", "C", "D"],
+            "visitdate": pd.to_datetime(["2022-01-01"] * 4),
+            "timeonart": [2, 12, 12, None],
+            "timeatfacility": [2, 3, 12, 2],
+            "age": [30, 4, 30, 30],
+            "whostage": [3, 1, 2, None],
+        }
+    )
+    lab = pd.DataFrame(
+        {
+            "key": ["Z"],
+            "testname": ["VL"],
+            "orderedbydate": pd.to_datetime(["2021-12-01"]),
+            "testresultcat": ["suppressed"],
+        }
+    )
+    out = target_features.prep_target_lab_features(targets.copy(), lab.copy())
+    assert out["most_recent_vl"].tolist() == ["earlyart", "restart", "novalidvl", "novalidvl"]
+    assert out["ahd"].tolist() == [1, 1, 0, 0]
+
+    # no targets, with and without lab data
+    for lab_df in [lab, lab.iloc[0:0]]:
+        out = target_features.prep_target_lab_features(targets.iloc[0:0].copy(), lab_df.copy())
+        assert out.empty
+        assert out["ahd"].dtype == "int64"
+
+
+def test_prep_target_lab_features_missing_vl_cd4():
+    # No lab data: should fill with novalidvl, even early on art or after a
+    # restart, and ahd from age and whostage alone
+    targets = pd.DataFrame({
+        "key": ["A", "B", "C"],
+        "visitdate": ["2022-01-01"] * 3,
+        "timeonart": [10, 2, 12],
+        "timeatfacility": [10, 2, 3],
+        "age": [30, 30, 4],
+        "whostage": [1, 1, 1]
+    })
+    lab = pd.DataFrame(columns=["key", "testname", "orderedbydate", "testresultcat"])
+    targets["visitdate"] = pd.to_datetime(targets["visitdate"])
+    out = target_features.prep_target_lab_features(targets.copy(), lab.copy())
+    assert out["most_recent_vl"].tolist() == ["novalidvl"] * 3
+    assert out["ahd"].tolist() == [0, 0, 1]
+
+
+def test_prep_latest_target_features_matches_full_path():
+    # 14 encounters, so the lateness window does not reach back to the first one;
+    # iit early in the history still sets the cascade status of the last encounter
+    dates = pd.date_range("2021-01-01", periods=14, freq="60D")
+    targets = pd.DataFrame(
+        {
+            "key": ["A"] * 14,
+            "visitdate": dates,
+            "nad": dates + pd.Timedelta(days=30),
+            "iit": [0, 1] + [0] * 12,
+            "visitdiff": [5, 40, 0, 3, 10, 0, 20, 1, 0, 15, 2, 0, 7, 0],
+            "sitecode": ["001"] * 14,
+            "nad_imputation_flag": [0] * 14,
+            "age": [30] * 14,
+            "whostage": [1] * 14,
+            "timeonart": [12] * 14,
+            "timeatfacility": [12] * 14,
+        }
+    )
+    visits = pd.DataFrame(
+        {
+            "key": ["A"] * 14,
+            "visitdate": dates,
+            "visitdiff": targets["visitdiff"],
+            "emr": ["kenyaemr"] * 14,
+            "sitecode": ["001"] * 14,
+            "nad_imputation_flag": [0] * 14,
+            "nad_imputed": dates + pd.Timedelta(days=30),
+        }
+    )
+    pharmacy = pd.DataFrame(
+        {"key": ["A"], "dispensedate": [dates[10]], "drug": ["TDF/3TC/DTG"]}
+    )
+    lab = pd.DataFrame(
+        {
+            "key": ["A"],
+            "testname": ["VL"],
+            "orderedbydate": [dates[12]],
+            "testresultcat": ["suppressed"],
+        }
+    )
+    full = target_features.prep_target_visit_features(
+        targets.drop(columns=["visitdiff"]), visits.copy()
+    )
+    full = target_features.prep_target_pharmacy_features(full, pharmacy.copy())
+    full = target_features.prep_target_lab_features(full, lab.copy())
+
+    latest = target_features.prep_latest_target_features(
+        targets.drop(columns=["visitdiff"]), visits.copy(), pharmacy.copy(), lab.copy()
+    )
+    assert len(latest) == 1
+    pd.testing.assert_series_equal(
+        latest.iloc[0], full.iloc[-1], check_names=False
+    )
+    assert latest["cascadestatus"].iloc[0] == "longtermrestart"
+
+
+def test_prep_target_features_matches_stages():
+    # two keys, given out of order, with VL, CD4 and pharmacy records
+    dates = pd.to_datetime(["2023-06-01", "2023-03-01", "2023-01-01"] * 2)
+    targets = pd.DataFrame(
+        {
+            "key": ["B"] * 3 + ["A"] * 3,
+            "visitdate": dates,
+            "iit": [0, 1, 0, 0, 0, 0],
+            "visitdiff": [0, 45, 3, 2, 0, 20],
+            "age": [30, 30, 30, 4, 4, 4],
+            "whostage": [1] * 6,
+        }
+    )
+    visits = pd.DataFrame(
+        {
+            "key": ["A", "B"],
+            "visitdate": pd.to_datetime(["2022-12-01", "2022-12-01"]),
+            "timeonart": [3, 24],
+            "timeatfacility": [3, 3],
+            "sitecode": ["001", "001"],
+            "nad_imputation_flag": [0, 0],
+            "nad_imputed": pd.to_datetime(["2023-01-01", "2023-01-01"]),
+        }
+    )
+    pharmacy = pd.DataFrame(
+        {
+            "key": ["A", "B"],
+            "dispensedate": pd.to_datetime(["2023-02-01", "2023-02-01"]),
+            "drug": ["TDF/3TC/DTG", "TDF/3TC/EFV"],
+        }
+    )
+    lab = pd.DataFrame(
+        {
+            "key": ["B", "B"],
+            "testname": ["VL", "CD4"],
+            "orderedbydate": pd.to_datetime(["2023-02-01", "2023-05-01"]),
+            "testresultcat": ["suppressed", "YesAHD"],
+        }
+    )
+    staged = target_features.prep_target_visit_features(targets.copy(), visits.copy())
+    staged = target_features.prep_target_pharmacy_features(staged, pharmacy.copy())
+    staged = target_features.prep_target_lab_features(staged, lab.copy())
+
+    out = target_features.prep_target_features(
+        targets.copy(), visits.copy(), pharmacy.copy(), lab.copy()
+    )
+    pd.testing.assert_frame_equal(out, staged)
+    assert out["key"].tolist() == ["A"] * 3 + ["B"] * 3
+    assert out["most_recent_vl"].tolist() == ["earlyart"] * 3 + ["restart", "suppressed", "suppressed"]
+    assert out["ahd"].tolist() == [1, 1, 1, 0, 0, 1]
+
+    # scored per patient, A has no lab rows at all, as when scored on its own
+    out = target_features.prep_target_features(
+        targets.copy(), visits.copy(), pharmacy.copy(), lab.copy(), per_patient_labs=True
+    )
+    assert out["most_recent_vl"].tolist() == ["novalidvl"] * 3 + ["restart", "suppressed", "suppressed"]
+
+
+def test_prep_target_features_lateness_regimen_and_vl():
+    # three keys with a re-engagement, late14/late30 boundaries, a dispense
+    # without a drug and the earlyart, restart and expired VL fallbacks
+    visitdate = pd.to_datetime([
+        "2021-01-05", "2021-02-10", "2021-05-20", "2021-09-01", "2022-03-15", "2022-04-20",
+        "2020-06-01", "2020-07-15", "2021-08-01", "2021-09-10", "2022-01-10", "2022-02-14",
+    ])
+    nad = pd.to_datetime([
+        "2021-02-05", "2021-05-10", "2021-08-20", "2022-03-01", "2022-04-15", "2022-07-20",
+        "2020-07-01", "2020-10-15", "2021-09-01", "2021-12-10", "2022-02-10", "2022-05-14",
+    ])
+    key = ["A"] * 6 + ["B"] * 4 + ["C"] * 2
+    sitecode = ["13074"] * 6 + ["12905"] * 4 + ["13074"] * 2
+    targets = pd.DataFrame(
+        {
+            "key": key,
+            "visitdate": visitdate,
+            "sitecode": sitecode,
+            "nad": nad,
+            "nad_imputation_flag": [0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0],
+            "visitdiff": [5, 10, 12, 14, 5, None, 14, 290, 9, None, 4, None],
+            "iit": [0, 0, 0, 0, 0, None, 0, 1, 0, None, 0, None],
+        }
+    )
+    # A's last encounter has no visit row
+    visits = pd.DataFrame(
+        {
+            "key": key[:5] + key[6:],
+            "visitdate": visitdate.delete(5),
+            "sitecode": sitecode[:5] + sitecode[6:],
+            "nad_imputation_flag": [0] * 11,
+            "nad_imputed": nad.delete(5),
+            "emr": ["kenyaemr"] * 11,
+            "age": [34.0, 34.1, 34.4, 34.7, 35.2, 4.5, 4.6, 5.7, 5.8, 51.0, 51.1],
+            "whostage": [1, 1, 2, 2, 3, 1, 1, 1, 1, 2, None],
+            "timeonart": [1.0, 2.2, 5.4, 9.2, 15.6, 30.0, 31.5, 44.0, 45.3, 8.0, 9.2],
+            "timeatfacility": [0.0, 1.2, 4.4, 8.2, 14.5, 0.0, 1.5, 14.0, 15.3, 0.0, 1.2],
+        }
+    )
+    pharmacy = pd.DataFrame(
+        {
+            "key": ["A", "A", "A", "B", "B", "C"],
+            "dispensedate": pd.to_datetime(
+                ["2021-01-05", "2021-05-20", "2022-03-10", "2020-06-01", "2021-08-01", "2022-01-11"]
+            ),
+            "drug": ["AZT/3TC/NVP", "TDF/3TC/DTG", None, "TDF/3TC/DTG", "AZT/3TC/EFV", "TDF/3TC/DTG"],
+        }
+    )
+    lab = pd.DataFrame(
+        {
+            "key": ["A", "A", "A", "B", "B", "C"],
+            "testname": ["VL", "CD4", "VL", "CD4", "VL", "VL"],
+            "orderedbydate": pd.to_datetime(
+                ["2021-02-01", "2021-02-01", "2022-04-01", "2020-06-01", "2020-07-10", "2022-02-14"]
+            ),
+            "testresultcat": ["suppressed", "YesAHD", "nonsuppressed", "NoAHD", "suppressed", "nonsuppressed"],
+        }
+    )
+    out = target_features.prep_target_features(targets, visits, pharmacy, lab)
+    assert out["key"].tolist() == key
+    assert out["cascadestatus"].tolist() == ["neverdisengaged"] * 8 + ["shorttermrestart"] * 2 + ["neverdisengaged"] * 2
+    assert out["lastvd"].fillna(-1).tolist() == [-1, 5, 10, 12, 14, 5, -1, 14, 100, 9, -1, 4]
+    assert out["late"].tolist() == [0, 1, 1, 1, 1, 1, 0, 1, 1, 1, 0, 1]
+    assert out["late14"].tolist() == out["late30"].tolist() == [0] * 8 + [1, 0, 0, 0]
+    assert out["lateness_last3"].round(2).fillna(-1).tolist() == [-1, 5, 7.5, 9, 12, 10.33, -1, 14, 57, 41, -1, 4]
+    assert out["lateness_last5"].round(2).fillna(-1).tolist() == [-1, 5, 7.5, 9, 10.25, 9.2, -1, 14, 57, 41, -1, 4]
+    pd.testing.assert_series_equal(out["lateness_last10"], out["lateness_last5"], check_names=False)
+    assert out["late_last3"].tolist() == [0, 1, 2, 3, 3, 3, 0, 1, 2, 3, 0, 1]
+    assert out["late_last5"].tolist() == out["late_last10"].tolist() == [0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 0, 1]
+    for late in ["late14", "late30"]:
+        for window in [3, 5, 10]:
+            assert out[f"{late}_last{window}"].tolist() == [0] * 8 + [1, 1, 0, 0]
+    assert out["optimizedhivregimen"].fillna(-1).tolist() == [0, 0, 1, 1, 0, 0, 1, 1, 0, 0, -1, 1]
+    assert out["most_recent_vl"].tolist() == [
+        "earlyart", "suppressed", "suppressed", "suppressed", "novalidvl", "nonsuppressed",
+        "restart", "suppressed", "novalidvl", "novalidvl",
+        "restart", "nonsuppressed",
+    ]
+    assert out["ahd"].tolist() == [0, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0]
+
+    # the latest path scores the last encounter of each key the same
+    latest = target_features.prep_latest_target_features(targets, visits, pharmacy, lab)
+    pd.testing.assert_frame_equal(
+        latest.reset_index(drop=True),
+        out.iloc[[5, 9, 11]][latest.columns].reset_index(drop=True),
+        check_dtype=False,
+    )
+
+
+def test_grouped_rolling_sums_matches_pandas_rolling():
+    import numpy as np
+    from src.common import helpers
+
+    keys = pd.Series(["b", "a", "b", "a", "b", "a", "b", "b"])
+    values = pd.Series([1.0, np.nan, 3.0, 4.0, np.nan, np.nan, 7.0, 0.0])
+    rolling = helpers.grouped_rolling_sums(keys, {"v": values}, [3])
+    sums, counts = rolling[("v", 3)]
+    expected_sums = values.groupby(keys).transform(
+        lambda x: x.rolling(window=3, min_periods=1).sum()
+    )
+    expected_means = values.groupby(keys).transform(
+        lambda x: x.rolling(window=3, min_periods=1).mean()
+    )
+    assert np.array_equal(sums, expected_sums.to_numpy(), equal_nan=True)
+    assert np.array_equal(
+        sums / np.maximum(counts, 1), expected_means.to_numpy(), equal_nan=True
+    )
+
+
+def test_cascade_status():
+    targets = pd.DataFrame(
+        {
+            "key": ["A", "A", "A", "A", "B"],
+            "visitdate": pd.to_datetime(
+                ["2020-01-01", "2020-02-01", "2020-05-01", "2021-01-01", "2020-01-01"]
+            ),
+            "iit": [1, 0, 0, 0, 0],
+        }
+    )
+    status = target_features.cascade_status(
+        targets["key"], targets["visitdate"], targets["iit"]
+    )
+    # A re-engages on 2020-02-01 after the iit; B never disengages
+    assert list(status) == [
+        "neverdisengaged",
+        "shorttermrestart",
+        "shorttermrestart",
+        "longtermrestart",
+        "neverdisengaged",
+    ]
@@ -84,3 +84,17 @@ def test_regimen_switch():
     # For patient A: first two visits should be None, third should be 1 (switch)
     # For patient B: first visit None, second visit 0 (no switch)
     assert list(df["regimen_switch"]) == [0, 0, 1, 0, 0]
+
+
+def test_regimen_switch_window():
+    df = pd.DataFrame(
+        {
+            "key": ["A", "A", "A", "B"],
+            "visitdate": ["2020-01-01", "2020-12-31", "2021-01-01", "2020-01-01"],
+            "currentregimen": ["ABC", "DEF", None, " "],
+        }
+    )
+    df = visit_features.regimen_switch(df)
+    # ABC still counts 365 days later but not 366; B never has a regimen
+    assert df["regimen_switch"].tolist()[:3] == [0, 1, 0]
+    assert pd.isnull(df["regimen_switch"].iloc[3])